@@ -1,6 +1,117 @@
+"""
+Logging setup shared by every module.
+
+Loggers never write themselves. Every configured logger has a single QueueHandler that puts the record on a queue,
+and a listener thread formats the records and writes them to the console and the log files. Records are formatted
+by the listener, so arguments are only turned into text off the event loop, and only for records that are kept:
+    logger.debug("Prompt:\\n%s", LazyJson(prompt))
+Arguments are formatted later, so pass values that are not changed after the call.
+
+Besides the human readable infos.log, records are written as JSON lines to events.jsonl, with the session,
+guild and user of the current `log_context` or of the `extra` of the call. Both files rotate by size.
+DEBUG records can be sampled per call site with LOG_DEBUG_SAMPLE_RATE.
+"""
+import os
+import json
+import queue
+import atexit
 import logging
+import contextvars
+import logging.handlers
 from logging.config import dictConfig
 
+# Processes started by cluster.py write their own log files.
+LOG_SUFFIX = f"-{os.environ['CLUSTER_ID']}" if os.getenv("CLUSTER_ID") else ""
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", 5))
+# Share of the DEBUG records of each call site that are kept, e.g. 0.1 keeps one in ten.
+DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 1.0))
+# Fields of a structured record taken from `log_context` or from `extra`.
+CONTEXT_FIELDS = ("session_id", "guild_id", "user_id")
+
+# Context of the records logged by the current task, e.g. {"session_id": ..., "guild_id": ...}.
+log_context = contextvars.ContextVar("log_context", default=None)
+
+
+class LazyJson:
+    """A log argument that is serialized to JSON only when its record is formatted."""
+    __slots__ = ("value",)
+
+    def __init__(self, value) -> None:
+        self.value = value
+
+    def __str__(self) -> str:
+        return json.dumps(self.value, indent=4, ensure_ascii=False)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line."""
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class ContextFilter(logging.Filter):
+    """Copies `log_context` onto the record, in the thread that logs it."""
+
+    def filter(self, record):
+        context = log_context.get()
+        if context:
+            for field, value in context.items():
+                if getattr(record, field, None) is None:
+                    setattr(record, field, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a `rate` share of the DEBUG records of each call site. Other levels always pass."""
+
+    def __init__(self, rate=DEBUG_SAMPLE_RATE) -> None:
+        super().__init__()
+        self.rate = rate
+        self.counts = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        key = (record.pathname, record.lineno)
+        count = self.counts.get(key, 0) + 1
+        self.counts[key] = count
+        return int(count * self.rate) > int((count - 1) * self.rate)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that leaves the formatting to the listener thread."""
+
+    def prepare(self, record):
+        return record
+
+
+class LazyQueueListener(logging.handlers.QueueListener):
+    """A QueueListener that formats the message of a record once for all of its handlers."""
+
+    def prepare(self, record):
+        try:
+            record.msg = record.getMessage()
+        except Exception as e:
+            # A bad format string must not stop the listener thread.
+            record.msg = f"{record.msg!r} % {record.args!r} ({e})"
+        record.args = None
+        return record
+
+
 LOGGING_CONFIG = {
     "version": 1,
     "disabled_existing_loggers": False,
@@ -10,6 +121,9 @@ LOGGING_CONFIG = {
         },
         "standard": {
             "format": "%(levelname)-8s - %(name)-20s : %(message)s"
+        },
+        "json": {
+            "()": JsonFormatter
         }
     },
     "handlers": {
@@ -25,39 +139,84 @@ LOGGING_CONFIG = {
         },
         "file": {
             'level': "INFO",
-            'class': "logging.FileHandler",
-            'filename': "assets/logs/infos.log",
-            'mode': "w",
+            'class': "logging.handlers.RotatingFileHandler",
+            'filename': f"assets/logs/infos{LOG_SUFFIX}.log",
+            'maxBytes': LOG_MAX_BYTES,
+            'backupCount': LOG_BACKUPS,
+            'encoding': "utf-8",
             'formatter': "verbose"
         },
+        "events": {
+            'level': "INFO",
+            'class': "logging.handlers.RotatingFileHandler",
+            'filename': f"assets/logs/events{LOG_SUFFIX}.jsonl",
+            'maxBytes': LOG_MAX_BYTES,
+            'backupCount': LOG_BACKUPS,
+            'encoding': "utf-8",
+            'formatter': "json"
+        },
     },
     "loggers": {
         "bot": {
-            'handlers': ['console', "file"],
+            'handlers': ['console', "file", "events"],
             "level": "INFO",
             "propagate": False
         },
         "core": {
-            'handlers': ['console', "file"],
+            'handlers': ['console', "file", "events"],
             "level": "DEBUG",
             "propagate": False
         },
         "gpt3": {
-            'handlers': ['console', "file"],
+            'handlers': ['console', "file", "events"],
             "level": "DEBUG",
             "propagate": False
         },
         "psy": {
-            'handlers': ['console', "file"],
+            'handlers': ['console', "file", "events"],
             "level": "DEBUG",
             "propagate": False
         },
         "discord": {
-            'handlers': ['console2', "file"],
+            'handlers': ['console2', "file", "events"],
             "level": "INFO",
             "propagate": False
         }
     }
 }
 
+listeners = []
+
+
+def _queue_handlers(config):
+    """
+    Move the handlers of every configured logger behind a queue.
+    Loggers with the same handlers share one queue and one listener thread.
+    """
+    queue_handlers = {}
+    for name in config["loggers"]:
+        logger = logging.getLogger(name)
+        handlers = tuple(logger.handlers)
+        if handlers not in queue_handlers:
+            records = queue.SimpleQueue()
+            listener = LazyQueueListener(
+                records, *handlers, respect_handler_level=True)
+            listener.start()
+            listeners.append(listener)
+            handler = LazyQueueHandler(records)
+            handler.addFilter(ContextFilter())
+            handler.addFilter(SamplingFilter())
+            queue_handlers[handlers] = handler
+        logger.handlers = [queue_handlers[handlers]]
+
+
+def stop_logging():
+    """Write the queued records and stop the listener threads."""
+    while listeners:
+        listeners.pop().stop()
+
+
 dictConfig(LOGGING_CONFIG)
+_queue_handlers(LOGGING_CONFIG)
+# Registered after logging's own exit handler, so it runs before the handlers are closed.
+atexit.register(stop_logging)
@@ -0,0 +1,191 @@
+"""
+Personality analysis of a PsyGPT questionnaire.
+
+The analysis is a map-reduce: every question/answer pair is scored in its own request, at most
+`concurrency` at a time, then the notes are reduced into the final report in one more request.
+The chat system message of the self chat is built from the report.
+
+Results are cached in the database by a hash of the prompts, questions and answers, so the same answers are
+never analyzed twice and changing a prompt invalidates the cache.
+
+Batch mode regenerates the report and chat system message of every stored user:
+    python -m assets.utils.analysis --concurrency 4
+Users whose analysis for the current prompts is cached are skipped, so an interrupted run resumes where it stopped.
+"""
+import os
+import json
+import asyncio
+import hashlib
+import argparse
+import openai
+from assets.utils.chat import generate_conversation
+from assets.utils.scheduler import SYSTEM_REQUESTER
+from assets.utils.storage import PsyDatabase
+from assets.utils.log_writer import log_writer
+from assets.utils.completion import completion_client
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("psy")
+
+# Scoring requests in flight at once for one analysis.
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", 4))
+# Each answer is cut to this many characters before it is scored.
+ANSWER_CHARS = 1000
+
+SCORE_SYSTEM_MESSAGE = (
+    "你是一位心理諮商師。以下是一題性格問卷的問題與使用者的回答。"
+    "請用繁體中文寫下這個回答透露出的性格特質、價值觀與情緒傾向，條列三到五點，每點不超過30字。"
+)
+REDUCE_SYSTEM_MESSAGE = (
+    "你是一位心理諮商師。以下是你對使用者每一題問卷回答的筆記。"
+    "請用繁體中文整合成一份給使用者本人的性格分析報告，包含整體性格、優勢、可能的盲點與建議，不超過500字。"
+)
+CHAT_SYSTEM_TEMPLATE = (
+    "你就是使用者本人，正在和自己聊天。以下是你的性格分析報告：\n{report}\n"
+    "請依照報告中的性格、價值觀與說話方式回答，全程使用繁體中文。若對方與你道別，請一律回答“掰掰”。"
+)
+
+
+def analysis_key(questions, answers):
+    """Hash of everything the analysis depends on: the prompts, the questions and the answers."""
+    data = json.dumps([SCORE_SYSTEM_MESSAGE, REDUCE_SYSTEM_MESSAGE, CHAT_SYSTEM_TEMPLATE,
+                      list(questions), list(answers)], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+async def score_answer(question, answer, requester=SYSTEM_REQUESTER, debug=False):
+    """Map step: notes on what one answer tells about the user."""
+    content = f"問題：{question}\n回答：{answer[:ANSWER_CHARS]}"
+    if debug:
+        return f"- {content}"
+    return await generate_conversation([
+        {"role": "system", "content": SCORE_SYSTEM_MESSAGE},
+        {"role": "user", "content": content},
+    ], requester=requester)
+
+
+async def reduce_notes(notes, requester=SYSTEM_REQUESTER, debug=False):
+    """Reduce step: the report from the notes of every answer."""
+    content = "\n\n".join(
+        f"第{i}題：\n{note}" for i, note in enumerate(notes, 1))
+    if debug:
+        return content
+    return await generate_conversation([
+        {"role": "system", "content": REDUCE_SYSTEM_MESSAGE},
+        {"role": "user", "content": content},
+    ], requester=requester)
+
+
+async def personality_analyze(questions, answers, database=None, requester=SYSTEM_REQUESTER, concurrency=ANALYSIS_CONCURRENCY, debug=False):
+    """
+    Analyze the user's personality by their answers.
+
+    Parameters:
+    - questions (list): The questions of the questionnaire.
+    - answers (list): The answers, in the same order.
+    - database (PsyDatabase): If given, results are cached in it.
+    - requester (tuple): (guild ID, user ID) the requests are scheduled for.
+    - concurrency (int): Scoring requests in flight at once.
+
+    Returns:
+    - report (str): The personality report.
+    - chat_system_message (str): The system message of the user's self chat.
+    """
+    key = analysis_key(questions, answers)
+    if database is not None and not debug:
+        cached = await database.get_analysis(key)
+        if cached is not None:
+            return cached
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def score(question, answer):
+        async with semaphore:
+            return await score_answer(question, answer, requester, debug)
+
+    notes = await asyncio.gather(*(score(question, answer) for question, answer in zip(questions, answers)))
+    report = await reduce_notes(notes, requester, debug)
+    chat_system_message = CHAT_SYSTEM_TEMPLATE.format(report=report)
+    if database is not None and not debug:
+        await database.save_analysis(key, report, chat_system_message)
+    return report, chat_system_message
+
+
+async def reanalyze_all(database, concurrency=ANALYSIS_CONCURRENCY, users=2, force=False, debug=False):
+    """
+    Regenerate the report and chat system message of every stored user.
+
+    Parameters:
+    - database (PsyDatabase): The PsyGPT database.
+    - concurrency (int): Scoring requests in flight at once, per user.
+    - users (int): Users analyzed at once.
+    - force (bool): Ignore the cached analyses and request everything again.
+    - debug (bool): Dry run. The reports are built from the answers and printed, nothing is written.
+
+    Returns:
+    - counts (dict): Number of users "analyzed", "cached" and "failed".
+    """
+    counts = {"analyzed": 0, "cached": 0, "failed": 0}
+    ids = await database.ids()
+    semaphore = asyncio.Semaphore(users)
+
+    async def reanalyze(user_id):
+        async with semaphore:
+            record = await database.get(user_id)
+            key = analysis_key(record["questions"], record["answers"])
+            cached = None if force else await database.get_analysis(key)
+            try:
+                if cached is None:
+                    report, chat_system_message = await personality_analyze(
+                        record["questions"], record["answers"], concurrency=concurrency, debug=debug)
+                    if not debug:
+                        await database.save_analysis(key, report, chat_system_message)
+                    status = "analyzed"
+                else:
+                    report, chat_system_message = cached
+                    status = "cached"
+                if debug:
+                    print(json.dumps({"user_id": user_id, "report": report,
+                                      "chat_system_message": chat_system_message}, ensure_ascii=False))
+                elif (report, chat_system_message) != (record["report"], record["chat_system_message"]):
+                    await database.update(user_id, report=report, chat_system_message=chat_system_message)
+            except Exception as e:
+                status = "failed"
+                logger.error(f"Failed to analyze user {user_id}: {e}")
+            counts[status] += 1
+            done = sum(counts.values())
+            if done % 10 == 0 or done == len(ids):
+                logger.info(
+                    f"Reanalyzed {done}/{len(ids)} users: {counts}")
+
+    await asyncio.gather(*(reanalyze(user_id) for user_id in ids))
+    return counts
+
+
+async def main(args):
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+
+    database = PsyDatabase(args.database)
+    try:
+        counts = await reanalyze_all(database, args.concurrency, args.users, args.force, args.debug)
+        print(counts)
+    finally:
+        await log_writer.close()
+        await completion_client.close()
+        await asyncio.to_thread(database.close)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Regenerate the personality report of every stored PsyGPT user.")
+    parser.add_argument("--database", default="assets/database/psygpt.sqlite3",
+                        help="Path to the PsyGPT database. (Default: assets/database/psygpt.sqlite3)")
+    parser.add_argument("--concurrency", type=int, default=ANALYSIS_CONCURRENCY,
+                        help=f"Scoring requests in flight per user. (Default: {ANALYSIS_CONCURRENCY})")
+    parser.add_argument("--users", type=int, default=2,
+                        help="Users analyzed at once. (Default: 2)")
+    parser.add_argument("--force", action="store_true",
+                        help="Ignore cached analyses.")
+    parser.add_argument("--debug", action="store_true",
+                        help="Dry run: do not call the model or write the database, print the reports built from the answers.")
+    asyncio.run(main(parser.parse_args()))
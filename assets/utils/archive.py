@@ -0,0 +1,274 @@
+"""
+Compacted archive of the conversation logs.
+
+Every chat writes its own JSONL file into assets/logs/conv_history/. Once a chat is finished, the compactor
+appends its file to the current segment of the archive as one gzip member and deletes it. Segments roll over
+at SEGMENT_BYTES, and each is a valid multi-member gzip file, so `zcat` reads it as well.
+An SQLite index holds the user, persona, time range, message and token counts of every archived chat and where
+its member is, so a chat is read without touching the rest of its segment.
+
+The bot compacts every ARCHIVE_INTERVAL seconds. The CLI reads the archive one chat at a time:
+    python -m assets.utils.archive query --user 1234 --persona Kita
+    python -m assets.utils.archive stats --since 2023-04-01
+    python -m assets.utils.archive compact --older-than 0
+"""
+import os
+import re
+import sys
+import json
+import gzip
+import zlib
+import time
+import asyncio
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+from assets.utils.metrics import metrics
+from assets.utils.timers import timers
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("bot")
+
+HISTORY_DIR = "assets/logs/conv_history"
+ARCHIVE_DIR = "assets/logs/archive"
+# A segment is closed and a new one started once it is this large.
+SEGMENT_BYTES = int(os.getenv("ARCHIVE_SEGMENT_BYTES", 64 * 1024 * 1024))
+# Logs not written for this many seconds belong to finished chats, idle chats are closed long before.
+ARCHIVE_AFTER = float(os.getenv("ARCHIVE_AFTER", 2 * 60 * 60))
+# Seconds between two compactions.
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", 10 * 60))
+READ_CHUNK = 64 * 1024
+
+# Log files are named "<user ID>-<persona>-<%Y%m%d%H%M%S>.jsonl". Older logs have random names.
+LOG_NAME = re.compile(r"^(\d+)-(.+)-(\d{14})\.jsonl$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    name TEXT PRIMARY KEY,
+    user_id INTEGER,
+    persona TEXT,
+    started TEXT NOT NULL,
+    ended TEXT NOT NULL,
+    messages INTEGER NOT NULL,
+    tokens INTEGER NOT NULL,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chats_by_user ON chats (user_id, persona, started);
+CREATE INDEX IF NOT EXISTS chats_by_persona ON chats (persona, started);
+CREATE INDEX IF NOT EXISTS chats_by_time ON chats (started);
+"""
+
+
+def history_path(user_id, persona):
+    """Path of the log of a chat that starts now."""
+    return os.path.join(HISTORY_DIR, f"{user_id}-{persona}-{datetime.now().strftime('%Y%m%d%H%M%S')}.jsonl")
+
+
+class ConversationArchive:
+    """
+    Segment files and their index.
+
+    Attributes:
+    - directory (str): Directory of the segments and of index.sqlite3.
+    - history_dir (str): Directory of the conversation logs to compact.
+    - live (set): Log paths of the chats in progress in this process, never compacted.
+    """
+
+    def __init__(self, directory=ARCHIVE_DIR, history_dir=HISTORY_DIR) -> None:
+        self.directory = directory
+        self.history_dir = history_dir
+        self.live = set()
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(
+                self.directory, "index.sqlite3"), check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            self._conn.commit()
+        return self._conn
+
+    def _current_segment(self, incoming):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = sorted(name for name in os.listdir(self.directory)
+                          if name.startswith("segment-") and name.endswith(".jsonl.gz"))
+        if segments:
+            last = segments[-1]
+            if os.path.getsize(os.path.join(self.directory, last)) + incoming <= SEGMENT_BYTES:
+                return last
+            number = int(last[len("segment-"):-len(".jsonl.gz")]) + 1
+        else:
+            number = 0
+        return f"segment-{number:06d}.jsonl.gz"
+
+    def _archive_file(self, path):
+        name = os.path.basename(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        records = []
+        for line in data.splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A torn last line after a crash, skip it.
+                continue
+        match = LOG_NAME.match(name)
+        mtime = datetime.fromtimestamp(
+            os.path.getmtime(path)).isoformat(timespec="seconds")
+        times = [record["time"] for record in records if "time" in record]
+        member = gzip.compress(data)
+        segment = self._current_segment(len(member))
+        segment_path = os.path.join(self.directory, segment)
+        with open(segment_path, "ab") as f:
+            offset = f.tell()
+            f.write(member)
+            f.flush()
+            os.fsync(f.fileno())
+        conn = self.conn
+        conn.execute("INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+            name, int(match.group(1)) if match else None, match.group(
+                2) if match else None,
+            times[0] if times else mtime, times[-1] if times else mtime,
+            sum(record.get("role") != "system" for record in records),
+            sum(record.get("tokens", 0) for record in records),
+            segment, offset, len(member)))
+        conn.commit()
+        # Only removed once it is indexed, a crash in between archives the chat again under the same name.
+        os.remove(path)
+
+    def compact(self, older_than=ARCHIVE_AFTER):
+        """
+        Move the finished logs into the archive.
+
+        Parameters:
+        - older_than (float): Only logs not written for this many seconds are archived.
+
+        Returns:
+        - archived (int): Number of archived chats.
+        """
+        if not os.path.isdir(self.history_dir):
+            return 0
+        archived = 0
+        with self._lock:
+            cutoff = time.time() - older_than
+            for entry in os.scandir(self.history_dir):
+                if not entry.name.endswith(".jsonl") or entry.path in self.live:
+                    continue
+                try:
+                    if entry.stat().st_mtime > cutoff:
+                        continue
+                    self._archive_file(entry.path)
+                except Exception as e:
+                    logger.error(f"Failed to archive {entry.path}: {e}")
+                    continue
+                archived += 1
+                metrics.inc("chats_archived_total")
+        return archived
+
+    async def run(self):
+        """Compact in a worker thread, then again every ARCHIVE_INTERVAL seconds."""
+        try:
+            archived = await asyncio.to_thread(self.compact)
+            if archived:
+                logger.info(f"Archived {archived} conversation logs.")
+        except Exception as e:
+            logger.error(f"Failed to compact conversation logs: {e}")
+        timers.call_later(ARCHIVE_INTERVAL, self.run)
+
+    def find(self, user_id=None, persona=None, since=None, until=None):
+        """Yield the index rows of the matching chats, oldest first. `since` and `until` are ISO times."""
+        conditions, values = [], []
+        for column, operator, value in (("user_id", "=", user_id), ("persona", "=", persona),
+                                        ("started", ">=", since), ("started", "<", until)):
+            if value is not None:
+                conditions.append(f"{column} {operator} ?")
+                values.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        yield from self.conn.execute(f"SELECT * FROM chats {where} ORDER BY started", values)
+
+    def read(self, row):
+        """Yield the records of one archived chat, decompressing its member chunk by chunk."""
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        tail = b""
+        with open(os.path.join(self.directory, row["segment"]), "rb") as f:
+            f.seek(row["offset"])
+            remaining = row["length"]
+            while remaining:
+                chunk = f.read(min(READ_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                *lines, tail = (tail + decompressor.decompress(chunk)).split(b"\n")
+                for line in lines:
+                    if line:
+                        yield json.loads(line)
+        tail += decompressor.flush()
+        for line in tail.split(b"\n"):
+            if line:
+                yield json.loads(line)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+conversation_archive = ConversationArchive()
+
+
+def main(args):
+    archive = ConversationArchive(args.archive, args.history)
+    try:
+        if args.command == "compact":
+            print(f"Archived {archive.compact(args.older_than)} conversation logs.")
+            return
+        rows = archive.find(args.user, args.persona, args.since, args.until)
+        if args.command == "query":
+            for row in rows:
+                for record in archive.read(row):
+                    sys.stdout.write(json.dumps(
+                        {"chat": row["name"], **record}, ensure_ascii=False) + "\n")
+            return
+        totals = {"chats": 0, "messages": 0, "tokens": 0}
+        for row in rows:
+            print(f"{row['name']}\t{row['persona']}\t{row['started']}\t{row['messages']} messages\t{row['tokens']} tokens")
+            totals["chats"] += 1
+            totals["messages"] += row["messages"]
+            totals["tokens"] += row["tokens"]
+        print(f"{totals['chats']} chats, {totals['messages']} messages, {totals['tokens']} tokens")
+    finally:
+        archive.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compact and query the conversation archive.")
+    parser.add_argument("--archive", default=ARCHIVE_DIR,
+                        help=f"Archive directory. (Default: {ARCHIVE_DIR})")
+    parser.add_argument("--history", default=HISTORY_DIR,
+                        help=f"Conversation log directory. (Default: {HISTORY_DIR})")
+    commands = parser.add_subparsers(dest="command", required=True)
+    compact = commands.add_parser(
+        "compact", help="Archive the finished conversation logs now.")
+    compact.add_argument("--older-than", type=float, default=ARCHIVE_AFTER,
+                         help=f"Only archive logs not written for this many seconds. (Default: {ARCHIVE_AFTER:g})")
+    for command, help in (("query", "Stream the messages of the matching chats as JSON lines."),
+                          ("stats", "Print the message and token counts of the matching chats.")):
+        subparser = commands.add_parser(command, help=help)
+        subparser.add_argument("--user", type=int, help="User ID.")
+        subparser.add_argument(
+            "--persona", help='Persona key, or "self" for PsyGPT self chats.')
+        subparser.add_argument(
+            "--since", help="Chats started at or after this ISO time, e.g. 2023-04-01.")
+        subparser.add_argument(
+            "--until", help="Chats started before this ISO time.")
+    main(parser.parse_args())
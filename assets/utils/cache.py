@@ -0,0 +1,94 @@
+import os
+import time
+import hashlib
+import unicodedata
+from collections import OrderedDict
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.getenv("RESPONSE_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+
+TRAILING_PUNCTUATION = "?？!！。.~～ 　"
+
+
+def normalize(text):
+    """Normalize a message so trivially different inputs share a cache entry."""
+    text = unicodedata.normalize("NFKC", text)
+    text = " ".join(text.split())
+    return text.rstrip(TRAILING_PUNCTUATION).lower()
+
+
+class ResponseCache:
+    """
+    An LRU cache of completions keyed by a hash of the namespace (usually the persona) and the normalized prompt.
+
+    Entries expire after `ttl` seconds, and the least recently used entries are evicted when there are more than
+    `max_entries` of them or they take more than `max_bytes`.
+
+    Attributes:
+    - enabled (bool): Whether lookups and stores do anything.
+    - hits (int): Number of lookups that found a response.
+    - misses (int): Number of lookups that did not.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES, enabled=RESPONSE_CACHE_ENABLED) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(namespace, messages):
+        digest = hashlib.sha256(namespace.encode("utf-8"))
+        for message in messages:
+            digest.update(b"\0" + message["role"].encode("utf-8") +
+                          b"\0" + normalize(message["content"]).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, namespace, messages):
+        """Returns the cached response for this prompt, or None."""
+        if not self.enabled:
+            return None
+        key = self.key(namespace, messages)
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] > self.ttl:
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, namespace, messages, response):
+        if not self.enabled or not response:
+            return
+        key = self.key(namespace, messages)
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (response, time.monotonic())
+        self.size += len(key) + len(response.encode("utf-8"))
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        response, _ = self.entries.pop(key)
+        self.size -= len(key) + len(response.encode("utf-8"))
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+response_cache = ResponseCache()
@@ -1,15 +1,40 @@
 import os
+import sys
 import json
-import openai
+import math
 import random
+import itertools
+import asyncio
 import discord
-import tiktoken
+import openai
+import time
 from datetime import datetime
 from collections import deque
-from asgiref.sync import sync_to_async
+from assets.utils.log_writer import log_writer
+from assets.utils.resilience import resilient_completion, CircuitOpen, DeadlineExceeded
+from assets.utils.cache import response_cache
+from assets.utils.scheduler import request_scheduler, SchedulerBusy, SYSTEM_REQUESTER
+from assets.utils.snapshot import session_journal
+from assets.utils.persona import persona_registry
+from assets.utils.memory import memory_budget, SPILL_DIR
+from assets.utils.archive import conversation_archive, history_path
+from assets.utils.tokens import num_tokens_from_message, num_tokens_from_message_async, num_tokens_from_messages
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("bot")
 
-character_info = json.load(
-    open("assets/settings/character_info.json", "r", encoding="utf-8"))
+# Maximum number of tokens of a prompt. Older messages are summarized to stay under it.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3500))
+# Each message is cut to this many characters before it is summarized.
+SUMMARY_INPUT_CHARS = 1000
+
+DISCORD_MESSAGE_LIMIT = 2000
+# Discord allows roughly 5 message edits per 5 seconds in a channel.
+EDIT_BUDGET = 5
+EDIT_WINDOW = 5.0
+
+# Bytes of a turn besides its content: the (role, content, tokens) tuple and the token count.
+TURN_OVERHEAD = sys.getsizeof(("user", "", 0)) + sys.getsizeof(1000)
 
 
 class CharacterSelectMenuView(discord.ui.View):
@@ -17,6 +42,12 @@ class CharacterSelectMenuView(discord.ui.View):
         super().__init__()
         self.value = None
         self.author = author
+        # Build the options per view so personas added by a reload show up.
+        self.select_callback.options = [discord.SelectOption(
+            label=persona.name,
+            value=persona.key,
+            description=persona.description) for persona in persona_registry.values()
+        ]
 
     """Check if the user is the author of the command"""
     async def interaction_check(self, interaction: discord.MessageInteraction) -> bool:
@@ -27,14 +58,7 @@ class CharacterSelectMenuView(discord.ui.View):
         return True
 
     """A select menu for the user to choose the character to chat with"""
-    @discord.ui.select(
-        placeholder="請選擇",
-        options=[discord.SelectOption(
-            label=character_info[character]["name"],
-            value=character,
-            description=character_info[character]["description"]) for character in character_info.keys()
-        ]
-    )
+    @discord.ui.select(placeholder="請選擇")
     async def select_callback(self, interaction, select):
         await interaction.response.defer()
         self.value = select.values[0]
@@ -42,10 +66,12 @@ class CharacterSelectMenuView(discord.ui.View):
 
 
 class User:
-    def __init__(self, id, conversation_path, debug=False):
+    __slots__ = ("id", "conversation", "count")
+
+    def __init__(self, id, conversation_path, debug=False, log_path=None, restored=False):
         self.id = id
         self.conversation = CharacterConversation(
-            id, conversation_path, limit=5, debug=debug)
+            id, conversation_path, debug=debug, log_path=log_path, restored=restored)
         self.count = 0
 
     # These user objects should be accessible by ID, for example if we had a bunch of user
@@ -64,117 +90,673 @@ class User:
         return self.__repr__()
 
 
+def _turn_size(content):
+    """Approximate bytes held by one turn: the content string plus the tuple and its token count."""
+    return sys.getsizeof(content) + TURN_OVERHEAD
+
+
+# Numbers the spill files, so a file still being removed never has the name of a new one.
+_spill_ids = itertools.count()
+# Background spill file tasks, kept so they are not garbage collected.
+_spill_tasks = set()
+
+
+def _in_background(func, *args):
+    """Run blocking file I/O in a worker thread. Without an event loop (scripts, benchmarks) it runs right away."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        func(*args)
+        return None
+    task = loop.create_task(asyncio.to_thread(func, *args))
+    _spill_tasks.add(task)
+    task.add_done_callback(_spill_tasks.discard)
+    return task
+
+
+def _dump_turns(path, turns):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(turns, f, ensure_ascii=False)
+
+
+def _load_turns(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _remove_spill(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _discard_spill(path, written):
+    """Remove a spill file in the background, once the task `written` that writes it is done."""
+    async def discard():
+        await asyncio.wait([written])
+        await asyncio.to_thread(_remove_spill, path)
+
+    if written is None:
+        _in_background(_remove_spill, path)
+        return
+    task = asyncio.get_running_loop().create_task(discard())
+    _spill_tasks.add(task)
+    task.add_done_callback(_spill_tasks.discard)
+
+
 class Conversation:
     """
     A class to store the conversation history. Conversation source should be stored in a folder inside assets/texts.
 
+    Turns are stored as compact (role, content, tokens) tuples. Token counts are computed once per turn when it
+    is appended and kept in a running total, so `prompt_tokens` and `__len__` do not re-encode the history.
+
+    The prompt always starts with `prefix`, the system message and the pinned few-shot examples. The prefix is an
+    immutable tuple that character conversations share with their persona. The rest of `token_budget` is filled
+    with the newest turns, and older turns are compacted into a rolling summary by `compact`.
+
+    The size of the history is reported to the global memory budget, which may spill the history of an inactive
+    conversation to disk. The file is written and read in a worker thread: `aprepare_prompt` loads the history
+    back with `load` before the turn uses it, and `turns` only falls back to a blocking read when it was not loaded.
+
     Attributes:
-    - messages (list): A list of messages for sending api request to OpenAI gpt-3.5-turbo.
+    - prefix (tuple): Messages at the start of every prompt: the system message, then the few-shot examples.
+    - prefix_tokens (int): Token count of `prefix`.
+    - turns (deque): (role, content, tokens) of every message in the history.
+    - total_tokens (int): Sum of the token counts of `turns`.
+    - summary (str): Summary of the messages that were compacted out of the history.
+    - token_budget (int): Maximum number of tokens of a prompt.
+    - journal_key (str): If set, every change is recorded in the session journal under this key.
+    - size (int): Approximate bytes held by `turns`.
+    - closed (bool): Whether the conversation ended. A closed conversation is no longer tracked by the memory budget.
     """
 
-    def __init__(self, limit=10, debug=False) -> None:
+    __slots__ = ("debug", "log_path", "journal_key", "prefix", "prefix_tokens", "summary", "summary_tokens",
+                 "token_budget", "_turns", "total_tokens", "window_tokens", "size", "spill_path", "_spill_data",
+                 "_spill_task", "_compaction", "closed")
+
+    def __init__(self, limit=None, debug=False, token_budget=CONTEXT_TOKEN_BUDGET, log_path=None) -> None:
         self.debug = debug
-        # generate random string txt file name
-        dummy_file_name = ''.join(random.choices(
-            "abcdefghijklmnopqrstuvwxyz", k=10))
-        self.log_path = f"assets/logs/conv_history/{dummy_file_name}.txt"
-        self.system_messages = None
-        self.messages = deque(maxlen=limit)
-
-    def init_system_message(self, message):
-        self.system_messages = {"role": "system", "content": message}
-        self._write_log()
-
-    def prepare_prompt(self, prompt):
+        if log_path is None:
+            # generate random string txt file name
+            dummy_file_name = ''.join(random.choices(
+                "abcdefghijklmnopqrstuvwxyz", k=10))
+            log_path = f"assets/logs/conv_history/{dummy_file_name}.jsonl"
+        self.log_path = log_path
+        # Not archived while the chat is in progress.
+        conversation_archive.live.add(log_path)
+        self.journal_key = None
+        self.prefix = ()
+        self.prefix_tokens = 0
+        self.summary = None
+        self.summary_tokens = 0
+        self.token_budget = token_budget
+        self._turns = deque(maxlen=limit)
+        self.total_tokens = 0
+        self.window_tokens = 0
+        self.size = 0
+        self.spill_path = None
+        self._spill_data = None
+        self._spill_task = None
+        self._compaction = None
+        self.closed = False
+
+    @property
+    def system_messages(self):
+        return self.prefix[0] if self.prefix else None
+
+    def init_system_message(self, message, tokens=None, log=True):
+        '''Set the system message. `log` is False for a restored conversation whose log already starts with it.'''
+        system_message = {"role": "system", "content": message}
+        if tokens is None:
+            tokens = num_tokens_from_message(system_message)
+        self.prefix = (system_message,)
+        self.prefix_tokens = tokens
+        if log:
+            self._write_log(system_message, tokens)
+
+    def add_example(self, message, tokens=None):
+        '''Pin a few-shot example message. Examples stay in every prompt.'''
+        if tokens is None:
+            tokens = num_tokens_from_message(message)
+        self.prefix += (message,)
+        self.prefix_tokens += tokens
+
+    @property
+    def turns(self):
+        if self.spill_path is not None:
+            self._unspill()
+        return self._turns
+
+    @property
+    def last_tokens(self):
+        '''Token count of the newest turn.'''
+        return self.turns[-1][2]
+
+    def _append(self, message, tokens=None):
+        """Append a message and keep the running token total in sync with the bounded deque."""
+        if tokens is None:
+            tokens = num_tokens_from_message(message)
+        turns = self.turns
+        delta = _turn_size(message["content"])
+        if turns.maxlen is not None and len(turns) == turns.maxlen:
+            # The deque is about to drop its oldest turn.
+            self.total_tokens -= turns[0][2]
+            delta -= _turn_size(turns[0][1])
+        turns.append((message["role"], message["content"], tokens))
+        self.total_tokens += tokens
+        self.size += delta
+        memory_budget.resize(self, delta)
+        self._write_log(message, tokens)
+        if self.journal_key is not None:
+            session_journal.message(self.journal_key, message, tokens)
+
+    def _popleft(self):
+        _, content, tokens = self.turns.popleft()
+        self.total_tokens -= tokens
+        self._shrink(_turn_size(content))
+
+    def pop_last(self):
+        '''Remove the newest message, e.g. a user input that does not fit in the budget.'''
+        _, content, tokens = self.turns.pop()
+        self.total_tokens -= tokens
+        self._shrink(_turn_size(content))
+        if self.journal_key is not None:
+            session_journal.pop(self.journal_key)
+
+    def _shrink(self, freed):
+        if self.closed:
+            return
+        self.size -= freed
+        memory_budget.resize(self, -freed)
+
+    @property
+    def history_budget(self):
+        '''Number of tokens left for the history after the pinned part of the prompt.'''
+        return self.token_budget - self.prefix_tokens - self.summary_tokens - 2
+
+    def _window_size(self):
+        '''Number of newest turns that fit in the history budget. The newest turn is always included.'''
+        budget = self.history_budget
+        used = 0
+        count = 0
+        for _, _, tokens in reversed(self.turns):
+            if count and used + tokens > budget:
+                break
+            used += tokens
+            count += 1
+        self.window_tokens = used
+        return count
+
+    def _pinned(self):
+        if self.summary:
+            return list(self.prefix) + [{"role": "system", "content": f"先前對話的摘要：{self.summary}"}]
+        return list(self.prefix)
+
+    def prepare_prompt(self, prompt, tokens=None):
         '''Get the user input and append it to prompt body. Return the prompt body.'''
-        if self.system_messages is None:
+        if not self.prefix:
             raise Exception("System message not found.")
-        self.messages.append({"role": "user", "content": prompt})
-        self._write_log()
-        return [self.system_messages] + list(self.messages)
+        self._append({"role": "user", "content": prompt}, tokens)
+        size = self._window_size()
+        turns = self.turns
+        window = [{"role": role, "content": content}
+                  for role, content, _ in itertools.islice(turns, len(turns) - size, None)]
+        return self._pinned() + window
+
+    async def aprepare_prompt(self, prompt):
+        '''Same as `prepare_prompt`, but long inputs are tokenized and a spilled history is loaded off the event loop.'''
+        await self.load()
+        tokens = await num_tokens_from_message_async(
+            {"role": "user", "content": prompt})
+        return self.prepare_prompt(prompt, tokens)
 
     def append_response(self, response):
         '''Get the assistant response and append it to prompt body.'''
-        if self.system_messages is None:
+        if not self.prefix:
             raise Exception("System message not found.")
-        self.messages.append({"role": "assistant", "content": response})
-        self._write_log()
-
-    def _write_log(self):
-        with open(self.log_path, "w", encoding="utf-8") as f:
-            json.dump([self.system_messages] + list(self.messages),
-                      f, indent=4, ensure_ascii=False)
+        self._append({"role": "assistant", "content": response})
+        if self.total_tokens > self.history_budget:
+            self.schedule_compaction()
+
+    def schedule_compaction(self):
+        '''Start `compact` in the background unless it is already running.'''
+        if self._compaction is None or self._compaction.done():
+            self._compaction = asyncio.get_running_loop().create_task(self.compact())
+
+    async def compact(self):
+        '''Fold the oldest messages into the rolling summary until the history fits in half of the budget.'''
+        await self.load()
+        keep = self.history_budget // 2
+        count = 0
+        remaining = self.total_tokens
+        turns = self.turns
+        for _, _, tokens in turns:
+            if remaining <= keep or count == len(turns) - 1:
+                break
+            remaining -= tokens
+            count += 1
+        if count == 0:
+            return
+        old = [{"role": role, "content": content}
+               for role, content, _ in itertools.islice(turns, count)]
+        try:
+            summary = await summarize_conversation(self.summary, old, debug=self.debug)
+        except Exception as e:
+            # The old messages are already outside the prompt window, so dropping them keeps the history bounded.
+            logger.error(f"Failed to summarize conversation: {e}")
+            summary = self.summary
+        # New messages are only appended on the right, so the oldest `count` messages are still the ones summarized.
+        for _ in range(count):
+            self._popleft()
+        self.summary = summary
+        self.summary_tokens = num_tokens_from_message(
+            {"role": "system", "content": f"先前對話的摘要：{summary}"}) if summary else 0
+        if self.journal_key is not None:
+            session_journal.summary(
+                self.journal_key, count, summary, self.summary_tokens)
+
+    def restore(self, session):
+        '''Rebuild the history from a session restored by the session journal. Nothing is tokenized or requested.'''
+        turns = self.turns
+        delta = 0
+        for role, content, tokens in session["messages"]:
+            turns.append((role, content, tokens))
+            self.total_tokens += tokens
+            delta += _turn_size(content)
+        self.size += delta
+        memory_budget.resize(self, delta)
+        self.summary = session["summary"]
+        self.summary_tokens = session["summary_tokens"]
+
+    def spill(self):
+        '''Drop the history from memory and write it to disk in a worker thread. Returns the number of bytes freed.'''
+        if self.spill_path is not None:
+            return 0
+        path = os.path.join(
+            SPILL_DIR, f"{os.path.basename(self.log_path)}-{next(_spill_ids)}.spill")
+        # Kept until the file is written, so the history is never only in flight.
+        self._spill_data = list(self._turns)
+        freed = self.size
+        self._turns = deque(maxlen=self._turns.maxlen)
+        self.size = 0
+        self.spill_path = path
+        self._spill_task = _in_background(_dump_turns, path, self._spill_data)
+        if self._spill_task is None:
+            self._spill_data = None
+        else:
+            self._spill_task.add_done_callback(
+                lambda task: self._spill_written(task, path))
+        return freed
+
+    def _spill_written(self, task, path):
+        if self.spill_path != path:
+            # Loaded again or closed before the file was written.
+            return
+        if task.cancelled() or task.exception() is not None:
+            # The history stays in `_spill_data` and is loaded from there.
+            logger.error(
+                f"Failed to spill conversation to {path}: {None if task.cancelled() else task.exception()}")
+            return
+        self._spill_data = None
+
+    async def load(self):
+        '''Load a spilled history back into memory, reading the file in a worker thread.'''
+        path = self.spill_path
+        if path is None:
+            return
+        turns = self._spill_data
+        if turns is None:
+            turns = await asyncio.to_thread(_load_turns, path)
+            if self.spill_path != path:
+                # Loaded by someone else meanwhile.
+                return
+        self._unspilled(turns)
+
+    def _unspill(self):
+        turns = self._spill_data
+        if turns is None:
+            turns = _load_turns(self.spill_path)
+        self._unspilled(turns)
+
+    def _unspilled(self, turns):
+        _discard_spill(self.spill_path, self._spill_task)
+        self.spill_path = None
+        self._spill_data = None
+        self._spill_task = None
+        self._turns.extend(tuple(turn) for turn in turns)
+        self.size = sum(_turn_size(content) for _, content, _ in self._turns)
+        memory_budget.resize(self, self.size)
+
+    def close(self):
+        '''Release the history of a conversation that ended. A summary still being requested is cancelled.'''
+        self.closed = True
+        if self._compaction is not None and self._compaction is not asyncio.current_task():
+            self._compaction.cancel()
+        self._compaction = None
+        memory_budget.discard(self, self.size)
+        conversation_archive.live.discard(self.log_path)
+        if self.spill_path is not None:
+            _discard_spill(self.spill_path, self._spill_task)
+            self.spill_path = None
+            self._spill_data = None
+            self._spill_task = None
+
+    def _write_log(self, message, tokens=None):
+        '''Append one message to the conversation log. The write itself happens in the background.'''
+        record = {"time": datetime.now().isoformat(timespec="seconds"), **message}
+        if tokens is not None:
+            record["tokens"] = tokens
+        log_writer.write(self.log_path, record)
+
+    @property
+    def prompt_tokens(self):
+        '''Number of tokens of the prompt returned by the last `prepare_prompt`.'''
+        return self.prefix_tokens + self.summary_tokens + self.window_tokens + 2
 
     def __len__(self):
-        return num_tokens_from_messages(list(self.messages))
+        return self.total_tokens + 2
 
     def __repr__(self) -> str:
-        return json.dumps(list(self.messages), indent=4, ensure_ascii=False)
+        return json.dumps([{"role": role, "content": content} for role, content, _ in self.turns], indent=4, ensure_ascii=False)
 
     def __str__(self) -> str:
-        return json.dumps(list(self.messages), indent=4, ensure_ascii=False)
+        return self.__repr__()
 
 
 class CharacterConversation(Conversation):
     """
-    A class to store the conversation history. Conversation source should be stored in a folder inside assets/texts.
+    A class to store the conversation history with a character. The character is taken from the shared persona registry,
+    so no file is read, nothing is tokenized and the prompt prefix is shared when a conversation starts.
+
+    A conversation `restored` from the session journal continues its existing log, so the system message is not
+    written to it again.
 
     Attributes:
-    - messages (list): A list of messages for sending api request to OpenAI gpt-3.5-turbo.
+    - persona (Persona): The character of this conversation.
     """
 
-    def __init__(self, user, character, limit=10, debug=False) -> None:
-        super().__init__(limit, debug)
-        label = f"{user}-{character}-{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        self.log_path = f"assets/logs/conv_history/{label}.txt"
-        self.name = character_info[character]["name"]
+    __slots__ = ("persona", "name")
 
-        with open(os.path.join(character_info[character]["path"], "intro.txt")) as f:
-            self.init_system_message(f.read())
-        with open(os.path.join(character_info[character]["path"], "conversation.txt")) as f:
-            example_chats = f.read().splitlines()
-            for chat in example_chats:
-                u, a = chat.split(",", 1)
-                self.messages.append(
-                    {"role": "user", "content": u.strip("\n")})
-                self.messages.append(
-                    {"role": "assistant", "content": a.strip("\n")})
+    def __init__(self, user, character, limit=None, debug=False, token_budget=CONTEXT_TOKEN_BUDGET, log_path=None, restored=False) -> None:
+        if log_path is None:
+            log_path = history_path(user, character)
+        super().__init__(limit, debug, token_budget, log_path)
+        self.persona = persona_registry[character]
+        self.name = self.persona.name
 
+        self.prefix = self.persona.prefix
+        self.prefix_tokens = self.persona.prefix_tokens
+        if not restored:
+            self._write_log(self.prefix[0])
 
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo"):
-    """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":  # note: future models may deviate from this
-        num_tokens = 0
-        for message in messages:
-            # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += 4
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += -1  # role is always required and always 1 token
-        num_tokens += 2  # every reply is primed with <im_start>assistant
-        return num_tokens
-    else:
-        raise NotImplementedError(f"""num_tokens_from_messages() is not presently implemented for model {model}.
-See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
 
+async def summarize_conversation(summary, messages, debug=False):
+    """
+    Fold messages into a conversation summary.
+
+    Parameters:
+    - summary (str): The current summary, or None.
+    - messages (list): The messages to add to the summary, oldest first.
 
-async def generate_conversation(prompt):
+    Returns:
+    - summary (str): The updated summary.
+    """
+    lines = [f"{message['role']}: {message['content'][:SUMMARY_INPUT_CHARS]}" for message in messages]
+    if debug:
+        return "\n".join(([summary] if summary else []) + lines)[-SUMMARY_INPUT_CHARS:]
+    prompt = [
+        {"role": "system", "content": "請用繁體中文將以下對話整理成精簡的摘要，保留人物、事實與使用者的偏好，不超過200字。"},
+        {"role": "user", "content": "\n".join(
+            ([f"目前的摘要：{summary}"] if summary else []) + lines)}
+    ]
+    return await generate_conversation(prompt)
+
+
+async def generate_conversation(prompt, cache_namespace=None, requester=SYSTEM_REQUESTER, prompt_tokens=None):
     """
     Requests a completion from the OpenAI gpt-3.5-turbo model and returns the completion as a string.
 
     Parameters:
     - prompt (list): A list of messages for sending api request to OpenAI gpt-3.5-turbo.
+    - cache_namespace (str): If given, the response cache is used with this namespace, usually the persona key.
+    - requester (tuple): (guild ID, user ID) the request is scheduled for.
+    - prompt_tokens (int): Token count of the prompt, counted here if not given.
 
     Returns:
     - completion (str): The completion generated by the model.
     """
-    completions = await sync_to_async(openai.ChatCompletion.create)(
-        model="gpt-3.5-turbo",
-        messages=prompt,
-    )
-    return completions['choices'][0]['message']['content']
+    if cache_namespace is not None:
+        cached = response_cache.get(cache_namespace, prompt)
+        if cached is not None:
+            return cached
+    if prompt_tokens is None:
+        prompt_tokens = num_tokens_from_messages(prompt)
+    await request_scheduler.acquire(requester, prompt_tokens)
+    completions = await resilient_completion.create(prompt, requester, prompt_tokens)
+    completion = completions['choices'][0]['message']['content']
+    if cache_namespace is not None:
+        response_cache.put(cache_namespace, prompt, completion)
+    return completion
+
+
+async def stream_conversation(prompt, cache_namespace=None, requester=SYSTEM_REQUESTER, prompt_tokens=None):
+    """
+    Requests a streamed completion from the OpenAI gpt-3.5-turbo model.
+
+    Parameters:
+    - prompt (list): A list of messages for sending api request to OpenAI gpt-3.5-turbo.
+    - cache_namespace (str): If given, the response cache is used with this namespace, usually the persona key.
+    - requester (tuple): (guild ID, user ID) the request is scheduled for.
+    - prompt_tokens (int): Token count of the prompt, counted here if not given.
+
+    Returns:
+    - chunks (async iterator): The pieces of the completion as they arrive.
+    """
+    if cache_namespace is not None:
+        cached = response_cache.get(cache_namespace, prompt)
+        if cached is not None:
+            yield cached
+            return
+    if prompt_tokens is None:
+        prompt_tokens = num_tokens_from_messages(prompt)
+    await request_scheduler.acquire(requester, prompt_tokens)
+    collected = []
+    stream = resilient_completion.stream(prompt, requester, prompt_tokens)
+    try:
+        async for chunk in stream:
+            collected.append(chunk)
+            yield chunk
+    finally:
+        # Close the request right away when the reply is cancelled, so the model stops generating.
+        await stream.aclose()
+    if cache_namespace is not None:
+        response_cache.put(cache_namespace, prompt, "".join(collected))
+
+
+async def stream_text(text):
+    """Yields a fixed text as a single chunk. Used for the canned replies in debug mode."""
+    yield text
+
+
+class EditBudget:
+    """
+    A sliding-window count of the message sends and edits made in one channel, mirroring Discord's per-channel bucket.
+
+    Attributes:
+    - capacity (int): Number of edits allowed per window.
+    - window (float): Length of the window in seconds.
+    """
+
+    def __init__(self, capacity=EDIT_BUDGET, window=EDIT_WINDOW) -> None:
+        self.capacity = capacity
+        self.window = window
+        self.history = deque()
+
+    def headroom(self):
+        """Returns how many edits can still be made in the current window."""
+        now = time.monotonic()
+        while self.history and now - self.history[0] > self.window:
+            self.history.popleft()
+        return self.capacity - len(self.history)
+
+    def spend(self):
+        self.history.append(time.monotonic())
+
+
+# Edit budgets by channel ID. Chats release theirs with `release_edit_budget` when they end.
+edit_budgets = {}
+
+
+def release_edit_budget(channel_id):
+    """Forget the edit budget of a channel whose chat ended."""
+    edit_budgets.pop(channel_id, None)
+
+
+class StreamingReply:
+    """
+    Streams a completion into Discord messages.
+
+    The first chunk is sent right away. After that, edits are coalesced: the more of the channel's edit budget
+    has been used, the longer the engine waits and the more new text it collects before editing again.
+    Text past Discord's 2000-character limit continues in follow-up messages.
+
+    Attributes:
+    - channel (discord.abc.Messageable): The channel to reply in.
+    - reference (discord.Message): The message the first reply answers, if any.
+    - min_interval (float): Seconds between edits when the budget is untouched.
+    - max_interval (float): Seconds after which pending text is always shown, if the budget allows it.
+    - min_chars (int): New characters needed before an edit is made before `max_interval`.
+    """
+
+    def __init__(self, channel, reference=None, min_interval=1.0, max_interval=3.0, min_chars=20) -> None:
+        self.channel = channel
+        self.reference = reference
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_chars = min_chars
+        self.budget = edit_budgets.setdefault(channel.id, EditBudget())
+        self.text = ""
+        # Start of the text shown in the current message, and how much of it is shown.
+        self.offset = 0
+        self.shown = 0
+        self.message = None
+        self.sent = []
+        self.last_edit = 0.0
+
+    async def run(self, chunks):
+        """
+        Consume the chunks and return the full reply text.
+
+        If the reply fails or is cancelled, the stream is closed and the partial messages are deleted.
+        """
+        try:
+            async for chunk in chunks:
+                self.text += chunk
+                if self._should_flush():
+                    await self._flush()
+            while self.shown < len(self.text):
+                await self._flush()
+        except BaseException:
+            for message in self.sent:
+                try:
+                    await message.delete()
+                except Exception as e:
+                    logger.error(f"Failed to delete partial reply: {e}")
+            raise
+        finally:
+            await chunks.aclose()
+        return self.text
+
+    def _should_flush(self):
+        pending = len(self.text) - self.shown
+        if pending <= 0:
+            return False
+        if self.message is None or len(self.text) - self.offset > DISCORD_MESSAGE_LIMIT:
+            return True
+        headroom = self.budget.headroom()
+        if headroom <= 0:
+            return False
+        elapsed = time.monotonic() - self.last_edit
+        interval = min(self.min_interval * self.budget.capacity /
+                       headroom, self.max_interval)
+        return (pending >= self.min_chars and elapsed >= interval) or elapsed >= self.max_interval
+
+    async def _flush(self):
+        content = self.text[self.offset:]
+        if len(content) > DISCORD_MESSAGE_LIMIT:
+            # Finish the current message at the last line break that fits, and continue in a new one.
+            cut = content.rfind("\n", 0, DISCORD_MESSAGE_LIMIT)
+            if cut <= 0:
+                cut = DISCORD_MESSAGE_LIMIT
+            await self._show(content[:cut])
+            self.offset += cut
+            self.shown = self.offset
+            self.message = None
+            return
+        await self._show(content)
+        self.shown = len(self.text)
+
+    async def _show(self, content):
+        if not content.strip():
+            return
+        self.budget.spend()
+        self.last_edit = time.monotonic()
+        if self.message is not None:
+            await self.message.edit(content=content)
+        elif self.reference is not None and self.offset == 0:
+            self.message = await self.channel.send(content, reference=self.reference)
+            self.sent.append(self.message)
+        else:
+            self.message = await self.channel.send(content)
+            self.sent.append(self.message)
+
+
+async def reply_turn(conversation, message, chunks, reference=None):
+    """
+    Stream the reply to the newest user input of a conversation into the channel of `message`.
+
+    If the reply fails or is empty, the user input is removed from the conversation, so the next prompt does not
+    carry two user messages in a row, and `message` is answered with the reason.
+    If it is cancelled, e.g. by a newer message, the input is removed as well and the cancellation propagates.
+
+    Parameters:
+    - conversation (Conversation): The conversation whose newest message is the user input.
+    - message (discord.Message): The message of the user that the turn answers.
+    - chunks (async iterator): The pieces of the completion.
+    - reference (discord.Message): The message the reply answers, if any.
+
+    Returns:
+    - completion (str): The full reply, or None if the turn failed.
+    """
+    try:
+        async with message.channel.typing():
+            completion = await StreamingReply(message.channel, reference=reference).run(chunks)
+    except asyncio.CancelledError:
+        # A newer message arrived or the chat was closed. The turn will be answered together with the newer message.
+        conversation.pop_last()
+        raise
+    except SchedulerBusy as e:
+        conversation.pop_last()
+        await message.reply(f"目前使用人數過多，預計需要等待約 {math.ceil(e.wait)} 秒，請稍後再試。")
+    except openai.error.RateLimitError:
+        conversation.pop_last()
+        await message.reply("目前使用人數過多，請稍後再試。")
+    except CircuitOpen as e:
+        conversation.pop_last()
+        await message.reply(f"AI 服務暫時不穩定，請約 {math.ceil(e.retry_after)} 秒後再試。")
+    except DeadlineExceeded:
+        conversation.pop_last()
+        await message.reply("回應逾時，請稍後再試一次。")
+    except Exception as e:
+        conversation.pop_last()
+        logger.error(f"Failed to generate conversation: {e}")
+        await message.reply(f"生成對話時發生錯誤：{e}")
+    else:
+        if completion:
+            return completion
+        conversation.pop_last()
+        await message.reply("沒有生成任何回應。")
+    return None
@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("bot")
+
+# Where the processes of a cluster share state, e.g. "sqlite:assets/database/state.sqlite3" or "redis://127.0.0.1:6399".
+# Empty for a single process, which keeps everything in memory.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "")
+# Rate limits are counted in fixed windows of this many seconds.
+RATE_WINDOW = 60
+# Seconds between two health reports of a process.
+HEALTH_INTERVAL = 10
+
+
+class SQLiteBackend:
+    """
+    Cluster state in a SQLite file shared by every process on the host.
+
+    Attributes:
+    - path (str): Path to the SQLite file.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="cluster-state")
+        self._conn = None
+        self._executor.submit(self._connect).result()
+
+    def _connect(self):
+        self._conn = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS rate_windows (key TEXT PRIMARY KEY, window INTEGER NOT NULL, count INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS health (cluster_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+        """)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _reserve(self, amounts, limits):
+        window = int(time.time() // RATE_WINDOW)
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            counts = {}
+            for key in amounts:
+                row = self._conn.execute(
+                    "SELECT window, count FROM rate_windows WHERE key = ?", (key,)).fetchone()
+                counts[key] = row[1] if row is not None and row[0] == window else 0
+            if any(counts[key] + amounts[key] > limits[key] for key in amounts):
+                self._conn.execute("ROLLBACK")
+                return (window + 1) * RATE_WINDOW - time.time()
+            for key in amounts:
+                self._conn.execute("INSERT OR REPLACE INTO rate_windows (key, window, count) VALUES (?, ?, ?)",
+                                   (key, window, counts[key] + amounts[key]))
+            self._conn.execute("COMMIT")
+            return 0.0
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    async def reserve(self, amounts, limits):
+        """
+        Take `amounts` from the shared rate limits of the current window, all or nothing.
+
+        Parameters:
+        - amounts (dict): Amount to take by limit name, e.g. {"requests": 1, "tokens": 900}.
+        - limits (dict): Limit per window by limit name.
+
+        Returns:
+        - wait (float): 0 if the amounts were taken, otherwise the seconds until the next window.
+        """
+        return await self._run(self._reserve, amounts, limits)
+
+    def _report_health(self, cluster_id, data):
+        self._conn.execute("INSERT OR REPLACE INTO health (cluster_id, data) VALUES (?, ?)",
+                           (cluster_id, json.dumps(data)))
+
+    async def report_health(self, cluster_id, data):
+        await self._run(self._report_health, cluster_id, data)
+
+    def _health(self):
+        return {row[0]: json.loads(row[1]) for row in self._conn.execute("SELECT cluster_id, data FROM health")}
+
+    async def health(self):
+        """Returns the last health report of every process by cluster ID."""
+        return await self._run(self._health)
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
+
+
+def _encode(*args):
+    """Encode a command in the Redis protocol."""
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = str(arg).encode("utf-8")
+        parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+    return b"".join(parts)
+
+
+async def _read_reply(reader):
+    line = (await reader.readline()).rstrip(b"\r\n")
+    kind, rest = line[:1], line[1:].decode("utf-8")
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        raise RuntimeError(rest)
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        if rest == "-1":
+            return None
+        data = await reader.readexactly(int(rest) + 2)
+        return data[:-2].decode("utf-8")
+    if kind == b"*":
+        return [await _read_reply(reader) for _ in range(int(rest))]
+    raise RuntimeError(f"Unexpected reply: {line!r}")
+
+
+class RedisBackend:
+    """
+    Cluster state in a Redis server, or in the `MiniRedis` stand-in started by the cluster launcher.
+
+    Only plain commands are used (INCRBY, DECRBY, EXPIRE, HSET, HGETALL), so any Redis-compatible server works.
+
+    Attributes:
+    - host (str): Server host.
+    - port (int): Server port.
+    """
+
+    def __init__(self, host, port) -> None:
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def execute(self, *args):
+        async with self._lock:
+            if self._writer is None:
+                self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                self._writer.write(_encode(*args))
+                await self._writer.drain()
+                return await _read_reply(self._reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self._writer = None
+                raise
+
+    async def reserve(self, amounts, limits):
+        """Same as `SQLiteBackend.reserve`. Amounts over the limit are given back right away."""
+        window = int(time.time() // RATE_WINDOW)
+        taken = []
+        over = False
+        for key, amount in amounts.items():
+            name = f"ratelimit:{key}:{window}"
+            count = await self.execute("INCRBY", name, amount)
+            taken.append((name, amount))
+            if count == amount:
+                await self.execute("EXPIRE", name, RATE_WINDOW * 2)
+            if count > limits[key]:
+                over = True
+                break
+        if not over:
+            return 0.0
+        for name, amount in taken:
+            await self.execute("DECRBY", name, amount)
+        return (window + 1) * RATE_WINDOW - time.time()
+
+    async def report_health(self, cluster_id, data):
+        await self.execute("HSET", "health", cluster_id, json.dumps(data))
+
+    async def health(self):
+        values = await self.execute("HGETALL", "health")
+        return {int(values[i]): json.loads(values[i + 1]) for i in range(0, len(values), 2)}
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class MiniRedis:
+    """
+    A tiny in-memory server that speaks the subset of the Redis protocol `RedisBackend` needs,
+    for running a cluster on one host without installing Redis.
+    """
+
+    def __init__(self) -> None:
+        self.data = {}
+        self.expires = {}
+        self._server = None
+
+    def _get(self, key):
+        if key in self.expires and self.expires[key] <= time.time():
+            self.data.pop(key, None)
+            del self.expires[key]
+        return self.data.get(key)
+
+    def _incr(self, key, amount):
+        value = int(self._get(key) or 0) + amount
+        self.data[key] = str(value)
+        return value
+
+    def handle(self, command, args):
+        command = command.upper()
+        if command == "PING":
+            return "+PONG"
+        if command == "INCRBY":
+            return self._incr(args[0], int(args[1]))
+        if command == "DECRBY":
+            return self._incr(args[0], -int(args[1]))
+        if command == "EXPIRE":
+            if self._get(args[0]) is None:
+                return 0
+            self.expires[args[0]] = time.time() + int(args[1])
+            return 1
+        if command == "GET":
+            value = self._get(args[0])
+            return value if value is None else str(value)
+        if command == "SET":
+            self.data[args[0]] = args[1]
+            self.expires.pop(args[0], None)
+            return "+OK"
+        if command == "DEL":
+            return sum(self.data.pop(key, None) is not None for key in args)
+        if command == "HSET":
+            fields = self.data.setdefault(args[0], {})
+            added = 0
+            for i in range(1, len(args), 2):
+                added += args[i] not in fields
+                fields[args[i]] = args[i + 1]
+            return added
+        if command == "HGETALL":
+            fields = self.data.get(args[0], {})
+            return [item for pair in fields.items() for item in pair]
+        raise ValueError(f"unknown command '{command}'")
+
+    @staticmethod
+    def _encode_reply(reply):
+        if isinstance(reply, str) and reply.startswith("+"):
+            return f"{reply}\r\n".encode()
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, int):
+            return f":{reply}\r\n".encode()
+        if isinstance(reply, list):
+            return f"*{len(reply)}\r\n".encode() + b"".join(MiniRedis._encode_reply(item) for item in reply)
+        data = reply.encode("utf-8")
+        return f"${len(data)}\r\n".encode() + data + b"\r\n"
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_reply(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if not request:
+                    break
+                try:
+                    reply = self._encode_reply(
+                        self.handle(request[0], request[1:]))
+                except Exception as e:
+                    reply = f"-ERR {e}\r\n".encode()
+                writer.write(reply)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=6399):
+        self._server = await asyncio.start_server(self._serve, host, port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+def format_health(health, now=None):
+    """
+    One line per process and per shard of a cluster's health reports.
+
+    Parameters:
+    - health (dict): Health reports by cluster ID, as returned by the backends.
+
+    Returns:
+    - lines (list): The lines to log or send.
+    - unhealthy (bool): Whether a process is stale or not ready, or a shard is disconnected.
+    """
+    now = now or time.time()
+    lines = []
+    unhealthy = False
+    for cluster_id, report in sorted(health.items()):
+        age = now - report["updated"]
+        stale = age > HEALTH_INTERVAL * 3
+        unhealthy |= stale or not report["ready"]
+        lines.append(f"cluster {cluster_id} pid={report['pid']} ready={report['ready']} sessions={report['sessions']} "
+                     f"queued={report['queued_requests']} updated {age:.0f}s ago{' STALE' if stale else ''}")
+        for shard_id, shard in sorted(report["shards"].items(), key=lambda item: int(item[0])):
+            latency = "-" if shard["latency"] is None else f"{shard['latency']}ms"
+            unhealthy |= shard["closed"] or shard["latency"] is None
+            lines.append(f"  shard {shard_id}/{report['shard_count']} latency={latency} guilds={shard['guilds']}"
+                         f"{' CLOSED' if shard['closed'] else ''}")
+    return lines, unhealthy
+
+
+def open_backend(url=STATE_BACKEND):
+    """Returns the state backend for a STATE_BACKEND url, or None for a single process."""
+    if not url:
+        return None
+    if url.startswith("sqlite:"):
+        return SQLiteBackend(url[len("sqlite:"):])
+    if url.startswith("redis://"):
+        host, _, port = url[len("redis://"):].rstrip("/").partition(":")
+        return RedisBackend(host or "127.0.0.1", int(port or 6379))
+    raise ValueError(f"Unknown state backend: {url}")
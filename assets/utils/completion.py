@@ -0,0 +1,118 @@
+import os
+import time
+import asyncio
+import aiohttp
+import openai
+from assets.utils.metrics import metrics
+
+# Configurable through environment variables, like the API key.
+MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 16))
+REQUEST_TIMEOUT = float(os.getenv("OPENAI_REQUEST_TIMEOUT", 60))
+POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", 32))
+KEEPALIVE_TIMEOUT = 30
+
+
+class CompletionClient:
+    """
+    An async client for OpenAI chat completions shared by every cog.
+
+    Requests go through `openai.ChatCompletion.acreate` on a single pooled keep-alive aiohttp session,
+    so completions for different users run concurrently instead of queueing on one worker thread.
+
+    Attributes:
+    - model (str): The chat model to request.
+    - max_concurrency (int): Maximum number of requests in flight at the same time.
+    - timeout (float): Seconds allowed for a request, or between two chunks of a stream.
+    - pool_size (int): Maximum number of pooled HTTP connections.
+    """
+
+    def __init__(self, model="gpt-3.5-turbo", max_concurrency=MAX_CONCURRENCY, timeout=REQUEST_TIMEOUT, pool_size=POOL_SIZE) -> None:
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight = 0
+        self._session = None
+
+    @property
+    def in_flight(self):
+        """Number of requests holding a concurrency slot."""
+        return self._in_flight
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector)
+        # openai reads the session from a context variable, so set it in the calling task.
+        openai.aiosession.set(self._session)
+        return self._session
+
+    async def create(self, messages, **kwargs):
+        """Request a completion and return the full response."""
+        async with self._semaphore:
+            self._in_flight += 1
+            try:
+                self._get_session()
+                with metrics.timer("completion_seconds", mode="create"):
+                    return await asyncio.wait_for(
+                        openai.ChatCompletion.acreate(
+                            model=self.model,
+                            messages=messages,
+                            request_timeout=self.timeout,
+                            **kwargs
+                        ),
+                        timeout=self.timeout
+                    )
+            finally:
+                self._in_flight -= 1
+
+    async def stream(self, messages, **kwargs):
+        """Request a streamed completion and yield the content of each chunk as it arrives."""
+        async with self._semaphore:
+            self._in_flight += 1
+            self._get_session()
+            start = time.perf_counter()
+            first = True
+            chunks = None
+            try:
+                response = await asyncio.wait_for(
+                    openai.ChatCompletion.acreate(
+                        model=self.model,
+                        messages=messages,
+                        stream=True,
+                        request_timeout=self.timeout,
+                        **kwargs
+                    ),
+                    timeout=self.timeout
+                )
+                chunks = response.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=self.timeout)
+                    except StopAsyncIteration:
+                        break
+                    content = chunk['choices'][0]['delta'].get('content', '')
+                    if content:
+                        if first:
+                            metrics.observe("completion_first_token_seconds",
+                                            time.perf_counter() - start)
+                            first = False
+                        yield content
+            finally:
+                self._in_flight -= 1
+                if chunks is not None:
+                    # Release the connection when the stream is closed early.
+                    await chunks.aclose()
+                    metrics.observe("completion_seconds",
+                                    time.perf_counter() - start, mode="stream")
+
+    async def close(self):
+        """Close the pooled HTTP session."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+completion_client = CompletionClient()
+metrics.gauge("completion_in_flight", lambda: completion_client.in_flight)
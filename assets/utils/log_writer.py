@@ -0,0 +1,95 @@
+import json
+import asyncio
+from collections import defaultdict
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("bot")
+
+
+class ConversationLogWriter:
+    """
+    An append-only JSONL sink for conversation logs.
+
+    `write` only buffers the record. A background task flushes the buffer in batches, either every
+    `flush_interval` seconds or as soon as `batch_size` records are pending, and does the file I/O in a
+    worker thread so disk latency never stalls the event loop. Call `close` on shutdown to flush the rest.
+
+    Attributes:
+    - flush_interval (float): Maximum number of seconds a record stays in the buffer.
+    - batch_size (int): Number of pending records that triggers an early flush.
+    """
+
+    def __init__(self, flush_interval=1.0, batch_size=64) -> None:
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._buffer = []
+        self._wakeup = asyncio.Event()
+        # Held while a batch is appended or a file is rewritten, so the two never interleave.
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._closing = False
+
+    def write(self, path, record):
+        """Queue one record to be appended to `path` as a JSON line."""
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts, benchmarks), write straight through.
+            self._flush([(path, line)])
+            return
+        self._buffer.append((path, line))
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._task = loop.create_task(self._run())
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._flush_pending()
+
+    async def _flush_pending(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        async with self._lock:
+            try:
+                await asyncio.to_thread(self._flush, batch)
+            except Exception as e:
+                logger.error(f"Failed to write conversation logs: {e}")
+
+    async def rewrite(self, func, path):
+        """
+        Run `func(path)` in a worker thread while no batch is being appended, e.g. to compact a file in place.
+        Pending records are flushed first, and records written meanwhile are appended to the rewritten file afterwards.
+        """
+        await self._flush_pending()
+        async with self._lock:
+            return await asyncio.to_thread(func, path)
+
+    @staticmethod
+    def _flush(batch):
+        lines = defaultdict(list)
+        for path, line in batch:
+            lines[path].append(line)
+        for path, path_lines in lines.items():
+            with open(path, "a", encoding="utf-8") as f:
+                f.writelines(path_lines)
+
+    async def close(self):
+        """Stop the background task and flush everything still buffered."""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self._flush_pending()
+
+
+log_writer = ConversationLogWriter()
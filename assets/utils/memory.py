@@ -0,0 +1,92 @@
+import os
+from collections import OrderedDict
+from assets.utils.metrics import metrics
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("bot")
+
+# Bytes of conversation history kept in memory across every session.
+SESSION_MEMORY_BUDGET = int(
+    os.getenv("SESSION_MEMORY_BUDGET", 64 * 1024 * 1024))
+# Histories evicted from memory are written here until their session is active again.
+# Each process of a cluster has its own directory, so it can clear it at startup.
+SPILL_DIR = f"assets/logs/spill{setting.LOG_SUFFIX}"
+
+
+class MemoryBudget:
+    """
+    A global budget for the history kept in memory by every conversation.
+
+    Conversations report their size as it grows. When the total goes over `budget`, the least recently active
+    conversations spill their history to disk until the total is back under 90% of the budget.
+    A spilled conversation loads its history again the next time it is used.
+
+    Attributes:
+    - budget (int): Maximum number of bytes.
+    - total (int): Bytes currently held by the tracked conversations.
+    - conversations (OrderedDict): Tracked conversations, least recently active first.
+    - spilled (int): Number of conversations spilled so far.
+    """
+
+    def __init__(self, budget=SESSION_MEMORY_BUDGET) -> None:
+        self.budget = budget
+        self.total = 0
+        self.conversations = OrderedDict()
+        self.spilled = 0
+
+    def resize(self, conversation, delta):
+        """Record that `conversation` was used and grew by `delta` bytes. Closed conversations are not tracked again."""
+        if conversation.closed:
+            return
+        self.total += delta
+        self.conversations[conversation] = None
+        self.conversations.move_to_end(conversation)
+        if self.total > self.budget:
+            self._evict(conversation)
+
+    def discard(self, conversation, size):
+        """Stop tracking a conversation that ended. `size` is what it still holds in memory."""
+        if conversation in self.conversations:
+            del self.conversations[conversation]
+            self.total -= size
+
+    def _evict(self, keep):
+        target = self.budget * 0.9
+        for conversation in list(self.conversations):
+            if self.total <= target:
+                break
+            if conversation is keep:
+                continue
+            try:
+                freed = conversation.spill()
+            except Exception as e:
+                logger.error(f"Failed to spill conversation: {e}")
+                continue
+            del self.conversations[conversation]
+            self.total -= freed
+            self.spilled += 1
+            metrics.inc("sessions_spilled_total")
+
+
+def remove_spill_files(directory=SPILL_DIR):
+    """
+    Remove the spill files left by a previous run. Restarted sessions are rebuilt from the session journal.
+
+    Returns:
+    - count (int): The number of removed files.
+    """
+    if not os.path.isdir(directory):
+        return 0
+    count = 0
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".spill"):
+            try:
+                os.remove(entry.path)
+                count += 1
+            except FileNotFoundError:
+                pass
+    return count
+
+
+memory_budget = MemoryBudget()
+metrics.gauge("session_memory_bytes", lambda: memory_budget.total)
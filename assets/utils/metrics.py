@@ -0,0 +1,189 @@
+import os
+import time
+import bisect
+from collections import defaultdict
+from aiohttp import web
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("bot")
+
+# Port of the local Prometheus endpoint, 0 to disable it.
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+METRICS_HOST = "127.0.0.1"
+
+# Latency buckets in seconds.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 20, 30, 60)
+
+
+class Histogram:
+    """A Prometheus-style histogram with fixed buckets."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Metrics:
+    """
+    In-process counters, gauges and latency histograms, rendered in the Prometheus text format.
+
+    Attributes:
+    - histograms (dict): Histograms by name and labels.
+    - counters (dict): Counters by name and labels.
+    - gauges (dict): Functions returning the current value of a gauge, by name.
+    """
+
+    def __init__(self) -> None:
+        self.histograms = defaultdict(dict)
+        self.counters = defaultdict(lambda: defaultdict(float))
+        self.gauges = {}
+        self._runner = None
+
+    def observe(self, name, value, **labels):
+        key = _labels(labels)
+        histogram = self.histograms[name].get(key)
+        if histogram is None:
+            histogram = self.histograms[name][key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        self.counters[name][_labels(labels)] += amount
+
+    def gauge(self, name, func):
+        """Register a gauge whose value is read from `func` at scrape time."""
+        self.gauges[name] = func
+
+    def timer(self, name, **labels):
+        """Context manager that observes the time spent in its block."""
+        return _Timer(self, name, labels)
+
+    def render(self):
+        lines = []
+        for name, series in self.histograms.items():
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(
+                    f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+                lines.append(
+                    f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(
+                    f"{name}_count{_format_labels(labels)} {histogram.count}")
+        for name, series in self.counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name, func in self.gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            value = func()
+            if isinstance(value, dict):
+                for label, item in value.items():
+                    lines.append(f"{name}{_format_labels(label)} {item}")
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """A short human readable summary for the admin command."""
+        lines = []
+        for name, series in self.histograms.items():
+            for labels, histogram in series.items():
+                lines.append(
+                    f"{name}{_format_labels(labels)}: n={histogram.count} p50≤{histogram.quantile(0.5)}s p99≤{histogram.quantile(0.99)}s")
+        for name, series in self.counters.items():
+            for labels, value in series.items():
+                lines.append(f"{name}{_format_labels(labels)}: {value:g}")
+        for name, func in self.gauges.items():
+            value = func()
+            if isinstance(value, dict):
+                for label, item in value.items():
+                    lines.append(f"{name}{_format_labels(label)}: {item}")
+            else:
+                lines.append(f"{name}: {value}")
+        return "\n".join(lines)
+
+    def instrument_http(self, http):
+        """Time every Discord REST call made through a discord.py HTTPClient."""
+        request = http.request
+
+        async def timed_request(route, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await request(route, **kwargs)
+            finally:
+                self.observe("discord_rest_seconds",
+                             time.perf_counter() - start, method=route.method)
+        http.request = timed_request
+
+    async def start_server(self, host=METRICS_HOST, port=METRICS_PORT):
+        """Serve /metrics on a local port."""
+        if not port:
+            return
+
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    async def stop_server(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class _Timer:
+    def __init__(self, metrics, name, labels) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() -
+                             self.start, **self.labels)
+
+
+metrics = Metrics()
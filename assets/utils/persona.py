@@ -0,0 +1,190 @@
+import os
+import json
+import asyncio
+from typing import NamedTuple, Tuple
+from assets.utils.tokens import num_tokens_from_message
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("bot")
+
+CONVERSATIONS_ROOT = "assets/conversations"
+CHARACTER_INFO_PATH = "assets/settings/character_info.json"
+WATCH_INTERVAL = 5.0
+
+
+class Persona(NamedTuple):
+    """
+    An immutable, pre-tokenized character. One instance is shared by every session with this character.
+
+    Attributes:
+    - key (str): The folder name of the character, e.g. "Kita".
+    - name (str): The display name.
+    - description (str): The description shown in the select menu.
+    - greeting (str): The first message sent in a new thread.
+    - system_message (str): The content of intro.txt.
+    - system_tokens (int): Token count of the system message.
+    - examples (tuple): Few-shot messages from conversation.txt as (role, content) pairs.
+    - example_tokens (tuple): Token count of each few-shot message.
+    - cacheable (bool): Whether replies of this character may be served from the response cache.
+    - prefix (tuple): The system message and the examples as message dicts, shared by every conversation. Never mutate them.
+    - prefix_tokens (int): Token count of `prefix`.
+    """
+    key: str
+    name: str
+    description: str
+    greeting: str
+    system_message: str
+    system_tokens: int
+    examples: Tuple[Tuple[str, str], ...]
+    example_tokens: Tuple[int, ...]
+    cacheable: bool = True
+    prefix: Tuple[dict, ...] = ()
+    prefix_tokens: int = 0
+
+
+def load_persona(key, info, path):
+    """Read and tokenize one character from its folder."""
+    with open(os.path.join(path, "intro.txt"), encoding="utf-8") as f:
+        system_message = f.read()
+    examples = []
+    with open(os.path.join(path, "conversation.txt"), encoding="utf-8") as f:
+        for chat in f.read().splitlines():
+            if not chat.strip():
+                continue
+            u, a = chat.split(",", 1)
+            examples.append(("user", u.strip("\n")))
+            examples.append(("assistant", a.strip("\n")))
+    prefix = ({"role": "system", "content": system_message},) + tuple(
+        {"role": role, "content": content} for role, content in examples)
+    tokens = tuple(num_tokens_from_message(message) for message in prefix)
+    return Persona(
+        key=key,
+        name=info.get("name", key),
+        description=info.get("description", ""),
+        greeting=info.get("greeting", "你好"),
+        system_message=system_message,
+        system_tokens=tokens[0],
+        examples=tuple(examples),
+        example_tokens=tokens[1:],
+        cacheable=info.get("cache", True),
+        prefix=prefix,
+        prefix_tokens=sum(tokens),
+    )
+
+
+class PersonaRegistry:
+    """
+    Every character under assets/conversations/, loaded once and shared.
+
+    `watch` polls the source files and reloads only the characters whose files changed,
+    so characters can be edited without restarting the bot.
+
+    Attributes:
+    - root (str): The folder that contains one folder per character.
+    - info_path (str): Path to character_info.json.
+    - personas (dict): Loaded personas by key.
+    """
+
+    def __init__(self, root=CONVERSATIONS_ROOT, info_path=CHARACTER_INFO_PATH) -> None:
+        self.root = root
+        self.info_path = info_path
+        self.personas = {}
+        self._mtimes = {}
+        self._task = None
+
+    def _sources(self):
+        """Returns the character info and the folder of every character."""
+        with open(self.info_path, "r", encoding="utf-8") as f:
+            info = json.load(f)
+        paths = {key: value.get("path", os.path.join(self.root, key))
+                 for key, value in info.items()}
+        for key in sorted(os.listdir(self.root)):
+            if key not in paths and os.path.isdir(os.path.join(self.root, key)):
+                paths[key] = os.path.join(self.root, key)
+        return info, paths
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return max(os.stat(os.path.join(path, name)).st_mtime for name in ("intro.txt", "conversation.txt"))
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        """Load the characters that are new or changed since the last load. Returns the keys that were reloaded."""
+        info, paths = self._sources()
+        info_mtime = os.stat(self.info_path).st_mtime
+        info_changed = self._mtimes.get(self.info_path) != info_mtime
+        self._mtimes[self.info_path] = info_mtime
+
+        reloaded = []
+        personas = dict(self.personas)
+        for key in list(personas):
+            if key not in paths:
+                del personas[key]
+        for key, path in paths.items():
+            mtime = self._mtime(path)
+            if mtime is None:
+                continue
+            changed = self._mtimes.get(key) != mtime
+            info_entry = info.get(key, {})
+            if key in personas and not changed and not info_changed:
+                continue
+            if key in personas and not changed:
+                # Only the metadata changed, keep the tokenized text.
+                persona = personas[key]
+                personas[key] = persona._replace(
+                    name=info_entry.get("name", key),
+                    description=info_entry.get("description", ""),
+                    greeting=info_entry.get("greeting", "你好"),
+                    cacheable=info_entry.get("cache", True))
+                continue
+            try:
+                personas[key] = load_persona(key, info_entry, path)
+            except Exception as e:
+                logger.error(f"Failed to load persona {key}: {e}")
+                continue
+            self._mtimes[key] = mtime
+            reloaded.append(key)
+        # Swap the whole dict so readers never see a half-updated registry.
+        self.personas = personas
+        if reloaded:
+            logger.info(f"Loaded personas: {', '.join(reloaded)}")
+        return reloaded
+
+    async def watch(self, interval=WATCH_INTERVAL):
+        """Poll the character files and reload the changed ones."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.load)
+            except Exception as e:
+                logger.error(f"Failed to reload personas: {e}")
+
+    def start_watching(self, interval=WATCH_INTERVAL):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.watch(interval))
+
+    def stop_watching(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _ensure_loaded(self):
+        if not self.personas:
+            self.load()
+
+    def __getitem__(self, key) -> Persona:
+        self._ensure_loaded()
+        return self.personas[key]
+
+    def __contains__(self, key):
+        self._ensure_loaded()
+        return key in self.personas
+
+    def values(self):
+        self._ensure_loaded()
+        return list(self.personas.values())
+
+
+persona_registry = PersonaRegistry()
@@ -0,0 +1,282 @@
+import os
+import time
+import random
+import asyncio
+import aiohttp
+import openai
+from collections import deque
+from assets.utils.completion import completion_client
+from assets.utils.scheduler import request_scheduler, SYSTEM_REQUESTER
+from assets.utils.metrics import metrics
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("bot")
+
+# Seconds a reply may take to start, retries included.
+REPLY_DEADLINE = float(os.getenv("REPLY_DEADLINE", 45))
+# Retries of a failed request, with a jittered exponential backoff between them.
+MAX_RETRIES = int(os.getenv("COMPLETION_RETRIES", 2))
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+# A duplicate request is sent when the first chunk takes longer than this percentile of the recent latencies.
+# Stalls more frequent than 1 - HEDGE_PERCENTILE pull the percentile up to the stalls themselves, lower it then.
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 0.95))
+HEDGE_MIN_DELAY = 1.0
+# Recent latencies needed before requests are hedged.
+HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = 200
+# Consecutive failures that open the circuit, and seconds it stays open.
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", 5))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 30))
+
+# Failures that mean the provider is slow or down. Anything else, e.g. an invalid request, is not retried.
+RETRYABLE_ERRORS = (openai.error.Timeout, openai.error.TryAgain, openai.error.APIConnectionError,
+                    openai.error.ServiceUnavailableError, openai.error.APIError,
+                    asyncio.TimeoutError, aiohttp.ClientError)
+
+
+class CircuitOpen(Exception):
+    """Raised without sending a request while the provider is considered down. `retry_after` is in seconds."""
+
+    def __init__(self, retry_after) -> None:
+        super().__init__(
+            f"The model provider is unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a reply did not start before its deadline."""
+
+
+class CircuitBreaker:
+    """
+    Fails fast while the provider is down.
+
+    After `threshold` failures in a row the circuit opens and every request fails with `CircuitOpen` for
+    `cooldown` seconds. Then one probe request is let through per `cooldown`: if it succeeds the circuit closes,
+    if it fails the circuit stays open.
+
+    Attributes:
+    - threshold (int): Consecutive failures that open the circuit.
+    - cooldown (float): Seconds the circuit stays open before a probe.
+    - failures (int): Consecutive failures so far.
+    - opened_at (float): `time.monotonic` when the circuit opened or the last probe started, None while closed.
+    """
+
+    def __init__(self, threshold=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def check(self):
+        """Raise `CircuitOpen` unless a request may be sent now."""
+        if self.opened_at is None:
+            return
+        remaining = self.opened_at + self.cooldown - time.monotonic()
+        if remaining > 0:
+            metrics.inc("circuit_rejected_total")
+            raise CircuitOpen(remaining)
+        # Let this request through as the probe, the others wait for its result or another cooldown.
+        self.opened_at = time.monotonic()
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info("Model provider recovered, closing the circuit.")
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(
+                    f"{self.failures} failed requests in a row, opening the circuit for {self.cooldown:g}s.")
+                metrics.inc("circuit_opened_total")
+            self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """The latencies of the most recent successful requests."""
+
+    def __init__(self, size=LATENCY_SAMPLES) -> None:
+        self.samples = deque(maxlen=size)
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, q):
+        """The `q` percentile of the recent latencies, or None without enough samples."""
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def backoff(attempt):
+    """Full-jitter exponential backoff: a random delay up to RETRY_BASE_DELAY * 2 ** attempt."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+async def _discard(task, stream=None):
+    """Cancel a request that lost the race and release its connection."""
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+    if stream is not None:
+        await stream.aclose()
+
+
+class ResilientCompletion:
+    """
+    Completion requests with a deadline, retries, hedging and a circuit breaker.
+
+    - Every reply must start before `deadline` seconds, or `DeadlineExceeded` is raised instead of waiting forever.
+    - A request that fails with a provider error is retried up to `max_retries` times after a jittered backoff,
+      taking budget from the scheduler again. Streams are only retried before their first chunk.
+    - When the first chunk is slower than the `hedge_percentile` of the recent latencies, a duplicate request is
+      sent if a connection slot is free and the scheduler has budget to spare right away, and whichever answers
+      first is used.
+    - While the circuit breaker is open, requests fail right away with `CircuitOpen`.
+
+    Attributes:
+    - deadline (float): Seconds a reply may take to start.
+    - max_retries (int): Retries of a failed request.
+    - hedge_percentile (float): Latency percentile after which a request is hedged, None to never hedge.
+    - breaker (CircuitBreaker): The circuit breaker.
+    - latency (LatencyTracker): Recent first-chunk latencies.
+    """
+
+    def __init__(self, deadline=REPLY_DEADLINE, max_retries=MAX_RETRIES, hedge_percentile=HEDGE_PERCENTILE) -> None:
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.hedge_percentile = hedge_percentile
+        self.breaker = CircuitBreaker()
+        self.latency = LatencyTracker()
+
+    def hedge_delay(self):
+        if self.hedge_percentile is None:
+            return None
+        percentile = self.latency.percentile(self.hedge_percentile)
+        return None if percentile is None else max(HEDGE_MIN_DELAY, percentile)
+
+    async def _race(self, start, tokens, deadline):
+        """
+        Start a request and wait for its first result, hedging it if it is slow.
+
+        Parameters:
+        - start (function): Starts one request, returns (task, stream). `stream` is closed if the request loses.
+        - tokens (int): Prompt tokens, taken from the scheduler for a hedge.
+        - deadline (float): `time.monotonic` by which the first result must arrive.
+
+        Returns:
+        - result: The result of the winning task.
+        - stream: The stream of the winning request.
+        """
+        started = time.monotonic()
+        primary, stream = start()
+        requests = {primary: stream}
+        hedged = False
+        hedge_delay = self.hedge_delay()
+        hedge_at = None if hedge_delay is None else started + hedge_delay
+        error = None
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise DeadlineExceeded(
+                        f"No reply within {self.deadline:g}s")
+                wait_until = deadline if hedge_at is None else min(
+                    deadline, hedge_at)
+                done, _ = await asyncio.wait(requests, timeout=wait_until - now, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if hedge_at is not None and time.monotonic() >= hedge_at:
+                        hedge_at = None
+                        # A hedge that would queue for a connection slot only adds load.
+                        if completion_client.in_flight < completion_client.max_concurrency and await request_scheduler.try_acquire(tokens):
+                            hedged = True
+                            metrics.inc("completion_hedged_total")
+                            task, stream = start()
+                            requests[task] = stream
+                    continue
+                for task in done:
+                    stream = requests.pop(task)
+                    if task.exception() is None or isinstance(task.exception(), StopAsyncIteration):
+                        self.latency.observe(time.monotonic() - started)
+                        if hedged and task is not primary:
+                            metrics.inc("completion_hedge_won_total")
+                        result = None if task.exception() is not None else task.result()
+                        return result, stream
+                    error = task.exception()
+                    if stream is not None:
+                        await stream.aclose()
+                if not requests:
+                    raise error
+        finally:
+            for task, stream in requests.items():
+                await _discard(task, stream)
+
+    async def _with_retries(self, start, requester, tokens):
+        self.breaker.check()
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            try:
+                result = await self._race(start, tokens, deadline)
+            except RETRYABLE_ERRORS as e:
+                self.breaker.failure()
+                delay = backoff(attempt)
+                if attempt >= self.max_retries or self.breaker.is_open or time.monotonic() + delay >= deadline:
+                    raise
+                attempt += 1
+                metrics.inc("completion_retries_total")
+                logger.warning(
+                    f"Completion failed, retry {attempt}/{self.max_retries} in {delay:.1f}s: {e!r}")
+                await asyncio.sleep(delay)
+                await request_scheduler.acquire(requester, tokens)
+                continue
+            except DeadlineExceeded:
+                self.breaker.failure()
+                metrics.inc("completion_deadline_exceeded_total")
+                raise
+            self.breaker.success()
+            return result
+
+    async def create(self, messages, requester=SYSTEM_REQUESTER, prompt_tokens=0):
+        """Same as `completion_client.create`. The first attempt must already have budget from the scheduler."""
+        def start():
+            return asyncio.ensure_future(completion_client.create(messages)), None
+
+        response, _ = await self._with_retries(start, requester, prompt_tokens)
+        return response
+
+    async def stream(self, messages, requester=SYSTEM_REQUESTER, prompt_tokens=0):
+        """Same as `completion_client.stream`. The first attempt must already have budget from the scheduler."""
+        def start():
+            stream = completion_client.stream(messages)
+            return asyncio.ensure_future(stream.__anext__()), stream
+
+        first, stream = await self._with_retries(start, requester, prompt_tokens)
+        try:
+            if first is None:
+                # The stream ended without content.
+                return
+            yield first
+            async for chunk in stream:
+                yield chunk
+        except RETRYABLE_ERRORS:
+            # Stalled or broken after the reply started, nothing to retry without repeating text.
+            self.breaker.failure()
+            raise
+        finally:
+            await stream.aclose()
+
+
+resilient_completion = ResilientCompletion()
+metrics.gauge("circuit_open", lambda: int(resilient_completion.breaker.is_open))
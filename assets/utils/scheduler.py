@@ -0,0 +1,225 @@
+import os
+import time
+import random
+import asyncio
+from collections import OrderedDict, deque
+from assets.utils.metrics import metrics
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("bot")
+
+# Provider limits, requests and tokens per minute.
+REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_RPM", 3500))
+TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TPM", 90000))
+# Tokens reserved for the completion on top of the prompt.
+COMPLETION_TOKEN_ESTIMATE = 500
+MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", 200))
+MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", 60))
+
+# Requests that do not belong to a user, e.g. summaries.
+SYSTEM_REQUESTER = (0, 0)
+
+
+class SchedulerBusy(Exception):
+    """Raised when a request would wait too long. `wait` is the estimated wait in seconds."""
+
+    def __init__(self, wait) -> None:
+        super().__init__(f"Request queue is full, estimated wait {wait:.0f}s")
+        self.wait = wait
+
+
+class TokenBucket:
+    """
+    A bucket that holds up to `per_minute` units and refills continuously at `per_minute` per minute.
+    """
+
+    def __init__(self, per_minute) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level +
+                         (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` units are available."""
+        self._refill()
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount):
+        self._refill()
+        self.level -= amount
+
+    def give(self, amount):
+        """Return units taken for a request that was not sent."""
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RequestScheduler:
+    """
+    Budgets model requests against the provider's requests-per-minute and tokens-per-minute limits.
+
+    Waiting requests are queued per guild and per user and granted round-robin: one request of the next guild,
+    and within a guild one request of the next user, so one busy guild or user cannot starve the others.
+    When the queue is full or the estimated wait is longer than `max_wait`, `acquire` raises `SchedulerBusy`.
+
+    In a cluster every process runs its own scheduler, so a granted request also takes its share of the
+    limits from the state backend shared by every process before it is sent.
+
+    Attributes:
+    - requests (TokenBucket): The requests-per-minute budget.
+    - tokens (TokenBucket): The tokens-per-minute budget.
+    - size (int): Number of queued requests.
+    - backend (SQLiteBackend | RedisBackend): The cluster's shared state, None for a single process.
+    """
+
+    def __init__(self, rpm=REQUESTS_PER_MINUTE, tpm=TOKENS_PER_MINUTE, max_queue=MAX_QUEUE, max_wait=MAX_WAIT) -> None:
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.queues = OrderedDict()
+        self.size = 0
+        self.queued_tokens = 0
+        self.backend = None
+        self._task = None
+
+    def estimate_wait(self, tokens=0):
+        """Estimated seconds before a new request of `tokens` tokens would be granted."""
+        return max(self.requests.wait_time(self.size + 1), self.tokens.wait_time(self.queued_tokens + tokens))
+
+    async def acquire(self, requester, tokens):
+        """
+        Wait for budget for one request.
+
+        Parameters:
+        - requester (tuple): (guild ID, user ID) of the request.
+        - tokens (int): Prompt tokens of the request.
+        """
+        tokens = min(tokens + COMPLETION_TOKEN_ESTIMATE, self.tokens.capacity)
+        await self._acquire(requester, tokens)
+        if self.backend is not None:
+            await self._reserve_shared(tokens)
+
+    async def _acquire(self, requester, tokens):
+        if self.size == 0 and self.requests.wait_time(1) == 0 and self.tokens.wait_time(tokens) == 0:
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            return
+        wait = self.estimate_wait(tokens)
+        if self.size >= self.max_queue or wait > self.max_wait:
+            metrics.inc("scheduler_rejected_total")
+            raise SchedulerBusy(wait)
+
+        guild_id, user_id = requester
+        entry = (asyncio.get_running_loop().create_future(), tokens)
+        self.queues.setdefault(guild_id, OrderedDict()).setdefault(
+            user_id, deque()).append(entry)
+        self.size += 1
+        self.queued_tokens += tokens
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        try:
+            await entry[0]
+        except asyncio.CancelledError:
+            if entry[0].done() and not entry[0].cancelled():
+                # Granted in the same iteration it was cancelled, give the budget back.
+                self.requests.give(1)
+                self.tokens.give(tokens)
+            else:
+                # Drop the request if it was still queued.
+                self._remove(guild_id, user_id, entry)
+            raise
+
+    async def try_acquire(self, tokens):
+        """Take budget for one request only if it is available right away and nobody is queued. Returns whether it was taken."""
+        tokens = min(tokens + COMPLETION_TOKEN_ESTIMATE, self.tokens.capacity)
+        if self.size or self.requests.wait_time(1) > 0 or self.tokens.wait_time(tokens) > 0:
+            return False
+        if self.backend is not None:
+            wait = await self.backend.reserve({"requests": 1, "tokens": tokens},
+                                              {"requests": self.requests.capacity, "tokens": self.tokens.capacity})
+            if wait > 0:
+                return False
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        return True
+
+    async def _reserve_shared(self, tokens):
+        """Take one request and `tokens` tokens from the limits shared by the whole cluster."""
+        waited = 0.0
+        while True:
+            wait = await self.backend.reserve({"requests": 1, "tokens": tokens},
+                                              {"requests": self.requests.capacity, "tokens": self.tokens.capacity})
+            if wait <= 0:
+                return
+            if waited + wait > self.max_wait:
+                metrics.inc("scheduler_rejected_total")
+                raise SchedulerBusy(waited + wait)
+            # Spread the processes that wait for the same window.
+            wait += random.uniform(0, 1)
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def _remove(self, guild_id, user_id, entry):
+        users = self.queues.get(guild_id)
+        if users is None or user_id not in users or entry not in users[user_id]:
+            return
+        users[user_id].remove(entry)
+        self.size -= 1
+        self.queued_tokens -= entry[1]
+        if not users[user_id]:
+            del users[user_id]
+        if not users:
+            del self.queues[guild_id]
+
+    def _pop_next(self):
+        """Pop the next request round-robin over guilds, then over users in the guild."""
+        guild_id, users = self.queues.popitem(last=False)
+        user_id, entries = users.popitem(last=False)
+        entry = entries.popleft()
+        if entries:
+            users[user_id] = entries
+        if users:
+            self.queues[guild_id] = users
+        self.size -= 1
+        self.queued_tokens -= entry[1]
+        return entry
+
+    def _peek_next(self):
+        users = next(iter(self.queues.values()))
+        return next(iter(users.values()))[0]
+
+    async def _run(self):
+        while self.size:
+            try:
+                future, tokens = self._peek_next()
+                if future.done():
+                    # Cancelled, its task has not removed it yet. Nothing was taken for it.
+                    self._pop_next()
+                    continue
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                future, tokens = self._pop_next()
+                self.requests.take(1)
+                self.tokens.take(tokens)
+                future.set_result(None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # One bad entry must not stop the scheduler and leave every other request queued, fail it instead.
+                logger.error(f"Request scheduler failed: {e!r}")
+                future, _ = self._pop_next()
+                if not future.done():
+                    future.set_exception(e)
+
+
+request_scheduler = RequestScheduler()
+metrics.gauge("scheduler_queue_depth", lambda: request_scheduler.size)
@@ -0,0 +1,205 @@
+import os
+import time
+import asyncio
+from collections import Counter
+from assets.utils.metrics import metrics
+from assets.utils.timers import timers
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("bot")
+
+# Messages sent within this many seconds of each other are answered as one turn.
+DEBOUNCE_SECONDS = float(os.getenv("CHAT_DEBOUNCE", 1.0))
+# Sessions without a message of their owner for this many seconds are closed.
+CHAT_IDLE_TIMEOUT = float(os.getenv("CHAT_IDLE_TIMEOUT", 30 * 60))
+QUESTIONNAIRE_IDLE_TIMEOUT = float(
+    os.getenv("QUESTIONNAIRE_IDLE_TIMEOUT", 60 * 60))
+
+
+class Session:
+    """
+    A thread owned by one user and handled by one cog.
+
+    Messages of a session are handled one at a time, in order, behind `lock`.
+    Sessions in different threads do not share anything and run in parallel.
+
+    With a `debounce` window, messages sent in a burst are merged into one turn, and a newer message
+    cancels the turn that is still being generated; its messages are answered together with the newer one.
+
+    Attributes:
+    - thread_id (int): The thread of the session.
+    - user_id (int): The user who owns the thread.
+    - handler (coroutine function): Called with the last message of a turn and the content of the turn.
+    - on_foreign (coroutine function): Called with messages of anyone else, or None to drop them.
+    - kind (str): What the session is, e.g. "chat" or "questionnaire".
+    - debounce (float): Seconds to wait for more messages before answering, or None to answer every message.
+    - pending (list): Messages of the owner that have not been answered yet, with the time they arrived.
+    - answering (int): Number of `pending` messages the turn in progress answers.
+    - on_idle (coroutine function): Called with the session when its owner has been silent for `idle_timeout` seconds.
+    - last_active (float): `time.monotonic` of the last message of the owner.
+    """
+
+    def __init__(self, thread_id, user_id, handler, on_foreign=None, kind="chat", debounce=None, on_idle=None, idle_timeout=None) -> None:
+        self.thread_id = thread_id
+        self.user_id = user_id
+        self.handler = handler
+        self.on_foreign = on_foreign
+        self.kind = kind
+        self.debounce = debounce
+        self.lock = asyncio.Lock()
+        self.pending = []
+        self.answering = 0
+        self.timer = None
+        self.task = None
+        self.on_idle = on_idle
+        self.idle_timeout = idle_timeout
+        self.idle_timer = None
+        self.last_active = time.monotonic()
+
+    def cancel(self):
+        """Cancel the debounce timer and the turn in progress, unless it is the caller itself."""
+        current = asyncio.current_task()
+        for task in (self.timer, self.task):
+            if task is not None and task is not current and not task.done():
+                task.cancel()
+        self.timer = None
+
+    def answered(self):
+        """Drop the messages of the turn in progress from `pending`. Its reply is committed and must not be repeated."""
+        del self.pending[:self.answering]
+        self.answering = 0
+
+
+class SessionRouter:
+    """
+    The registry of every active session by thread ID, shared by all cogs.
+
+    The bot hands every message to `dispatch`. A message outside a session costs one dict lookup.
+    Records logged while a message of a session is handled carry the session, guild and user in `log_context`.
+
+    Attributes:
+    - sessions (dict): Active sessions by thread ID.
+    """
+
+    def __init__(self) -> None:
+        self.sessions = {}
+
+    def register(self, thread_id, user_id, handler, on_foreign=None, kind="chat", debounce=None, on_idle=None, idle_timeout=None):
+        self.unregister(thread_id)
+        session = Session(thread_id, user_id, handler,
+                          on_foreign, kind, debounce, on_idle, idle_timeout)
+        self.sessions[thread_id] = session
+        if on_idle is not None and idle_timeout:
+            session.idle_timer = timers.call_at(
+                session.last_active + idle_timeout, lambda: self._check_idle(session))
+        return session
+
+    def unregister(self, thread_id):
+        """Remove a session and cancel whatever it is still generating."""
+        session = self.sessions.pop(thread_id, None)
+        if session is not None:
+            session.cancel()
+            if session.idle_timer is not None:
+                session.idle_timer.cancel()
+        return session
+
+    def _check_idle(self, session):
+        """
+        Runs when the idle timer of a session fires. Messages only move `last_active` forward,
+        so the timer is re-armed here instead of on every message.
+        """
+        if self.sessions.get(session.thread_id) is not session:
+            return
+        deadline = session.last_active + session.idle_timeout
+        if session.lock.locked() or session.pending:
+            # Still answering, look again after another timeout.
+            deadline = time.monotonic() + session.idle_timeout
+        if deadline > time.monotonic():
+            session.idle_timer = timers.call_at(
+                deadline, lambda: self._check_idle(session))
+            return
+        session.idle_timer = None
+        metrics.inc("sessions_expired_total", kind=session.kind)
+        logger.info(
+            f"Closing idle {session.kind} session in thread {session.thread_id}.")
+        return session.on_idle(session)
+
+    def get(self, thread_id):
+        return self.sessions.get(thread_id)
+
+    def answered(self, thread_id):
+        """
+        Called by a handler as soon as the reply of its turn is committed to the conversation,
+        so a turn cancelled after that point is not answered again with the next message.
+        """
+        session = self.sessions.get(thread_id)
+        if session is not None:
+            session.answered()
+
+    async def dispatch(self, message):
+        """Hand a message to the session of its thread, if there is one."""
+        session = self.sessions.get(message.channel.id)
+        if session is None:
+            return
+        if message.author.id != session.user_id:
+            if session.on_foreign is not None:
+                await session.on_foreign(message)
+            return
+        arrived = time.perf_counter()
+        session.last_active = time.monotonic()
+        # Every event runs in its own task, so the context stays with this message and its debounced turn.
+        setting.log_context.set({"session_id": session.thread_id, "user_id": session.user_id,
+                                 "guild_id": message.guild.id if message.guild is not None else None})
+        if session.debounce is None:
+            async with session.lock:
+                if self.sessions.get(message.channel.id) is not session:
+                    # The session ended while this message was waiting for the lock.
+                    return
+                try:
+                    await session.handler(message, message.content)
+                except Exception as e:
+                    logger.error(
+                        f"Failed to handle message {message.id} in thread {session.thread_id}: {e}")
+            metrics.observe("message_seconds", time.perf_counter() -
+                            arrived, kind=session.kind)
+            return
+
+        session.pending.append((message, arrived))
+        # The turn in progress is stale now, answer it together with this message instead.
+        session.cancel()
+        session.timer = asyncio.get_running_loop().create_task(
+            self._answer_after(session, session.debounce))
+
+    async def _answer_after(self, session, delay):
+        await asyncio.sleep(delay)
+        session.timer = None
+        async with session.lock:
+            # Taken under the lock, so the messages a previous turn committed meanwhile are not answered again.
+            batch = list(session.pending)
+            if self.sessions.get(session.thread_id) is not session or not batch:
+                return
+            session.task = asyncio.current_task()
+            session.answering = len(batch)
+            last = batch[-1][0]
+            try:
+                await session.handler(last, "\n".join(message.content for message, _ in batch))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(
+                    f"Failed to handle message {last.id} in thread {session.thread_id}: {e}")
+            finally:
+                session.task = None
+            session.answered()
+            now = time.perf_counter()
+            for _, arrived in batch:
+                metrics.observe("message_seconds", now -
+                                arrived, kind=session.kind)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+session_router = SessionRouter()
+metrics.gauge("active_sessions", lambda: {(("kind", kind),): count for kind, count in Counter(
+    session.kind for session in session_router.sessions.values()).items()})
@@ -0,0 +1,180 @@
+import os
+import json
+import asyncio
+from assets.utils.log_writer import log_writer
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("bot")
+
+SNAPSHOT_PATH = "assets/logs/sessions.jsonl"
+# The journal is compacted once it holds at least this many records of closed sessions, removed or summarized
+# messages, and more of them than live records.
+COMPACT_MIN_RECORDS = 1000
+
+
+class SessionJournal:
+    """
+    An append-only journal of the in-flight chat sessions, used to restore them after a restart.
+
+    Every change is one short JSON line written through the background log writer:
+    - {"op": "open", "k": key, "d": {...}}: a session started, `d` holds what the cog needs to rebuild it.
+    - {"op": "m", "k": key, "r": role, "c": content, "t": tokens}: a message was added to the conversation.
+    - {"op": "p", "k": key}: the newest message was removed, e.g. the input of a cancelled turn.
+    - {"op": "s", "k": key, "n": count, "c": summary, "t": tokens}: the oldest `count` messages were summarized.
+    - {"op": "close", "k": key}: the session ended.
+
+    Token counts are journaled too, so restoring a session needs neither the tokenizer nor the model.
+    `restore` replays the journal once at startup and rewrites it with only the live sessions. At runtime the
+    journal counts its dead records and `compact` rewrites it the same way in a worker thread once they dominate.
+
+    Attributes:
+    - path (str): Path to the journal file.
+    - sessions (dict): The restored sessions by key.
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH) -> None:
+        self.path = path
+        self.sessions = {}
+        # Records in the journal by live session key, and records that replaying no longer needs.
+        self._records = {}
+        self._dead = 0
+        self._compaction = None
+
+    def _write(self, record):
+        log_writer.write(self.path, record)
+        self._count(record)
+
+    def _count(self, record):
+        key, op = record["k"], record["op"]
+        if op == "open":
+            self._dead += self._records.get(key, 0)
+            self._records[key] = 1
+            return
+        if key not in self._records:
+            self._dead += 1
+        elif op == "m":
+            self._records[key] += 1
+        elif op == "p":
+            # The pop and the message it removes.
+            self._records[key] -= 1
+            self._dead += 2
+        elif op == "s":
+            removed = min(record["n"], self._records[key] - 1)
+            self._records[key] += 1 - removed
+            self._dead += removed
+        elif op == "close":
+            self._dead += self._records.pop(key) + 1
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        if self._dead < COMPACT_MIN_RECORDS or self._dead <= sum(self._records.values()):
+            return
+        if self._compaction is not None and not self._compaction.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._compaction = loop.create_task(self.compact())
+
+    def open(self, key, **data):
+        self._write({"op": "open", "k": key, "d": data})
+
+    def message(self, key, message, tokens):
+        self._write({"op": "m", "k": key, "r": message["role"],
+                    "c": message["content"], "t": tokens})
+
+    def pop(self, key):
+        self._write({"op": "p", "k": key})
+
+    def summary(self, key, count, summary, tokens):
+        self._write({"op": "s", "k": key, "n": count,
+                    "c": summary, "t": tokens})
+
+    def close(self, key):
+        self._write({"op": "close", "k": key})
+
+    @staticmethod
+    def _apply(sessions, record):
+        key = record["k"]
+        if record["op"] == "open":
+            sessions[key] = {"data": record["d"], "messages": [],
+                             "summary": None, "summary_tokens": 0}
+        elif record["op"] == "close":
+            sessions.pop(key, None)
+        elif key in sessions:
+            session = sessions[key]
+            if record["op"] == "m":
+                session["messages"].append(
+                    (record["r"], record["c"], record["t"]))
+            elif record["op"] == "p":
+                if session["messages"]:
+                    session["messages"].pop()
+            elif record["op"] == "s":
+                del session["messages"][:record["n"]]
+                session["summary"] = record["c"]
+                session["summary_tokens"] = record["t"]
+
+    def _replay(self, path):
+        sessions = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self._apply(sessions, json.loads(line))
+                    except (ValueError, KeyError):
+                        # A torn last line after a crash, skip it.
+                        continue
+        return sessions
+
+    @staticmethod
+    def _rewrite(path, sessions):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, session in sessions.items():
+                f.write(json.dumps(
+                    {"op": "open", "k": key, "d": session["data"]}, ensure_ascii=False) + "\n")
+                if session["summary"]:
+                    f.write(json.dumps({"op": "s", "k": key, "n": 0, "c": session["summary"],
+                            "t": session["summary_tokens"]}, ensure_ascii=False) + "\n")
+                for role, content, tokens in session["messages"]:
+                    f.write(json.dumps({"op": "m", "k": key, "r": role,
+                            "c": content, "t": tokens}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+
+    def _compact_file(self, path):
+        sessions = self._replay(path)
+        self._rewrite(path, sessions)
+        return len(sessions)
+
+    def restore(self):
+        """Replay the journal, keep the live sessions in `sessions`, and compact the file. Returns `sessions`."""
+        sessions = self._replay(self.path)
+        self._rewrite(self.path, sessions)
+        self._records = {key: 1 + bool(session["summary"]) + len(session["messages"])
+                         for key, session in sessions.items()}
+        self._dead = 0
+        self.sessions = sessions
+        logger.info(f"Restored {len(sessions)} sessions from {self.path}.")
+        return sessions
+
+    async def compact(self):
+        """Rewrite the journal with only the live sessions, in a worker thread between two log writer batches."""
+        self._dead = 0
+        try:
+            live = await log_writer.rewrite(self._compact_file, self.path)
+        except Exception as e:
+            logger.error(f"Failed to compact the session journal: {e}")
+            return
+        logger.info(f"Compacted the session journal to {live} sessions.")
+
+    def take(self, prefix):
+        """Remove and return the restored sessions whose key starts with `prefix`."""
+        taken = {key: session for key, session in self.sessions.items()
+                 if key.startswith(prefix)}
+        for key in taken:
+            del self.sessions[key]
+        return taken
+
+
+session_journal = SessionJournal()
@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("psy")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    discriminator TEXT NOT NULL,
+    questions TEXT NOT NULL,
+    answers TEXT NOT NULL,
+    report TEXT,
+    chat_system_message TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS questionnaires (
+    user_id INTEGER PRIMARY KEY,
+    guild_id INTEGER,
+    thread_id INTEGER NOT NULL,
+    counter INTEGER NOT NULL,
+    answers TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS analyses (
+    key TEXT PRIMARY KEY,
+    report TEXT NOT NULL,
+    chat_system_message TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+FIELDS = ("discriminator", "questions", "answers",
+          "report", "chat_system_message")
+
+
+class PsyDatabase:
+    """
+    SQLite storage for PsyGPT users, indexed by Discord user ID.
+
+    The database runs in WAL mode on one connection that is only used from a single worker thread,
+    so the async methods never block the event loop and writes are serialized.
+
+    Attributes:
+    - path (str): Path to the SQLite file.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="psy-db")
+        self._conn = None
+        self._executor.submit(self._connect).result()
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._add_column("questionnaires", "guild_id INTEGER")
+        self._conn.commit()
+
+    def _add_column(self, table, column):
+        """Add a column to a table created by an older version of the schema."""
+        columns = {row["name"] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+        if column.split()[0] in columns:
+            return
+        try:
+            self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+        except sqlite3.OperationalError as e:
+            # Another process of the cluster added it first.
+            if "duplicate column" not in str(e):
+                raise
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def run(self, func, *args):
+        """Run a function on the database thread from synchronous code."""
+        return self._executor.submit(func, *args).result()
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        record = dict(row)
+        record["questions"] = json.loads(record["questions"])
+        record["answers"] = json.loads(record["answers"])
+        return record
+
+    def _get(self, user_id):
+        row = self._conn.execute(
+            "SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        return self._to_dict(row)
+
+    def _contains(self, user_id):
+        return self._conn.execute("SELECT 1 FROM users WHERE id = ?", (user_id,)).fetchone() is not None
+
+    def _save(self, user_id, discriminator, questions, answers):
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO users (id, discriminator, questions, answers, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET discriminator = excluded.discriminator, questions = excluded.questions, "
+                "answers = excluded.answers, report = NULL, chat_system_message = NULL, updated_at = excluded.updated_at",
+                (user_id, discriminator, json.dumps(questions, ensure_ascii=False),
+                 json.dumps(answers, ensure_ascii=False), time.time()))
+
+    def _update(self, user_id, fields):
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise KeyError(f"Unknown fields: {', '.join(unknown)}")
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._conn:
+            self._conn.execute(
+                f"UPDATE users SET {columns}, updated_at = ? WHERE id = ?",
+                (*fields.values(), time.time(), user_id))
+
+    def _save_questionnaire(self, user_id, state):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO questionnaires (user_id, guild_id, thread_id, counter, answers) VALUES (?, ?, ?, ?, ?)",
+                (user_id, state.get("guild_id"), state["thread_id"], state["counter"],
+                 json.dumps(state["answers"], ensure_ascii=False)))
+
+    def _delete_questionnaire(self, user_id):
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM questionnaires WHERE user_id = ?", (user_id,))
+
+    def _questionnaires(self):
+        rows = self._conn.execute(
+            "SELECT user_id, guild_id, thread_id, counter, answers FROM questionnaires").fetchall()
+        return {row["user_id"]: {
+            "guild_id": row["guild_id"],
+            "thread_id": row["thread_id"],
+            "counter": row["counter"],
+            "answers": json.loads(row["answers"])
+        } for row in rows}
+
+    def _get_analysis(self, key):
+        row = self._conn.execute(
+            "SELECT report, chat_system_message FROM analyses WHERE key = ?", (key,)).fetchone()
+        return None if row is None else (row["report"], row["chat_system_message"])
+
+    def _save_analysis(self, key, report, chat_system_message):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analyses (key, report, chat_system_message, created_at) VALUES (?, ?, ?, ?)",
+                (key, report, chat_system_message, time.time()))
+
+    def _ids(self):
+        return [row[0] for row in self._conn.execute("SELECT id FROM users ORDER BY id")]
+
+    def _count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    async def get(self, user_id):
+        """Returns the record of a user as a dict, or None."""
+        return await self._run(self._get, user_id)
+
+    async def contains(self, user_id):
+        return await self._run(self._contains, user_id)
+
+    async def save(self, user_id, discriminator, questions, answers):
+        """Store the questionnaire of a user. Any previous report is cleared."""
+        await self._run(self._save, user_id, discriminator, questions, answers)
+
+    async def update(self, user_id, **fields):
+        """Update some fields of a stored user, e.g. `report` and `chat_system_message`."""
+        await self._run(self._update, user_id, fields)
+
+    async def save_questionnaire(self, user_id, state):
+        """Checkpoint an in-progress questionnaire so it survives a restart."""
+        await self._run(self._save_questionnaire, user_id, state)
+
+    async def delete_questionnaire(self, user_id):
+        await self._run(self._delete_questionnaire, user_id)
+
+    def questionnaires(self):
+        """Returns every in-progress questionnaire by user ID. Called once at startup."""
+        return self.run(self._questionnaires)
+
+    async def get_analysis(self, key):
+        """Returns the cached (report, chat_system_message) of an analysis key, or None."""
+        return await self._run(self._get_analysis, key)
+
+    async def save_analysis(self, key, report, chat_system_message):
+        await self._run(self._save_analysis, key, report, chat_system_message)
+
+    async def ids(self):
+        return await self._run(self._ids)
+
+    async def count(self):
+        return await self._run(self._count)
+
+    def migrate_json(self, json_path):
+        """
+        Import the old psygpt_database.json once. The file is renamed afterwards so it is not imported again.
+        Importing is idempotent, so a file that another process migrated or renamed meanwhile is skipped.
+
+        Returns:
+        - count (int): The number of imported users.
+        """
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0
+
+        def migrate():
+            with self._conn:
+                for discriminator, record in data.items():
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO users (id, discriminator, questions, answers, report, chat_system_message, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (record["id"], discriminator,
+                         json.dumps(record.get("questions", []),
+                                    ensure_ascii=False),
+                         json.dumps(record.get("answers", []),
+                                    ensure_ascii=False),
+                         record.get("report"), record.get("chat_system_message"), time.time()))
+
+        self.run(migrate)
+        try:
+            os.replace(json_path, json_path + ".migrated")
+        except FileNotFoundError:
+            # Another process of the cluster migrated the same file.
+            return 0
+        logger.info(f"Migrated {len(data)} users from {json_path}.")
+        return len(data)
+
+    def close(self):
+        if self._conn is not None:
+            self.run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
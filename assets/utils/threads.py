@@ -0,0 +1,117 @@
+import time
+import asyncio
+import discord
+from datetime import datetime, timedelta, timezone
+from assets.utils.metrics import metrics
+from assets.utils.session import session_router
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("core")
+
+# Deletes in flight at once. Every thread is its own rate-limit bucket, so this mostly bounds the global rate.
+CLEANUP_CONCURRENCY = 5
+# Minimum seconds between two progress reports.
+PROGRESS_INTERVAL = 2.0
+
+
+def thread_created_at(thread):
+    """Creation time of a thread. Threads older than 2022 have no `created_at`, their ID holds it."""
+    return thread.created_at or discord.utils.snowflake_time(thread.id)
+
+
+async def list_threads(channel, archived=True):
+    """
+    Every thread of a text channel: the active ones and, with `archived`, the public and private archived ones.
+    Private archived threads are skipped if the bot is not allowed to list them.
+    """
+    threads = {thread.id: thread for thread in channel.threads}
+    for thread in await channel.guild.active_threads():
+        if thread.parent_id == channel.id:
+            threads[thread.id] = thread
+    if archived:
+        async for thread in channel.archived_threads(limit=None):
+            threads[thread.id] = thread
+        try:
+            async for thread in channel.archived_threads(limit=None, private=True):
+                threads[thread.id] = thread
+        except discord.Forbidden:
+            logger.info(
+                f"Not allowed to list private archived threads in {channel.id}.")
+    return list(threads.values())
+
+
+class ThreadCleaner:
+    """
+    Deletes many threads with bounded concurrency.
+
+    discord.py already waits on the rate-limit bucket of each route and retries 429s, so the cleaner only limits
+    how many deletes are in flight and reports progress while they run.
+    Threads with an active chat or questionnaire session are never deleted.
+
+    Attributes:
+    - owner_id (int): Only delete threads created by this user, e.g. the bot. None for any owner.
+    - older_than (float): Only delete threads created more than this many hours ago.
+    - concurrency (int): Deletes in flight at once.
+    - deleted (int): Threads deleted so far.
+    - failed (int): Threads that could not be deleted.
+    """
+
+    def __init__(self, owner_id=None, older_than=0.0, concurrency=CLEANUP_CONCURRENCY) -> None:
+        self.owner_id = owner_id
+        self.older_than = older_than
+        self.concurrency = concurrency
+        self.deleted = 0
+        self.failed = 0
+
+    def matches(self, thread, now=None):
+        if session_router.get(thread.id) is not None:
+            return False
+        if self.owner_id is not None and thread.owner_id != self.owner_id:
+            return False
+        if self.older_than:
+            now = now or datetime.now(timezone.utc)
+            if now - thread_created_at(thread) < timedelta(hours=self.older_than):
+                return False
+        return True
+
+    async def _delete(self, thread, semaphore):
+        async with semaphore:
+            try:
+                await thread.delete()
+            except discord.NotFound:
+                # Already gone.
+                pass
+            except discord.HTTPException as e:
+                self.failed += 1
+                logger.error(f"Failed to delete thread {thread.id}: {e}")
+                return
+            self.deleted += 1
+            metrics.inc("threads_deleted_total")
+
+    async def run(self, threads, on_progress=None):
+        """
+        Delete the matching threads.
+
+        Parameters:
+        - threads (list): Candidate threads, e.g. from `list_threads`.
+        - on_progress (coroutine function): Called with (done, total) at most every PROGRESS_INTERVAL seconds.
+
+        Returns:
+        - total (int): Number of threads that matched the filters.
+        """
+        now = datetime.now(timezone.utc)
+        targets = [thread for thread in threads if self.matches(thread, now)]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [asyncio.create_task(self._delete(thread, semaphore))
+                 for thread in targets]
+        last_report = time.monotonic()
+        pending = set(tasks)
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=PROGRESS_INTERVAL)
+            if on_progress is not None and pending and time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                try:
+                    await on_progress(self.deleted + self.failed, len(targets))
+                except Exception as e:
+                    logger.error(f"Failed to report cleanup progress: {e}")
+        return len(targets)
@@ -0,0 +1,120 @@
+import time
+import heapq
+import asyncio
+import itertools
+from datetime import datetime, timedelta
+import assets.settings.setting as setting
+
+logger = setting.logging.getLogger("bot")
+
+
+class Timer:
+    """A scheduled callback. `when` is on the `time.monotonic` clock."""
+
+    __slots__ = ("when", "callback", "cancelled")
+
+    def __init__(self, when, callback) -> None:
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def seconds_until(clock_time, now=None):
+    """Seconds until the next time the wall clock shows `clock_time` ("HH:MM")."""
+    now = now or datetime.now()
+    target = datetime.strptime(clock_time, "%H:%M")
+    target = now.replace(hour=target.hour, minute=target.minute,
+                         second=0, microsecond=0)
+    if target <= now:
+        target += timedelta(days=1)
+    return (target - now).total_seconds()
+
+
+class TimerScheduler:
+    """
+    Runs callbacks at deadlines from one background task that sleeps until the earliest deadline.
+
+    Timers live in a heap, so scheduling and cancelling are cheap and an idle bot does not wake up at all.
+    Cancelled timers are dropped lazily when they reach the top of the heap.
+    A callback may return a coroutine, which is run as its own task so a slow callback never delays the others.
+
+    Attributes:
+    - heap (list): (deadline, sequence, timer) of the scheduled timers.
+    """
+
+    def __init__(self) -> None:
+        self.heap = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+
+    def call_at(self, when, callback):
+        """Run `callback` at `when` on the `time.monotonic` clock. Returns the `Timer`."""
+        timer = Timer(when, callback)
+        heapq.heappush(self.heap, (when, next(self._sequence), timer))
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        elif self.heap[0][2] is timer:
+            # The new timer is the earliest, wake the runner up to shorten its sleep.
+            self._wakeup.set()
+        return timer
+
+    def call_later(self, delay, callback):
+        return self.call_at(time.monotonic() + delay, callback)
+
+    def every_day(self, clock_time, callback):
+        """Run `callback` every day when the wall clock shows `clock_time` ("HH:MM")."""
+        def run():
+            self.every_day(clock_time, callback)
+            return callback()
+        return self.call_later(seconds_until(clock_time), run)
+
+    def _fire(self, timer):
+        try:
+            result = timer.callback()
+        except Exception as e:
+            logger.error(f"Timer callback failed: {e}")
+            return
+        if asyncio.iscoroutine(result):
+            task = asyncio.get_running_loop().create_task(result)
+            self._running.add(task)
+            task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._running.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Timer callback failed: {task.exception()}")
+
+    async def _run(self):
+        while True:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+            timeout = None
+            if self.heap:
+                timeout = self.heap[0][0] - time.monotonic()
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, timer = heapq.heappop(self.heap)
+            self._fire(timer)
+
+    async def close(self):
+        """Stop the scheduler and cancel the callbacks still running."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._running):
+            task.cancel()
+        self.heap.clear()
+        self._wakeup = asyncio.Event()
+
+
+timers = TimerScheduler()
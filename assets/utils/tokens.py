@@ -0,0 +1,50 @@
+import asyncio
+import functools
+
+# Inputs longer than this many characters are tokenized in a worker thread so a
+# single huge message does not stall the event loop for every other user.
+LONG_INPUT_CHARS = 2000
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model="gpt-3.5-turbo"):
+    """Returns the tiktoken encoding for a model. The encoding is loaded once per process, on first use."""
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def num_tokens_from_message(message, model="gpt-3.5-turbo"):
+    """Returns the number of tokens used by a single message, without the reply priming."""
+    if model == "gpt-3.5-turbo":  # note: future models may deviate from this
+        encoding = get_encoding(model)
+        # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        num_tokens = 4
+        for key, value in message.items():
+            if not isinstance(value, str):
+                value = str(value)
+            num_tokens += len(encoding.encode(value))
+            if key == "name":  # if there's a name, the role is omitted
+                num_tokens += -1  # role is always required and always 1 token
+        return num_tokens
+    else:
+        raise NotImplementedError(f"""num_tokens_from_message() is not presently implemented for model {model}.
+See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
+
+
+async def num_tokens_from_message_async(message, model="gpt-3.5-turbo"):
+    """Same as `num_tokens_from_message`, but tokenizes long messages in a worker thread."""
+    if sum(len(str(value)) for value in message.values()) > LONG_INPUT_CHARS:
+        return await asyncio.to_thread(num_tokens_from_message, message, model)
+    return num_tokens_from_message(message, model)
+
+
+def num_tokens_from_messages(messages, model="gpt-3.5-turbo"):
+    """Returns the number of tokens used by a list of messages."""
+    num_tokens = 0
+    for message in messages:
+        num_tokens += num_tokens_from_message(message, model)
+    num_tokens += 2  # every reply is primed with <im_start>assistant
+    return num_tokens
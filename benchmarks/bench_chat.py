@@ -0,0 +1,199 @@
+"""
+Microbenchmarks for the per-message hot paths in assets/utils/chat.py.
+
+Runs token counting, `Conversation.prepare_prompt`, `_write_log`, `__len__` / `__str__` and
+`CharacterConversation` construction over several conversation lengths, message sizes and
+CJK / ASCII mixes, and reports the median time per call of each case.
+
+Results can be saved as JSON and compared with a stored baseline. Cases that got slower than
+`--threshold` times the baseline are reported as regressions and make the script exit with status 1.
+
+Usage:
+    python -m benchmarks.bench_chat --save-baseline          # record benchmarks/baselines/bench_chat.json
+    python -m benchmarks.bench_chat --output results.json    # compare with the baseline and save the results
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import platform
+import argparse
+import tempfile
+import statistics
+from assets.utils.chat import Conversation, CharacterConversation, num_tokens_from_messages
+from assets.utils.persona import persona_registry
+from assets.utils.log_writer import log_writer
+
+BASELINE_PATH = "benchmarks/baselines/bench_chat.json"
+
+LENGTHS = (10, 100, 1000)
+SIZES = {"short": 40, "long": 800}
+ASCII_WORDS = ["hello", "world", "python", "discord", "bot", "chat", "token", "cache", "the", "a", "is", "and"]
+CJK_WORDS = ["你好", "世界", "今天", "天氣", "很好", "我們", "聊天", "機器人", "心理", "測試", "。", "，"]
+MIXES = {
+    "ascii": 0.0,
+    "cjk": 1.0,
+    "mixed": 0.5,
+}
+
+SYSTEM_MESSAGE = "You are a helpful assistant. 你是一個有幫助的助理，請用繁體中文回答。"
+
+
+def make_text(rng, size, cjk_ratio):
+    """Random text of about `size` characters, with `cjk_ratio` of the words in CJK."""
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(CJK_WORDS) if rng.random() < cjk_ratio else rng.choice(ASCII_WORDS) + " "
+        words.append(word)
+        length += len(word)
+    return "".join(words)[:size]
+
+
+def make_messages(rng, count, size, cjk_ratio):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": make_text(rng, size, cjk_ratio)}
+            for i in range(count)]
+
+
+def make_conversation(messages, log_path):
+    conversation = Conversation(log_path=log_path)
+    conversation.init_system_message(SYSTEM_MESSAGE)
+    # A large budget keeps the whole history in the window, so every case measures the same amount of work.
+    conversation.token_budget = 10**9
+    for message in messages:
+        conversation._append(message)
+    return conversation
+
+
+def measure(func, repeat, min_time):
+    """Median seconds per call of `func` over `repeat` rounds, each running for at least `min_time` seconds."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    rounds = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        rounds.append((time.perf_counter() - start) / number)
+    return statistics.median(rounds)
+
+
+async def run(args, tmp):
+    rng = random.Random(args.seed)
+    log_path = os.path.join(tmp, "bench.jsonl")
+    results = {}
+
+    def record(name, func):
+        seconds = measure(func, args.repeat, args.min_time)
+        results[name] = seconds * 1e6
+        print(f"{name:<48} {seconds * 1e6:12.2f} us")
+
+    for mix, cjk_ratio in MIXES.items():
+        for size_name, size in SIZES.items():
+            message = {"role": "user", "content": make_text(
+                rng, size, cjk_ratio)}
+            for length in LENGTHS:
+                messages = make_messages(rng, length, size, cjk_ratio)
+                conversation = make_conversation(messages, log_path)
+                case = f"{mix}/{size_name}/{length}"
+
+                record(f"num_tokens_from_messages/{case}",
+                       lambda: num_tokens_from_messages(messages))
+
+                def prepare():
+                    conversation.prepare_prompt(message["content"])
+                    conversation.pop_last()
+                record(f"prepare_prompt/{case}", prepare)
+                record(f"len/{case}", lambda: len(conversation))
+                record(f"str/{case}", lambda: str(conversation))
+                await log_writer.close()
+
+            record(f"write_log/{mix}/{size_name}",
+                   lambda: conversation._write_log(message))
+            await log_writer.close()
+
+    for persona in persona_registry.values():
+        record(f"character_conversation/{persona.key}",
+               lambda: CharacterConversation(0, persona.key, log_path=log_path))
+        await log_writer.close()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the ratio of every case to the baseline. Returns the names of the regressed cases."""
+    regressions = []
+    print(f"\n{'case':<48} {'baseline':>12} {'now':>12} {'ratio':>7}")
+    for name, now in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:<48} {'-':>12} {now:12.2f} {'new':>7}")
+            continue
+        ratio = now / before
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"{name:<48} {before:12.2f} {now:12.2f} {ratio:7.2f}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def save(path, results):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "unit": "us",
+            "results": results,
+        }, f, indent=4)
+
+
+async def main(args):
+    persona_registry.load()
+    with tempfile.TemporaryDirectory() as tmp:
+        results = await run(args, tmp)
+
+    if args.output:
+        save(args.output, results)
+    if args.save_baseline:
+        save(args.baseline, results)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline first.")
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} cases are slower than {args.threshold}x the baseline.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Measured rounds per case. (Default: 5)")
+    parser.add_argument("--min-time", type=float, default=0.05,
+                        help="Minimum seconds per round. (Default: 0.05)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the generated messages. (Default: 0)")
+    parser.add_argument("--baseline", default=BASELINE_PATH,
+                        help=f"Baseline to compare with. (Default: {BASELINE_PATH})")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="Ratio to the baseline above which a case is a regression. (Default: 1.25)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Save the results as the new baseline instead of comparing.")
+    parser.add_argument("--output",
+                        help="Also save the results to this JSON file.")
+    sys.exit(asyncio.run(main(parser.parse_args())))
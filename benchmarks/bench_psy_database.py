@@ -0,0 +1,81 @@
+"""
+Benchmark for the PsyGPT storage engine.
+
+Fills a temporary SQLite database with synthetic users and measures lookups and writes,
+next to the linear scan over a dict that the JSON database used to do.
+
+Usage: python -m benchmarks.bench_psy_database --users 100000
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from assets.utils.storage import PsyDatabase
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+async def measure(func, ids, repeat):
+    samples = []
+    for _ in range(repeat):
+        user_id = random.choice(ids)
+        start = time.perf_counter()
+        await func(user_id)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(name, samples):
+    print(f"{name:<24} p50 {percentile(samples, 0.5):8.3f} ms   p99 {percentile(samples, 0.99):8.3f} ms")
+
+
+async def main(users, repeat):
+    questions = [f"Q{i}" for i in range(5)]
+    answers = ["這是一個測試回答。" * 4 for _ in range(5)]
+    with tempfile.TemporaryDirectory() as tmp:
+        database = PsyDatabase(os.path.join(tmp, "bench.sqlite3"))
+        ids = list(range(10**17, 10**17 + users))
+
+        def fill():
+            with database._conn:
+                for user_id in ids:
+                    database._conn.execute(
+                        "INSERT INTO users (id, discriminator, questions, answers, report, chat_system_message, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (user_id, f"user#{user_id % 10000:04d}", json.dumps(questions),
+                         json.dumps(answers, ensure_ascii=False), "report", "system", time.time()))
+
+        start = time.perf_counter()
+        await asyncio.to_thread(database.run, fill)
+        print(f"Inserted {users} users in {time.perf_counter() - start:.2f} s")
+
+        report("contains", await measure(database.contains, ids, repeat))
+        report("get", await measure(database.get, ids, repeat))
+        report("update report", await measure(
+            lambda user_id: database.update(user_id, report="new report"), ids, repeat))
+        report("save questionnaire", await measure(
+            lambda user_id: database.save(user_id, "user#0000", questions, answers), ids, repeat))
+
+        # The old JSON database scanned every record to find an ID.
+        legacy = {f"user{user_id}": {"id": user_id} for user_id in ids}
+
+        async def legacy_contains(user_id):
+            return user_id in [legacy[user]["id"] for user in legacy]
+        report("legacy linear scan", await measure(legacy_contains, ids, min(repeat, 50)))
+        database.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100000,
+                        help="Number of stored users. (Default: 100000)")
+    parser.add_argument("--repeat", type=int, default=1000,
+                        help="Number of measured operations per benchmark. (Default: 1000)")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.repeat))
@@ -0,0 +1,79 @@
+"""
+Measures the memory held per chat session.
+
+Creates character conversations with a given number of turns and reports the bytes per session traced by
+tracemalloc, next to the old layout where every session copied the persona messages and kept every turn as a dict.
+
+Usage: python -m benchmarks.bench_session_memory --sessions 1000 --turns 20
+"""
+import random
+import argparse
+import tempfile
+import tracemalloc
+from collections import deque
+from assets.utils.chat import User
+from assets.utils.memory import memory_budget
+from assets.utils.persona import persona_registry
+
+TEXTS = ["你好，今天過得怎麼樣？", "Can you tell me a short story about a cat?",
+         "我最近工作壓力很大，有什麼建議嗎？", "這是一個比較長的回答。" * 10]
+
+
+def measure(build, sessions):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = [build(i) for i in range(sessions)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    used = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return used / sessions, objects
+
+
+def main(sessions, turns):
+    persona_registry.load()
+    keys = [persona.key for persona in persona_registry.values()]
+    rng = random.Random(0)
+    contents = [[rng.choice(TEXTS) + str(i) for i in range(turns)]
+                for _ in range(sessions)]
+    # Never spill during the measurement.
+    memory_budget.budget = float("inf")
+
+    # No event loop is running, so the conversation logs are written straight through
+    # and nothing stays buffered during the measurement.
+    with tempfile.TemporaryDirectory() as tmp:
+        def build(i):
+            user = User(i, keys[i % len(keys)], log_path=f"{tmp}/{i}.jsonl")
+            for j, content in enumerate(contents[i]):
+                user.conversation._append(
+                    {"role": "user" if j % 2 == 0 else "assistant", "content": content}, tokens=len(content))
+            return user
+
+        def build_legacy(i):
+            persona = persona_registry[keys[i % len(keys)]]
+            messages = deque([{"role": "system", "content": persona.system_message}] +
+                             [{"role": role, "content": content} for role, content in persona.examples])
+            token_counts = deque(persona.example_tokens)
+            for j, content in enumerate(contents[i]):
+                messages.append(
+                    {"role": "user" if j % 2 == 0 else "assistant", "content": content})
+                token_counts.append(len(content))
+            return messages, token_counts
+
+        compact, users = measure(build, sessions)
+        legacy, _ = measure(build_legacy, sessions)
+        print(f"{sessions} sessions with {turns} turns")
+        print(f"compact sessions   {compact:10.0f} bytes/session")
+        print(f"dict per message   {legacy:10.0f} bytes/session")
+        print(f"budget incl. text  {memory_budget.total / sessions:10.0f} bytes/session")
+        for user in users:
+            user.conversation.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=1000,
+                        help="Number of sessions. (Default: 1000)")
+    parser.add_argument("--turns", type=int, default=20,
+                        help="Turns per session. (Default: 20)")
+    args = parser.parse_args()
+    main(args.sessions, args.turns)
@@ -0,0 +1,354 @@
+"""
+Offline load test of the chat message path.
+
+Simulated users chat in their own threads with `GPT3Helper` and `PsyGPT`. Their messages go through the session
+router exactly like `Bot.on_message` hands them over, and the cogs stream their replies from a local
+OpenAI-compatible mock server (benchmarks/mock_openai.py) into fake Discord threads with a configurable REST latency.
+
+Reports throughput, turn latency percentiles (to the first reply message and to the end of the reply, and to
+the end of every turn including the failed ones), failed turns, and the event loop lag measured while the test runs. Requests still go through the request scheduler,
+so a long tail usually means the OPENAI_RPM / OPENAI_TPM budget (or --rpm / --tpm) is exhausted.
+Everything the test writes goes to a temporary directory. No network is needed once the tiktoken
+encoding is in its local cache.
+
+Usage: python -m benchmarks.load_test --users 200 --turns 5 --latency 0.5 --error-rate 0.02
+With --stall-rate and --error-rate, compare a run with --no-resilience to see what deadlines, retries and hedging do.
+"""
+import os
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import itertools
+import openai
+from benchmarks.mock_openai import add_arguments, from_arguments
+from assets.utils.chat import User, Conversation
+from assets.utils.persona import persona_registry
+from assets.utils.snapshot import session_journal
+from assets.utils.session import session_router
+from assets.utils.log_writer import log_writer
+from assets.utils.completion import completion_client
+from assets.utils.metrics import metrics
+from assets.utils.scheduler import request_scheduler, TokenBucket
+from assets.utils.resilience import resilient_completion
+from cogs.gpt3 import GPT3Helper
+from cogs.psy import PsyGPT
+
+# Replies of the cogs that mean the turn failed.
+ERROR_REPLIES = ("生成對話時發生錯誤", "目前使用人數過多", "沒有生成任何回應", "訊息過長", "AI 服務暫時不穩定", "回應逾時")
+USER_MESSAGES = [
+    "你好，今天過得怎麼樣？",
+    "Can you tell me a short story about a cat?",
+    "我最近工作壓力很大，有什麼建議嗎？",
+    "What do you think about learning Python and 日本語 at the same time?",
+    "謝謝你的回答！",
+]
+SELF_CHAT_SYSTEM_MESSAGE = "你是使用者本人。你外向、好奇，說話直接但溫和。請用使用者的語氣回答。"
+
+ids = itertools.count(10**17)
+
+
+class FakeAuthor:
+    def __init__(self, id, name) -> None:
+        self.id = id
+        self.name = name
+        self.discriminator = "0000"
+        self.bot = False
+
+
+class FakeGuild:
+    def __init__(self, id) -> None:
+        self.id = id
+
+
+class FakeMessage:
+    def __init__(self, channel, content, author, reference=None) -> None:
+        self.id = next(ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.author = author
+        self.reference = reference
+
+    async def edit(self, content=None, **kwargs):
+        await self.channel.rest()
+        self.content = content
+        return self
+
+    async def reply(self, content, **kwargs):
+        return await self.channel.send(content, reference=self)
+
+    async def delete(self):
+        await self.channel.rest()
+
+
+class _Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeThread:
+    """
+    A Discord thread. Every REST call takes `latency` seconds.
+
+    Attributes:
+    - sent (list): (time, message) of every message the bot sent.
+    - done (asyncio.Event): Set when the cog has finished a turn.
+    """
+
+    def __init__(self, guild, bot_user, latency) -> None:
+        self.id = next(ids)
+        self.guild = guild
+        self.bot_user = bot_user
+        self.latency = latency
+        self.sent = []
+        self.done = asyncio.Event()
+        self.calls = 0
+
+    async def rest(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+    async def send(self, content, reference=None, **kwargs):
+        await self.rest()
+        message = FakeMessage(self, content, self.bot_user, reference)
+        self.sent.append((time.perf_counter(), message))
+        return message
+
+    def typing(self):
+        return _Typing()
+
+    async def delete(self):
+        await self.rest()
+
+
+class FakeBot:
+    def __init__(self) -> None:
+        self.debug = False
+        self.cluster_id = 0
+        self.user = FakeAuthor(1, "NaichenBot")
+        self.threads = {}
+
+    def owns_guild(self, guild_id):
+        return True
+
+    async def fetch_channel(self, id):
+        return self.threads[id]
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def report(name, samples, unit="s"):
+    print(f"{name:<20} p50 {percentile(samples, 0.5):8.3f} {unit}   p90 {percentile(samples, 0.9):8.3f} {unit}   "
+          f"p99 {percentile(samples, 0.99):8.3f} {unit}   max {max(samples, default=0):8.3f} {unit}")
+
+
+async def monitor_loop_lag(samples, interval=0.05):
+    """Measure how late the event loop wakes up a sleeping task."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append((time.perf_counter() - start - interval) * 1000)
+
+
+def serve_in_thread(server, port):
+    """Run the mock server on its own event loop, so it does not add to the lag of the bot's loop."""
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start(port=port))
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+    return stop
+
+
+class LoadTest:
+    def __init__(self, args, tmp) -> None:
+        self.args = args
+        self.tmp = tmp
+        self.bot = FakeBot()
+        self.gpt3 = GPT3Helper(self.bot)
+        shutil.copy("assets/database/questions.json", tmp)
+        self.psy = PsyGPT(self.bot, database_dir=tmp)
+        self.guilds = [FakeGuild(next(ids)) for _ in range(args.guilds)]
+        self.first_reply = []
+        self.turn = []
+        self.any_turn = []
+        self.errors = 0
+        self.turns = 0
+
+    def open_thread(self, author):
+        thread = FakeThread(random.choice(self.guilds),
+                            self.bot.user, self.args.discord_latency)
+        self.bot.threads[thread.id] = thread
+
+        async def done(handler, message, content):
+            try:
+                await handler(message, content)
+            finally:
+                thread.done.set()
+        return thread, done
+
+    def open_gpt3_chat(self, author):
+        """Set up a character chat the way the chat command does, without the select menu."""
+        thread, done = self.open_thread(author)
+        persona = random.choice(list(persona_registry.values()))
+        user = User(author.id, persona.key, log_path=os.path.join(
+            self.tmp, f"{author.id}.jsonl"))
+        key = f"gpt3:{author.id}"
+        session_journal.open(key, persona=persona.key, thread=thread.id,
+                             start=[thread.id, 0], log_path=user.conversation.log_path)
+        user.conversation.journal_key = key
+        self.gpt3.chatting_users[author.id] = user
+        self.gpt3.chatting_threads[author.id] = thread.id
+        self.gpt3.chatting_start_message[author.id] = FakeMessage(
+            thread, "聊天室已創建！", self.bot.user)
+        session_router.register(thread.id, author.id, lambda message, content: done(
+            self.gpt3.handle_message, message, content), debounce=self.args.debounce)
+        return thread
+
+    def open_psy_chat(self, author):
+        """Set up a self chat the way the self_chat command does, with a synthetic analysis."""
+        thread, done = self.open_thread(author)
+        conversation = Conversation(
+            log_path=os.path.join(self.tmp, f"{author.id}.jsonl"))
+        conversation.init_system_message(SELF_CHAT_SYSTEM_MESSAGE)
+        key = f"psy:{author.id}"
+        session_journal.open(key, thread=thread.id, system=SELF_CHAT_SYSTEM_MESSAGE,
+                             log_path=conversation.log_path)
+        conversation.journal_key = key
+        self.psy.chatting_threads[author.id] = {
+            "thread_id": thread.id,
+            "conversation": conversation
+        }
+        session_router.register(thread.id, author.id, lambda message, content: done(
+            self.psy.handle_chat, message, content), debounce=self.args.debounce)
+        return thread
+
+    async def simulate_user(self, index):
+        author = FakeAuthor(next(ids), f"user{index}")
+        await asyncio.sleep(random.random() * self.args.ramp_up)
+        if random.random() < self.args.psy_ratio:
+            thread = self.open_psy_chat(author)
+        else:
+            thread = self.open_gpt3_chat(author)
+
+        for _ in range(self.args.turns):
+            thread.done.clear()
+            sent = len(thread.sent)
+            message = FakeMessage(
+                thread, random.choice(USER_MESSAGES), author)
+            start = time.perf_counter()
+            await session_router.dispatch(message)
+            await thread.done.wait()
+            end = time.perf_counter()
+
+            self.turns += 1
+            self.any_turn.append(end - start)
+            replies = thread.sent[sent:]
+            if not replies or any(reply.content.startswith(ERROR_REPLIES) for _, reply in replies):
+                self.errors += 1
+            else:
+                self.first_reply.append(replies[0][0] - start)
+                self.turn.append(end - start)
+            await asyncio.sleep(random.expovariate(1 / self.args.think))
+        session_router.unregister(thread.id)
+
+    async def run(self):
+        lag = []
+        monitor = asyncio.create_task(monitor_loop_lag(lag))
+        start = time.perf_counter()
+        await asyncio.gather(*(self.simulate_user(i) for i in range(self.args.users)))
+        elapsed = time.perf_counter() - start
+        monitor.cancel()
+
+        print(f"{self.args.users} users, {self.turns} turns in {elapsed:.2f} s, "
+              f"{(self.turns - self.errors) / elapsed:.2f} turns/s, {self.errors} failed")
+        print(f"Discord REST calls: {sum(thread.calls for thread in self.bot.threads.values())}")
+        report("first reply", self.first_reply)
+        report("full reply", self.turn)
+        report("any turn", self.any_turn)
+        report("event loop lag", lag, unit="ms")
+
+
+async def main(args):
+    server = from_arguments(args)
+    stop_server = serve_in_thread(server, args.port)
+    openai.api_base = f"http://127.0.0.1:{args.port}/v1"
+    openai.api_key = "sk-load-test"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        session_journal.path = os.path.join(tmp, "sessions.jsonl")
+        if args.rpm:
+            request_scheduler.requests = TokenBucket(args.rpm)
+        if args.tpm:
+            request_scheduler.tokens = TokenBucket(args.tpm)
+        if args.no_resilience:
+            resilient_completion.deadline = float("inf")
+            resilient_completion.max_retries = 0
+            resilient_completion.hedge_percentile = None
+            resilient_completion.breaker.threshold = float("inf")
+        await asyncio.to_thread(persona_registry.load)
+        test = LoadTest(args, tmp)
+        try:
+            await test.run()
+            print(f"Mock server requests: {server.requests}")
+            if args.metrics:
+                print(metrics.summary())
+        finally:
+            await log_writer.close()
+            await completion_client.close()
+            await asyncio.to_thread(test.psy.database.close)
+            stop_server()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100,
+                        help="Number of simulated users. (Default: 100)")
+    parser.add_argument("--guilds", type=int, default=5,
+                        help="Number of guilds the users are spread over. (Default: 5)")
+    parser.add_argument("--turns", type=int, default=5,
+                        help="Messages sent by each user. (Default: 5)")
+    parser.add_argument("--think", type=float, default=2.0,
+                        help="Mean seconds a user waits after a reply before the next message. (Default: 2)")
+    parser.add_argument("--ramp-up", type=float, default=5.0,
+                        help="Seconds over which the users join. (Default: 5)")
+    parser.add_argument("--psy-ratio", type=float, default=0.5,
+                        help="Fraction of the users chatting with PsyGPT instead of a character. (Default: 0.5)")
+    parser.add_argument("--debounce", type=float, default=0.0,
+                        help="Debounce window of the chat sessions in seconds. (Default: 0)")
+    parser.add_argument("--discord-latency", type=float, default=0.05,
+                        help="Seconds taken by every Discord REST call. (Default: 0.05)")
+    parser.add_argument("--rpm", type=int, default=None,
+                        help="Requests per minute of the scheduler. (Default: OPENAI_RPM)")
+    parser.add_argument("--tpm", type=int, default=None,
+                        help="Tokens per minute of the scheduler. (Default: OPENAI_TPM)")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="Port of the mock OpenAI server. (Default: 8765)")
+    parser.add_argument("--no-resilience", action="store_true",
+                        help="Disable reply deadlines, retries, hedging and the circuit breaker.")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Print the bot's metrics summary at the end.")
+    add_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
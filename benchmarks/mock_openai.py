@@ -0,0 +1,136 @@
+"""
+A local OpenAI-compatible chat completion server for load tests.
+
+Answers /v1/chat/completions with a canned reply, streamed or not, after a configurable latency.
+A fraction of the requests can fail with a server error or a rate limit, or stall before answering.
+
+Usage: python -m benchmarks.mock_openai --port 8765 --latency 0.5 --chunk-delay 0.05
+"""
+import json
+import random
+import asyncio
+import argparse
+from aiohttp import web
+
+REPLY_CHUNKS = ["這是", "一個", "測試", "回應", "。", "Hello", " from", " the", " mock", " server", "!"]
+
+
+class MockOpenAI:
+    """
+    The mock server.
+
+    Attributes:
+    - latency (float): Seconds before the first byte of a response.
+    - jitter (float): Random extra latency, up to this many seconds.
+    - chunk_delay (float): Seconds between two streamed chunks.
+    - chunks (int): Number of chunks in a reply.
+    - error_rate (float): Fraction of requests that fail with HTTP 500.
+    - rate_limit_rate (float): Fraction of requests that fail with HTTP 429.
+    - stall_rate (float): Fraction of requests that wait `stall_seconds` more before answering.
+    - stall_seconds (float): Extra latency of a stalled request.
+    - requests (int): Number of requests served so far.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.2, chunk_delay=0.05, chunks=40, error_rate=0.0, rate_limit_rate=0.0, stall_rate=0.0, stall_seconds=30.0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.chunks = chunks
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.requests = 0
+        self._runner = None
+
+    def _reply(self):
+        return [REPLY_CHUNKS[i % len(REPLY_CHUNKS)] for i in range(self.chunks)]
+
+    @staticmethod
+    def _error(status, message, type):
+        return web.json_response({"error": {"message": message, "type": type, "param": None, "code": None}}, status=status)
+
+    async def handle(self, request):
+        body = await request.json()
+        self.requests += 1
+        latency = self.latency + random.random() * self.jitter
+        if random.random() < self.stall_rate:
+            latency += self.stall_seconds
+        await asyncio.sleep(latency)
+
+        roll = random.random()
+        if roll < self.error_rate:
+            return self._error(500, "Injected server error.", "server_error")
+        if roll < self.error_rate + self.rate_limit_rate:
+            return self._error(429, "Injected rate limit.", "requests")
+
+        if not body.get("stream"):
+            return web.json_response({
+                "id": f"chatcmpl-{self.requests}",
+                "object": "chat.completion",
+                "model": body.get("model"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(self._reply())}}],
+            })
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for content in self._reply():
+            chunk = {"id": f"chatcmpl-{self.requests}", "object": "chat.completion.chunk", "model": body.get("model"),
+                     "choices": [{"index": 0, "finish_reason": None, "delta": {"content": content}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(self.chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def start(self, host="127.0.0.1", port=8765):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.5,
+                        help="Seconds before the first byte of a response. (Default: 0.5)")
+    parser.add_argument("--jitter", type=float, default=0.2,
+                        help="Random extra latency in seconds. (Default: 0.2)")
+    parser.add_argument("--chunk-delay", type=float, default=0.05,
+                        help="Seconds between two streamed chunks. (Default: 0.05)")
+    parser.add_argument("--chunks", type=int, default=40,
+                        help="Number of chunks in a reply. (Default: 40)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests failing with HTTP 500. (Default: 0)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Fraction of requests failing with HTTP 429. (Default: 0)")
+    parser.add_argument("--stall-rate", type=float, default=0.0,
+                        help="Fraction of requests that stall before answering. (Default: 0)")
+    parser.add_argument("--stall-seconds", type=float, default=30.0,
+                        help="Extra latency of a stalled request. (Default: 30)")
+
+
+def from_arguments(args):
+    return MockOpenAI(args.latency, args.jitter, args.chunk_delay, args.chunks, args.error_rate, args.rate_limit_rate,
+                      args.stall_rate, args.stall_seconds)
+
+
+async def main(args):
+    server = from_arguments(args)
+    await server.start(port=args.port)
+    print(f"Serving on http://127.0.0.1:{args.port}/v1")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765,
+                        help="Port to listen on. (Default: 8765)")
+    add_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
@@ -1,30 +1,59 @@
 """
 Naichen bot main file. This file is the entry point of the bot. 
 It will load all extensions in ./cogs/ and start the bot. 
-It will also switch avatar to day or night avatar at 06:00 and 18:00. 
+It will also switch avatar to day or night avatar at 06:00 and 18:00 with the timer scheduler. 
 The avatar images are stored in ./img/ folder. 
 The bot will also change its status to "listening to 後藤さんの呪いだわ..." 
 and its activity to "online" when it starts.
+To run several processes that each own a range of shards, start the bot with cluster.py.
 """
+import time
+START_TIME = time.perf_counter()
+
 import os
+import json
+import hashlib
 import logging
 import discord
 import argparse
-from discord.ext import commands, tasks
+from discord.ext import commands
 from datetime import datetime
 import asyncio
 import assets.settings.setting as setting
+from assets.utils.log_writer import log_writer
+from assets.utils.completion import completion_client
+from assets.utils.snapshot import session_journal
+from assets.utils.session import session_router
+from assets.utils.metrics import metrics, METRICS_PORT
+from assets.utils.timers import timers
+from assets.utils.scheduler import request_scheduler
+from assets.utils.cluster import open_backend, HEALTH_INTERVAL
+from assets.utils.archive import conversation_archive, ARCHIVE_INTERVAL
+from assets.utils.memory import remove_spill_files
+
+IMPORTED_TIME = time.perf_counter()
 
 logger = setting.logging.getLogger("bot")
 token = os.getenv("BOT_TOKEN")
 
 DAY_TIME = "06:00"
 NIGHT_TIME = "18:00"
+# Retries of a failed avatar switch, the delay doubles after every attempt.
+AVATAR_RETRIES = 5
+AVATAR_RETRY_DELAY = 30
+
+# Hash of the last app command tree synced to Discord.
+COMMAND_TREE_HASH_PATH = "assets/logs/command_tree.sha256"
 
 
-class Bot(commands.Bot):
-    def __init__(self, debug: bool = False):
+class Bot(commands.AutoShardedBot):
+    def __init__(self, debug: bool = False, force_sync: bool = False, shard_ids=None, shard_count=None, cluster_id: int = 0):
         self.debug = debug
+        self.force_sync = force_sync
+        # Index of this process in the cluster, 0 when the bot runs alone.
+        self.cluster_id = cluster_id
+        # State shared by the processes of the cluster, None when the bot runs alone.
+        self.state_backend = None
 
         intents = discord.Intents.default()
         intents.members = True
@@ -39,39 +68,169 @@ class Bot(commands.Bot):
             description="Naichen bot.",
             activity=discord.Activity(
                 type=discord.ActivityType.listening, name="後藤さんの呪いだわ..."),
-            status=discord.Status.online
+            status=discord.Status.online,
+            shard_ids=shard_ids,
+            shard_count=shard_count
         )
 
         self.day_avatar = "assets/img/day_bocchi.jpg"
         self.night_avatar = "assets/img/night_bocchi.jpg"
+        # Read the images once, switching only has to upload them.
+        self.avatar_images = {}
+        for state, path in (("day", self.day_avatar), ("night", self.night_avatar)):
+            with open(path, 'rb') as image:
+                self.avatar_images[state] = image.read()
 
         self.init_avatar()
 
     async def on_ready(self):
         logger.info(f'Logged in as {self.user} (ID: {self.user.id})')
+        logger.info(
+            f"Shards {sorted(self.shards)} of {self.shard_count}, {len(self.guilds)} guilds.")
+        logger.info(
+            f"Ready {time.perf_counter() - START_TIME:.2f}s after start.")
+
+    async def on_message(self, message):
+        if message.author == self.user:
+            # message author is not the bot itself
+            return
+        await self.process_commands(message)
+        # Chat and questionnaire threads are handled by the session registered for the thread.
+        await session_router.dispatch(message)
 
     async def setup_hook(self) -> None:
         """Setup hook for bot startup. This is called before the bot starts the main loop."""
-        self.update_avatar.start()
-        await load_extensions()
+        timings = {"imports": IMPORTED_TIME - START_TIME,
+                   "login": time.perf_counter() - IMPORTED_TIME}
+        start = time.perf_counter()
+        timers.every_day(DAY_TIME, lambda: self.switch_avatar(is_day=True))
+        timers.every_day(NIGHT_TIME, lambda: self.switch_avatar(is_day=False))
+        metrics.instrument_http(self.http)
+        if METRICS_PORT:
+            await metrics.start_server(port=METRICS_PORT + self.cluster_id)
+        self.state_backend = open_backend()
+        if self.state_backend is not None:
+            request_scheduler.backend = self.state_backend
+            timers.call_later(HEALTH_INTERVAL, self.report_health)
+        # Restore in-flight sessions before the cogs load and before the gateway connects.
+        # Their histories come from the journal, so the spill files of the previous run are stale.
+        await asyncio.to_thread(remove_spill_files)
+        session_journal.restore()
+        timings["restore"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        extension_timings = await load_extensions()
+        timings["extensions"] = time.perf_counter() - start
+
+        # Commands are global and the conversation logs are shared, one process of the cluster syncs and compacts for all.
+        if self.cluster_id == 0:
+            timers.call_later(ARCHIVE_INTERVAL, conversation_archive.run)
+            start = time.perf_counter()
+            await self.sync_commands()
+            timings["sync"] = time.perf_counter() - start
+
+        logger.info("Startup timings: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()) +
+                    " (" + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in extension_timings.items()) + ")")
+
+    def command_tree_hash(self):
+        """Hash of the global app commands, as they would be sent to Discord."""
+        payload = [command.to_dict()
+                   for command in self.tree.get_commands()]
+        payload.sort(key=lambda command: (
+            command.get("type", 1), command["name"]))
+        data = json.dumps([self.application_id, payload],
+                          sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    async def sync_commands(self):
+        """Sync the global app commands, unless they are the same as the last synced ones."""
+        tree_hash = self.command_tree_hash()
+        if not self.force_sync and os.path.exists(COMMAND_TREE_HASH_PATH):
+            with open(COMMAND_TREE_HASH_PATH, "r", encoding="utf-8") as f:
+                if f.read().strip() == tree_hash:
+                    logger.info("Commands unchanged, skipping global sync.")
+                    return
         logger.info("Syncing command to global...")
         cmds = await self.tree.sync()
         logger.info(f"{len(cmds)} commands synced!")
+        with open(COMMAND_TREE_HASH_PATH, "w", encoding="utf-8") as f:
+            f.write(tree_hash)
 
-    def switch_avatar(self, is_day: True):
-        """Switch avatar to day or night avatar."""
-        if is_day:
-            with open(self.day_avatar, 'rb') as image:
-                asyncio.get_event_loop().create_task(self.user.edit(avatar=image.read()))
-                logger.info(
-                    f'{self.user} changed its avatar to {self.day_avatar}!')
-                self.day_night_state = "day"
-        else:
-            with open(self.night_avatar, 'rb') as image:
-                asyncio.get_event_loop().create_task(self.user.edit(avatar=image.read()))
-                logger.info(
-                    f'{self.user} changed its avatar to {self.night_avatar}!')
-                self.day_night_state = "night"
+    def health(self):
+        """Health of this process and of each of its shards."""
+        guilds = {}
+        for guild in self.guilds:
+            guilds[guild.shard_id] = guilds.get(guild.shard_id, 0) + 1
+        shards = {}
+        for shard_id, shard in self.shards.items():
+            latency = shard.latency
+            shards[shard_id] = {
+                "latency": None if latency != latency or latency == float("inf") else round(latency * 1000),
+                "closed": shard.is_closed(),
+                "guilds": guilds.get(shard_id, 0),
+            }
+        return {
+            "pid": os.getpid(),
+            "ready": self.is_ready(),
+            "shard_count": self.shard_count,
+            "shards": shards,
+            "sessions": len(session_router),
+            "queued_requests": request_scheduler.size,
+            "updated": time.time(),
+        }
+
+    def owns_guild(self, guild_id):
+        """
+        Whether the guild is on one of the shards of this process, computed like Discord does, so it works before ready.
+        Without a guild only a process that runs every shard owns it.
+        """
+        if self.shard_ids is None:
+            return True
+        if guild_id is None:
+            return False
+        return (guild_id >> 22) % self.shard_count in self.shard_ids
+
+    async def report_health(self):
+        """Write the health of this process to the shared state, then again every HEALTH_INTERVAL seconds."""
+        if self.is_closed():
+            return
+        try:
+            await self.state_backend.report_health(self.cluster_id, self.health())
+        except Exception as e:
+            logger.warning(f"Failed to report health: {e}")
+        timers.call_later(HEALTH_INTERVAL, self.report_health)
+
+    async def close(self) -> None:
+        """Flush buffered conversation logs and close the completion client before shutting down."""
+        await timers.close()
+        await log_writer.close()
+        await completion_client.close()
+        await metrics.stop_server()
+        await asyncio.to_thread(conversation_archive.close)
+        if self.state_backend is not None:
+            await self.state_backend.close()
+        await super().close()
+
+    async def switch_avatar(self, is_day: bool, attempt: int = 0):
+        """Switch avatar to day or night avatar. A failed switch is retried later with a growing delay."""
+        state = "day" if is_day else "night"
+        if self.is_closed() or self.day_night_state == state:
+            return
+        try:
+            await self.user.edit(avatar=self.avatar_images[state])
+        except Exception as e:
+            if attempt >= AVATAR_RETRIES:
+                logger.error(f"Failed to change avatar to {state}: {e}")
+                return
+            delay = AVATAR_RETRY_DELAY * 2 ** attempt
+            logger.warning(
+                f"Failed to change avatar to {state}, retrying in {delay}s: {e}")
+            timers.call_later(delay, lambda: self.switch_avatar(
+                is_day, attempt + 1))
+            return
+        self.day_night_state = state
+        logger.info(
+            f'{self.user} changed its avatar to {self.day_avatar if is_day else self.night_avatar}!')
 
     def init_avatar(self):
         """Initialize avatar to day or night avatar."""
@@ -86,31 +245,36 @@ class Bot(commands.Bot):
         else:
             self.day_night_state = "night"
 
-    @tasks.loop(seconds=10)
-    async def update_avatar(self):
-        """Update avatar to day or night avatar."""
-        if bot.is_closed():
-            logger.warn(f'{self.user} is offline now!')
-            return
 
-        now = datetime.strftime(datetime.now(), '%H:%M')
-        if now == DAY_TIME and bot.day_night_state == "night":
-            bot.switch_avatar(is_day=True)
-        elif now == NIGHT_TIME and bot.day_night_state == "day":
-            bot.switch_avatar(is_day=False)
+async def load_extensions():
+    """Load all extensions in ./cogs/ concurrently. Returns the seconds each extension took to load."""
+    timings = {}
 
+    async def load(name):
+        start = time.perf_counter()
+        await bot.load_extension("cogs." + name)
+        timings[name] = time.perf_counter() - start
 
-async def load_extensions():
-    """Load all extensions in ./cogs/"""
-    for f in os.listdir("./cogs"):
-        if f.endswith(".py"):
-            await bot.load_extension("cogs." + f[:-3])
+    await asyncio.gather(*(load(f[:-3]) for f in sorted(os.listdir("./cogs")) if f.endswith(".py")))
+    return timings
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug', action='store_true',
                         help='Enable debug mode. (Default: False)')
+    parser.add_argument('--sync', action='store_true',
+                        help='Sync app commands even if they did not change. (Default: False)')
+    parser.add_argument('--shard-ids', type=lambda ids: [int(i) for i in ids.split(",")],
+                        help='Comma separated shards run by this process, needs --shard-count. (Default: all)')
+    parser.add_argument('--shard-count', type=int,
+                        help='Total number of shards. (Default: recommended by Discord)')
+    parser.add_argument('--cluster-id', type=int, default=0,
+                        help='Index of this process in the cluster. (Default: 0)')
     args = parser.parse_args()
 
-    bot = Bot(debug=args.debug)
+    if args.cluster_id:
+        # Every process of the cluster restores and rewrites its own journal.
+        session_journal.path = f"assets/logs/sessions-{args.cluster_id}.jsonl"
+    bot = Bot(debug=args.debug, force_sync=args.sync, shard_ids=args.shard_ids,
+              shard_count=args.shard_count, cluster_id=args.cluster_id)
     bot.run(token, root_logger=True)
@@ -0,0 +1,197 @@
+"""
+Cluster launcher. Runs the bot in several processes, each owning a contiguous range of shards,
+so the gateway traffic, token counting and JSON handling of the whole deployment are spread over several cores.
+
+The processes share the OpenAI rate limits and their health reports through a state backend:
+- sqlite: a SQLite file on this host. (Default)
+- redis: a Redis server given by --redis-url, or a small in-memory stand-in served by the launcher.
+The PsyGPT database is a SQLite file in WAL mode and is shared as is. Chat and questionnaire sessions live in
+threads, and every thread belongs to the guild of one shard, so each process keeps its own sessions and journal.
+
+A process that exits is restarted with a growing delay. The health of every process and shard is logged
+every HEALTH_LOG_INTERVAL seconds.
+
+Usage: python cluster.py --processes 4 --shard-count 8 --backend redis
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import argparse
+import aiohttp
+import assets.settings.setting as setting
+from assets.utils.cluster import MiniRedis, open_backend, format_health
+
+logger = setting.logging.getLogger("bot")
+token = os.getenv("BOT_TOKEN")
+
+STATE_SQLITE_PATH = "assets/database/cluster.sqlite3"
+MINI_REDIS_PORT = 6399
+HEALTH_LOG_INTERVAL = 60
+# A process that exits is restarted after this many seconds, doubling up to MAX_RESTART_DELAY.
+RESTART_DELAY = 5
+MAX_RESTART_DELAY = 300
+# A process that ran this long before exiting is restarted after RESTART_DELAY again.
+STABLE_SECONDS = 600
+# Seconds a process gets to close after SIGINT before it is killed.
+SHUTDOWN_TIMEOUT = 30
+
+
+def shard_ranges(shard_count, processes):
+    """Split the shards into `processes` contiguous ranges of nearly equal size."""
+    processes = min(processes, shard_count)
+    return [list(range(i * shard_count // processes, (i + 1) * shard_count // processes))
+            for i in range(processes)]
+
+
+async def recommended_shard_count():
+    """The number of shards Discord recommends for the bot."""
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot",
+                               headers={"Authorization": f"Bot {token}"}) as response:
+            response.raise_for_status()
+            return (await response.json())["shards"]
+
+
+class ClusterProcess:
+    """
+    One bot process of the cluster, restarted when it exits.
+
+    Attributes:
+    - cluster_id (int): Index of the process in the cluster.
+    - shard_ids (list): Shards run by the process.
+    - command (list): Command line of the process.
+    - restarts (int): Restarts since the process last ran for STABLE_SECONDS.
+    """
+
+    def __init__(self, cluster_id, shard_ids, shard_count, debug=False, force_sync=False) -> None:
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.command = [sys.executable, "bot.py", "--cluster-id", str(cluster_id),
+                        "--shard-ids", ",".join(map(str, shard_ids)), "--shard-count", str(shard_count)]
+        if debug:
+            self.command.append("--debug")
+        if force_sync and cluster_id == 0:
+            self.command.append("--sync")
+        self.restarts = 0
+        self.process = None
+
+    async def run(self, env, stopping):
+        """Run the process until `stopping` is set, restarting it whenever it exits."""
+        while not stopping.is_set():
+            started = time.monotonic()
+            # In its own session, so only the launcher forwards Ctrl+C and the process is not interrupted twice.
+            self.process = await asyncio.create_subprocess_exec(
+                *self.command, env=dict(env, CLUSTER_ID=str(self.cluster_id)), start_new_session=True)
+            logger.info(
+                f"Started cluster {self.cluster_id} (pid {self.process.pid}) with shards {self.shard_ids}.")
+            code = await self.process.wait()
+            if stopping.is_set():
+                break
+            if time.monotonic() - started >= STABLE_SECONDS:
+                self.restarts = 0
+            delay = min(RESTART_DELAY * 2 ** self.restarts, MAX_RESTART_DELAY)
+            self.restarts += 1
+            logger.warning(
+                f"Cluster {self.cluster_id} exited with code {code}, restarting in {delay}s.")
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        if self.process is None or self.process.returncode is not None:
+            return
+        # bot.py closes cleanly on KeyboardInterrupt.
+        self.process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Cluster {self.cluster_id} did not close in {SHUTDOWN_TIMEOUT}s, killing it.")
+            self.process.kill()
+            await self.process.wait()
+
+
+async def log_health(backend, processes, stopping):
+    while not stopping.is_set():
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=HEALTH_LOG_INTERVAL)
+            return
+        except asyncio.TimeoutError:
+            pass
+        try:
+            health = await backend.health()
+        except Exception as e:
+            logger.warning(f"Failed to read cluster health: {e}")
+            continue
+        # Reports of a previous, larger cluster may still be in the backend.
+        health = {cluster_id: report for cluster_id, report in health.items()
+                  if cluster_id < processes}
+        lines, unhealthy = format_health(health)
+        missing = processes - len(health)
+        if missing:
+            unhealthy = True
+            lines.append(f"{missing} processes have not reported yet")
+        (logger.warning if unhealthy else logger.info)(
+            "Cluster health:\n" + "\n".join(lines))
+
+
+async def main(args):
+    shard_count = args.shard_count or await recommended_shard_count()
+    ranges = shard_ranges(shard_count, args.processes)
+    logger.info(
+        f"Running {shard_count} shards in {len(ranges)} processes with the {args.backend} backend.")
+
+    mini_redis = None
+    if args.backend == "sqlite":
+        url = f"sqlite:{STATE_SQLITE_PATH}"
+    elif args.redis_url:
+        url = args.redis_url
+    else:
+        mini_redis = MiniRedis()
+        await mini_redis.start(port=MINI_REDIS_PORT)
+        url = f"redis://127.0.0.1:{MINI_REDIS_PORT}"
+    env = dict(os.environ, STATE_BACKEND=url)
+    backend = open_backend(url)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    cluster = [ClusterProcess(cluster_id, shard_ids, shard_count, args.debug, args.sync)
+               for cluster_id, shard_ids in enumerate(ranges)]
+    tasks = [asyncio.create_task(process.run(env, stopping))
+             for process in cluster]
+    tasks.append(asyncio.create_task(
+        log_health(backend, len(cluster), stopping)))
+    try:
+        await stopping.wait()
+        logger.info("Stopping the cluster...")
+        await asyncio.gather(*(process.stop() for process in cluster))
+        await asyncio.gather(*tasks)
+    finally:
+        await backend.close()
+        if mini_redis is not None:
+            await mini_redis.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the bot in several processes, each owning a range of shards.")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="Number of bot processes. (Default: number of cores)")
+    parser.add_argument("--shard-count", type=int,
+                        help="Total number of shards. (Default: recommended by Discord)")
+    parser.add_argument("--backend", choices=("sqlite", "redis"), default="sqlite",
+                        help="Where the processes share state. (Default: sqlite)")
+    parser.add_argument("--redis-url",
+                        help="Redis server of the redis backend, e.g. redis://127.0.0.1:6379. "
+                             "(Default: an in-memory stand-in served by the launcher)")
+    parser.add_argument("--debug", action="store_true",
+                        help="Enable debug mode in every process. (Default: False)")
+    parser.add_argument("--sync", action="store_true",
+                        help="Sync app commands even if they did not change. (Default: False)")
+    asyncio.run(main(parser.parse_args()))
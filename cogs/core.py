@@ -3,11 +3,21 @@ Core commands cog.
 """
 
 from discord.ext import commands
+from assets.utils.metrics import metrics
+from assets.utils.threads import ThreadCleaner, list_threads
+from assets.utils.cluster import format_health
 import assets.settings.setting as setting
 
 logger = setting.logging.getLogger("core")
 
 
+class CleanupFlags(commands.FlagConverter):
+    """Filters of delete_all_threads, e.g. `!delete_all_threads hours: 24 bot_only: true`."""
+    hours: float = 0.0
+    bot_only: bool = False
+    archived: bool = True
+
+
 class Core(commands.Cog):
 
     def __init__(self, bot):
@@ -21,14 +31,44 @@ class Core(commands.Cog):
         fmt = await ctx.bot.tree.sync()
         await ctx.send(f"Synced {len(fmt)} commands to current guild.")
 
+    @commands.command(name="metrics")
+    @commands.has_permissions(administrator=True)
+    async def _metrics(self, ctx):
+        """Show latency, token and session metrics."""
+        summary = metrics.summary() or "No metrics yet."
+        await ctx.send(f"```\n{summary[:1900]}\n```")
+
+    @commands.command(name="cluster")
+    @commands.has_permissions(administrator=True)
+    async def _cluster(self, ctx):
+        """Show the health of every process and shard of the cluster."""
+        if self.bot.state_backend is None:
+            health = {self.bot.cluster_id: self.bot.health()}
+        else:
+            health = await self.bot.state_backend.health()
+        lines, _ = format_health(health)
+        await ctx.send("```\n" + "\n".join(lines)[:1900] + "\n```")
+
     @commands.command(name="delete_all_threads")
     @commands.has_permissions(administrator=True)
-    async def _delete_all_threads(self, ctx):
+    async def _delete_all_threads(self, ctx, *, flags: CleanupFlags):
+        """Delete the active and archived threads of this channel, except the ones with a chat in progress."""
+        cleaner = ThreadCleaner(
+            owner_id=self.bot.user.id if flags.bot_only else None, older_than=flags.hours)
         try:
-            for thread in ctx.channel.threads:
-                await thread.delete()
-            logger.debug("Deleted all threads.")
-            await ctx.send("成功刪除所有討論串！")
+            threads = await list_threads(ctx.channel, archived=flags.archived)
+            progress = await ctx.send(f"正在刪除討論串...（共 {len(threads)} 個）")
+
+            async def report(done, total):
+                await progress.edit(content=f"正在刪除討論串...（{done}/{total}）")
+
+            total = await cleaner.run(threads, on_progress=report)
+            logger.debug("Deleted %d of %d threads in %d.", cleaner.deleted, total, ctx.channel.id,
+                         extra={"guild_id": ctx.guild.id, "user_id": ctx.author.id})
+            if cleaner.failed:
+                await progress.edit(content=f"已刪除 {cleaner.deleted}/{total} 個討論串，{cleaner.failed} 個刪除失敗。")
+                return False
+            await progress.edit(content=f"成功刪除 {cleaner.deleted} 個討論串！")
             return True
         except Exception as e:
             logger.error(f"Failed to delete all threads: {e}")
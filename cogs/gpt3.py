@@ -3,19 +3,19 @@ This file contains a cog for the GPT-3 helper commands.
 """
 
 import os
-import json
 import asyncio
 import openai
 import discord
 from discord.ext import commands
 from typing import List, Optional
 from collections import deque
-from assets.utils.chat import CharacterSelectMenuView, User, CharacterConversation, generate_conversation, num_tokens_from_messages
+from assets.utils.chat import CharacterSelectMenuView, User, CharacterConversation, reply_turn, stream_conversation, stream_text, release_edit_budget
+from assets.utils.persona import persona_registry
+from assets.utils.snapshot import session_journal
+from assets.utils.metrics import metrics
+from assets.utils.session import session_router, DEBOUNCE_SECONDS, CHAT_IDLE_TIMEOUT
 import assets.settings.setting as setting
 
-character_info = json.load(
-    open("assets/settings/character_info.json", "r", encoding="utf-8"))
-
 logger = setting.logging.getLogger("gpt3")
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -28,13 +28,11 @@ class GPT3Helper(commands.Cog):
     - bot (commands.Bot): The bot instance.
     - chatting_users (dict): A dictionary to store the user who is currently chatting in a thread with the bot.
     - chatting_threads (dict): A dictionary to store the thread in which the bot is currently chatting with a user.
-    - chat_flag (bool): A flag to indicate whether the chat function in on_message is on or off.
-    - conversation (str): The full conversation prompt.
-    - content (collections.deque): A deque to store the last 5 messages sent in the chat channel.
+    - chatting_start_message (dict): The message that announced each user's chat thread.
 
     Methods:
-    - update_conversation: Update the conversation prompt. Read original conversation material from disk and append conversations from a deque.
-    - auto_shutup: A coroutine to turn off the chat function after 10 minutes.
+    - handle_message: Reply to a turn of the user in their chat thread.
+    - expire_conversation: Close a chat after CHAT_IDLE_TIMEOUT seconds without a message of the user.
 
     Commands:
     - update_api_key: Set the OpenAI API key.
@@ -49,58 +47,78 @@ class GPT3Helper(commands.Cog):
         self.chatting_threads = {}
         self.chatting_start_message = {}
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
-        if message.author == self.bot.user:
-            # message author is not the bot itself
-            return
-        if not message.guild:
-            # message is from a dm
+    async def cog_load(self):
+        await asyncio.to_thread(persona_registry.load)
+        persona_registry.start_watching()
+        self.restore_sessions()
+
+    def restore_sessions(self):
+        """Rebuild the chats that were in flight before the restart from the session journal."""
+        for key, session in session_journal.take("gpt3:").items():
+            data = session["data"]
+            if data["persona"] not in persona_registry:
+                session_journal.close(key)
+                continue
+            user_id = int(key.split(":", 1)[1])
+            user = User(user_id, data["persona"],
+                        debug=self.bot.debug, log_path=data["log_path"], restored=True)
+            user.conversation.restore(session)
+            user.conversation.journal_key = key
+            channel_id, message_id = data["start"]
+            self.chatting_users[user_id] = user
+            self.chatting_threads[user_id] = data["thread"]
+            self.chatting_start_message[user_id] = self.bot.get_partial_messageable(
+                channel_id).get_partial_message(message_id)
+            session_router.register(data["thread"], user_id, self.handle_message, debounce=DEBOUNCE_SECONDS,
+                                    on_idle=self.expire_conversation, idle_timeout=CHAT_IDLE_TIMEOUT)
+
+    async def cog_unload(self):
+        persona_registry.stop_watching()
+
+    async def handle_message(self, message, content):
+        """Reply to a turn of the user in their chat thread. Called by the session router, one turn at a time."""
+        user = self.chatting_users[message.author.id]
+        prompt = await user.conversation.aprepare_prompt(content)
+
+        if self.bot.debug:
+            logger.debug("Prompt:\n%s", setting.LazyJson(prompt))
+            logger.debug("Tokens: %d", user.conversation.prompt_tokens)
+
+        if user.conversation.prompt_tokens > user.conversation.token_budget:
+            # Older turns are summarized, so only a single oversized message can exceed the budget.
+            user.conversation.pop_last()
+            await message.reply("訊息過長，請縮短後再試一次。")
             return
-        if message.author.id in self.chatting_users \
-                and message.author.id in self.chatting_threads \
-                and message.channel.id == self.chatting_threads[message.author.id]:
-            # message is from a chatting user
-
-            user = self.chatting_users[message.author.id]
-            prompt = user.conversation.prepare_prompt(message.content)
-
-            if self.bot.debug:
-                logger.debug(f"\n\n{user.conversation}\n\n")
-                logger.debug(f"Tokens: {num_tokens_from_messages(prompt)}")
-
-            if num_tokens_from_messages(prompt) > 3500:
-                await message.reply("對話過長，請重新開始對話。")
-                await self.end_conversation(message)
-                return
-
-            try:
-                async with message.channel.typing():
-                    if self.bot.debug:
-                        if message.content == "掰掰":
-                            # Debuging chat exit function
-                            completion = "掰掰"
-                        else:
-                            # Debuging reply function
-                            completion = "這是一個測試回應。為了避免過度使用 OpenAI API，這個回應是從本地讀取的。"
-                    else:
-                        completion = await generate_conversation(prompt)
-            except Exception as e:
-                logger.error(f"Failed to generate conversation: {e}")
-                await message.reply(f"生成對話時發生錯誤：{e}")
 
-            if completion == "":
-                await message.reply("沒有生成任何回應。")
-                return
+        if self.bot.debug:
+            if content == "掰掰":
+                # Debuging chat exit function
+                chunks = stream_text("掰掰")
+            else:
+                # Debuging reply function
+                chunks = stream_text(
+                    "這是一個測試回應。為了避免過度使用 OpenAI API，這個回應是從本地讀取的。")
+        else:
+            persona = user.conversation.persona
+            chunks = stream_conversation(
+                prompt, cache_namespace=persona.key if persona.cacheable else None,
+                requester=(message.guild.id, message.author.id), prompt_tokens=user.conversation.prompt_tokens)
+        completion = await reply_turn(user.conversation, message, chunks, reference=message)
+        if completion is None:
+            return
 
-            user.conversation.append_response(completion)
-            await message.reply(completion)
+        user.conversation.append_response(completion)
+        session_router.answered(message.channel.id)
+        metrics.inc("tokens_total", user.conversation.prompt_tokens,
+                    cog="gpt3", persona=user.conversation.persona.key, kind="prompt")
+        metrics.inc("tokens_total", user.conversation.last_tokens,
+                    cog="gpt3", persona=user.conversation.persona.key, kind="completion")
 
-            # If the bot reply with "掰掰", end the conversation
-            if "掰掰" in completion:
-                logger.debug("Quitting Chat...")
-                await asyncio.sleep(3)
-                await self.end_conversation(message)
+        # If the bot reply with "掰掰", end the conversation
+        if "掰掰" in completion:
+            logger.debug("Quitting Chat...")
+            await asyncio.sleep(3)
+            await self.end_conversation(message)
 
     @commands.command(name="update_gpt3_api_key")
     @commands.has_permissions(administrator=True)
@@ -127,10 +145,11 @@ class GPT3Helper(commands.Cog):
             logger.info("Character selection view timeout")
             return
 
-        logger.debug(
-            f"Creating thread to chat with {view.value} for {ctx.author.name}")
-        character_name = character_info[view.value]["name"]
-        character_greeting = character_info[view.value]["greeting"]
+        logger.debug("Creating thread to chat with %s for %s",
+                     view.value, ctx.author.name)
+        persona = persona_registry[view.value]
+        character_name = persona.name
+        character_greeting = persona.greeting
 
         thread_name = ctx.author.name + f" 與{character_name}的聊天室"
         message_thread = await ctx.channel.send(f"正在創建聊天室...")
@@ -140,10 +159,16 @@ class GPT3Helper(commands.Cog):
         )
         await message_thread.edit(content=f"聊天室已創建！")
 
-        self.chatting_users[ctx.author.id] = User(
-            ctx.author.id, view.value, debug=self.bot.debug)
+        user = User(ctx.author.id, view.value, debug=self.bot.debug)
+        key = f"gpt3:{ctx.author.id}"
+        session_journal.open(key, persona=view.value, thread=thread.id,
+                             start=[message_thread.channel.id, message_thread.id], log_path=user.conversation.log_path)
+        user.conversation.journal_key = key
+        self.chatting_users[ctx.author.id] = user
         self.chatting_threads[ctx.author.id] = thread.id
         self.chatting_start_message[ctx.author.id] = message_thread
+        session_router.register(thread.id, ctx.author.id, self.handle_message, debounce=DEBOUNCE_SECONDS,
+                                on_idle=self.expire_conversation, idle_timeout=CHAT_IDLE_TIMEOUT)
 
         await thread.send(character_greeting)
 
@@ -158,16 +183,30 @@ class GPT3Helper(commands.Cog):
             return False
 
     async def end_conversation(self, message):
-        if message.author.id in self.chatting_threads:
-            thread_id = self.chatting_threads[message.author.id]
-            await self.chatting_start_message[message.author.id].edit(content="聊天室已關閉！")
-
-            del self.chatting_start_message[message.author.id]
-            del self.chatting_users[message.author.id]
-            del self.chatting_threads[message.author.id]
+        await self.close_conversation(message.author.id)
+
+    async def close_conversation(self, user_id, notice="聊天室已關閉！"):
+        if user_id in self.chatting_threads:
+            thread_id = self.chatting_threads[user_id]
+            start_message = self.chatting_start_message.pop(user_id)
+            self.chatting_users.pop(user_id).conversation.close()
+            del self.chatting_threads[user_id]
+            session_router.unregister(thread_id)
+            release_edit_budget(thread_id)
+            session_journal.close(f"gpt3:{user_id}")
+            try:
+                await start_message.edit(content=notice)
+            except Exception as e:
+                logger.error(f"Failed to edit start message: {e}")
             # Attempt to close and lock the thread.
             await self.close_thread(thread_id)
 
+    async def expire_conversation(self, session):
+        """Close a chat whose user has been silent for too long."""
+        if self.chatting_threads.get(session.user_id) != session.thread_id:
+            return
+        await self.close_conversation(session.user_id, notice="聊天室因閒置過久已關閉！")
+
 
 async def setup(client):
     await client.add_cog(GPT3Helper(client))
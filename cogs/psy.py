@@ -4,14 +4,18 @@ This file contains a cog for AI psychotherapy assistant commands.
 
 import os
 import json
-import time
 import asyncio
 import openai
 import discord
 from discord.ui import View, Button
 from discord.ext import commands
-from asgiref.sync import sync_to_async
-from assets.utils.chat import Conversation, generate_conversation, num_tokens_from_messages
+from assets.utils.chat import Conversation, reply_turn, stream_conversation, stream_text, release_edit_budget
+from assets.utils.analysis import personality_analyze
+from assets.utils.archive import history_path
+from assets.utils.storage import PsyDatabase
+from assets.utils.snapshot import session_journal
+from assets.utils.metrics import metrics
+from assets.utils.session import session_router, DEBOUNCE_SECONDS, CHAT_IDLE_TIMEOUT, QUESTIONNAIRE_IDLE_TIMEOUT
 import assets.settings.setting as setting
 
 logger = setting.logging.getLogger("psy")
@@ -23,17 +27,28 @@ class PsyGPT(commands.Cog):
     """Cog for PsyGPT commands.
     """
 
-    def __init__(self, bot):
+    def __init__(self, bot, database_dir="assets/database"):
         self.bot = bot
 
-        self.database_path = "assets/database/psygpt_database.json"
-        self.questions_path = "assets/database/questions.json"
+        self.database_path = os.path.join(database_dir, "psygpt.sqlite3")
+        self.legacy_database_path = os.path.join(
+            database_dir, "psygpt_database.json")
+        self.questions_path = os.path.join(database_dir, "questions.json")
 
-        self.load_database()
+        self.database = PsyDatabase(self.database_path)
+        # The processes of a cluster share the database, so only the first one imports the legacy file.
+        if bot.cluster_id == 0:
+            self.database.migrate_json(self.legacy_database_path)
         self.load_questions()
 
-        self.questionnaire_threads = {}
+        # In-progress questionnaires by user ID, restored from their checkpoints. The database is shared by the
+        # cluster, so only the questionnaires in guilds of this process's shards are restored; any other process
+        # would never see their messages and expire them while they are still answered.
+        self.questionnaire_threads = {user_id: state for user_id, state in self.database.questionnaires().items()
+                                      if bot.owns_guild(state["guild_id"])}
         self.chatting_threads = {}
+        # Analyses running in the background, kept so they are not garbage collected.
+        self.analyses = set()
 
     def load_questions(self):
         if not os.path.exists(self.questions_path):
@@ -44,149 +59,132 @@ class PsyGPT(commands.Cog):
         self.questions = json.load(
             open(self.questions_path, "r", encoding="utf-8"))
 
-    def load_database(self):
-        if not os.path.exists(self.database_path):
-            logger.info(
-                f"Database file {self.database_path} does not exist. Creating one...")
-            with open(self.database_path, "w", encoding="utf-8") as f:
-                json.dump({}, f)
-        self.database = json.load(
-            open(self.database_path, "r", encoding="utf-8"))
-
-    def write_database(self):
-        json.dump(self.database, open(
-            self.database_path, "w", encoding="utf-8"), indent=4)
-
-    @commands.Cog.listener()
-    async def on_message(self, ctx):
-        if ctx.author == self.bot.user:
-            # message author is not the bot itself
-            return
-        if not ctx.guild:
-            # message is from a dm
-            return
-        if ctx.author.id in self.questionnaire_threads \
-                and ctx.channel.id == self.questionnaire_threads[ctx.author.id]["thread_id"]:
-            # Questionnaire thread
-
-            # Delete any message inside this thread that is not belong to the bot or the user.
-            async for msg in ctx.channel.history(limit=None, oldest_first=True):
-                if msg.author.id != ctx.author.id and msg.author.id != self.bot.user.id:
-                    await msg.delete()
-
-            user_discriminator = ctx.author.name + "#" + ctx.author.discriminator
-            if self.questionnaire_threads[ctx.author.id]["counter"] == len(self.questions):
-                # Make a list of all user messages in this thread in order.
-                user_messages = []
-                async for msg in ctx.channel.history(limit=None, oldest_first=True):
-                    if msg.author.id == ctx.author.id:
-                        user_messages.append(msg)
-
-                self.database[user_discriminator] = {
-                    "id": ctx.author.id,
-                    "questions": self.questions,
-                    "answers": [msg.content for msg in user_messages]
-                }
-                self.write_database()
-                # Delete this user in chatting_thread
-                del self.questionnaire_threads[ctx.author.id]
-
-                logger.info(f"Saved user {user_discriminator}'s data.")
-
-                # TODO: Analyze the qa and make a report here.
-                # Pseudo code:
-                report = await personality_analyze(
-                    self.database[user_discriminator]["questions"],
-                    self.database[user_discriminator]["answers"],
-                    debug=self.bot.debug
-                )
-                self.database[user_discriminator]["report"] = report
-
-                # TODO: Analyze the qa and generate a chat system prompt.
-                self.database[user_discriminator]["chat_system_message"] = "你是一位熱於助人的AI助理，你的名字叫做奶辰，你是一位軟體工程師，若人類詢問你和軟體技術相關的問題，請你將人類的需求拆成一個個小問題，並且將這些問題的答案組合起來成最佳解答，回答人類的問題，並且告訴人類為何你的答案是最佳解答。確保你的答案是正確的，並且不會對人類造成傷害。若人類與你道別，請一律回答“掰掰”。若遇到專有名詞可以使用原文並以繁體中文解釋輔助，其餘請全程使用繁體中文回答。"
-
-                self.write_database()
-
-                await ctx.channel.send("分析已完成！將於5秒後自動關閉此討論串。")
-                await asyncio.sleep(5)
-                await self.close_thread(ctx.channel.id)
-            else:
-                await ctx.channel.send(self.questions[self.questionnaire_threads[ctx.author.id]["counter"]])
-                self.questionnaire_threads[ctx.author.id]["counter"] += 1
-
-        elif ctx.author.id in self.chatting_threads \
-                and ctx.channel.id == self.chatting_threads[ctx.author.id]["thread_id"]:
-            # Chatting thread
-
-            conv = self.chatting_threads[ctx.author.id]["conversation"]
-            prompt = conv.prepare_prompt(ctx.content)
-
-            if self.bot.debug:
-                logger.debug(f"\n\n{conv}\n\n")
-                logger.debug(f"Tokens: {num_tokens_from_messages(prompt)}")
-
-            if num_tokens_from_messages(prompt) > 3500:
-                await ctx.reply("對話過長，請重新開始對話。")
-                del self.chatting_threads[ctx.author.id]
-                await self.close_thread(ctx.channel.id)
-                return
+    async def cog_load(self):
+        for user_id, state in self.questionnaire_threads.items():
+            self.register_questionnaire(user_id, state)
+        self.restore_sessions()
+
+    def register_questionnaire(self, user_id, state):
+        session_router.register(state["thread_id"], user_id, self.handle_questionnaire,
+                                on_foreign=self.delete_foreign_message, kind="questionnaire",
+                                on_idle=self.expire_questionnaire, idle_timeout=QUESTIONNAIRE_IDLE_TIMEOUT)
+
+    def restore_sessions(self):
+        """Rebuild the self chats that were in flight before the restart from the session journal."""
+        for key, session in session_journal.take("psy:").items():
+            conversation = Conversation(
+                debug=self.bot.debug, log_path=session["data"]["log_path"])
+            conversation.init_system_message(
+                session["data"]["system"], log=False)
+            conversation.restore(session)
+            conversation.journal_key = key
+            user_id = int(key.split(":", 1)[1])
+            self.chatting_threads[user_id] = {
+                "thread_id": session["data"]["thread"],
+                "conversation": conversation
+            }
+            session_router.register(session["data"]["thread"], user_id, self.handle_chat, debounce=DEBOUNCE_SECONDS,
+                                    on_idle=self.expire_chat, idle_timeout=CHAT_IDLE_TIMEOUT)
+
+    async def cog_unload(self):
+        for task in list(self.analyses):
+            task.cancel()
+        await asyncio.to_thread(self.database.close)
+
+    async def delete_foreign_message(self, ctx):
+        """Delete any message inside a questionnaire thread that is not belong to the bot or the user."""
+        try:
+            await ctx.delete()
+        except Exception as e:
+            logger.error(f"Failed to delete message {ctx.id}: {e}")
 
-            try:
-                async with ctx.channel.typing():
-                    if self.bot.debug:
-                        if ctx.content == "掰掰":
-                            # Debuging chat exit function
-                            full_reply_content = "掰掰"
-                        else:
-                            # Debuging reply function
-                            full_reply_content = "這是一個測試回應。為了避免過度使用 OpenAI API，這個回應是從本地讀取的。"
-                    else:
-                        start_time = time.time()
-                        response = await sync_to_async(openai.ChatCompletion.create)(
-                            model="gpt-3.5-turbo",
-                            messages=prompt,
-                            stream=True
-                        )
-                        collected_messages = []
-                        message = None
-                        for chunk in response:
-                            chunk_time = time.time() - start_time  # calculate the time delay of the chunk
-                            # extract the message
-                            chunk_message = chunk['choices'][0]['delta']
-                            collected_messages.append(
-                                chunk_message)  # save the message
-                            if chunk_time > 3.0:
-                                full_reply_content = ''.join(
-                                    [m.get('content', '') for m in collected_messages])
-                                if message:
-                                    await message.edit(content=full_reply_content)
-                                else:
-                                    message = await ctx.channel.send(full_reply_content)
-                                start_time = time.time()
-
-                        full_reply_content = ''.join(
-                            [m.get('content', '') for m in collected_messages])
-                        if message:
-                            await message.edit(content=full_reply_content)
-                        else:
-                            message = await ctx.channel.send(full_reply_content)
+    async def handle_questionnaire(self, ctx, content):
+        """Record an answer and send the next question. Called by the session router, one message at a time."""
+        state = self.questionnaire_threads[ctx.author.id]
+        # The answer is only recorded once the next step succeeded, so a failed send does not shift the answers.
+        answers = state["answers"] + [content]
 
-            except Exception as e:
-                logger.error(f"Failed to generate conversation: {e}")
-                await ctx.reply(f"生成對話時發生錯誤：{e}")
+        user_discriminator = ctx.author.name + "#" + ctx.author.discriminator
+        if state["counter"] == len(self.questions):
+            await self.database.save(
+                ctx.author.id, user_discriminator, self.questions, answers)
+            # Delete this user in chatting_thread
+            self.end_questionnaire(ctx.author.id)
+            await self.database.delete_questionnaire(ctx.author.id)
+
+            logger.info(f"Saved user {user_discriminator}'s data.")
+
+            # The analysis takes several requests, run it in the background so the handler returns right away.
+            await ctx.channel.send("問卷已完成，正在分析中...")
+            task = asyncio.create_task(self.analyze(ctx, answers))
+            self.analyses.add(task)
+            task.add_done_callback(self.analyses.discard)
+        else:
+            await ctx.channel.send(self.questions[state["counter"]])
+            state["answers"] = answers
+            state["counter"] += 1
+            await self.database.save_questionnaire(ctx.author.id, state)
+
+    async def analyze(self, ctx, answers):
+        """Analyze a finished questionnaire, store the report and close its thread."""
+        try:
+            report, chat_system_message = await personality_analyze(
+                self.questions, answers, database=self.database,
+                requester=(ctx.guild.id, ctx.author.id), debug=self.bot.debug)
+        except Exception as e:
+            logger.error(f"Failed to analyze user {ctx.author.id}: {e}")
+            await ctx.channel.send(f"分析時發生錯誤：{e}")
+            return
+        await self.database.update(
+            ctx.author.id, report=report, chat_system_message=chat_system_message)
+
+        await ctx.channel.send("分析已完成！將於5秒後自動關閉此討論串。")
+        await asyncio.sleep(5)
+        await self.close_thread(ctx.channel.id)
+
+    async def handle_chat(self, ctx, content):
+        """Reply to a turn in a self chat thread. Called by the session router, one turn at a time."""
+        conv = self.chatting_threads[ctx.author.id]["conversation"]
+        prompt = await conv.aprepare_prompt(content)
+
+        if self.bot.debug:
+            logger.debug("Prompt:\n%s", setting.LazyJson(prompt))
+            logger.debug("Tokens: %d", conv.prompt_tokens)
+
+        if conv.prompt_tokens > conv.token_budget:
+            # Older turns are summarized, so only a single oversized message can exceed the budget.
+            conv.pop_last()
+            await ctx.reply("訊息過長，請縮短後再試一次。")
+            return
 
-            if full_reply_content == "":
-                await ctx.reply("沒有生成任何回應。")
-                return
+        if self.bot.debug:
+            if content == "掰掰":
+                # Debuging chat exit function
+                chunks = stream_text("掰掰")
+            else:
+                # Debuging reply function
+                chunks = stream_text(
+                    "這是一個測試回應。為了避免過度使用 OpenAI API，這個回應是從本地讀取的。")
+        else:
+            chunks = stream_conversation(
+                prompt, requester=(ctx.guild.id, ctx.author.id), prompt_tokens=conv.prompt_tokens)
+        full_reply_content = await reply_turn(conv, ctx, chunks)
+        if full_reply_content is None:
+            return
 
-            conv.append_response(full_reply_content)
+        conv.append_response(full_reply_content)
+        session_router.answered(ctx.channel.id)
+        metrics.inc("tokens_total", conv.prompt_tokens,
+                    cog="psy", persona="self", kind="prompt")
+        metrics.inc("tokens_total", conv.last_tokens,
+                    cog="psy", persona="self", kind="completion")
 
-            # If the bot reply with "掰掰", end the conversation
-            if "掰掰" in full_reply_content:
-                logger.debug("Quitting Chat...")
-                await asyncio.sleep(3)
-                del self.chatting_threads[ctx.author.id]
-                await self.close_thread(ctx.channel.id)
+        # If the bot reply with "掰掰", end the conversation
+        if "掰掰" in full_reply_content:
+            logger.debug("Quitting Chat...")
+            await asyncio.sleep(3)
+            self.end_chat(ctx.author.id)
+            await self.close_thread(ctx.channel.id)
 
     @commands.command(name="update_psygpt_api_key")
     @commands.has_permissions(administrator=True)
@@ -203,8 +201,7 @@ class PsyGPT(commands.Cog):
 
         user_id = ctx.author.id
 
-        ids_in_database = [self.database[user]["id"] for user in self.database]
-        if user_id in ids_in_database:
+        if await self.database.contains(user_id):
             # Send a message contains yes button and no button ask if the user wants to overwrite the data, if user choose yes, then keep the function, if no, return.
             view = View()
             view.add_item(
@@ -225,7 +222,7 @@ class PsyGPT(commands.Cog):
                     if isinstance(child, Button) and child.custom_id == custom_id:
                         clicked_button = child
                         break
-                logger.debug(f"Clicked button: {clicked_button.label}")
+                logger.debug("Clicked button: %s", clicked_button.label)
                 if clicked_button is not None and clicked_button.label == "是":
                     await message.edit(content="資料會在分析完成後覆蓋。", view=None)
                 else:
@@ -236,12 +233,13 @@ class PsyGPT(commands.Cog):
 
         # Check if the user has already started a conversation in a thread. If yes, send a message that mention the thread to the user.
         if user_id in self.questionnaire_threads:
-            thread_id = self.questionnaire_threads[user_id]
+            thread_id = self.questionnaire_threads[user_id]["thread_id"]
             try:
                 thread = await self.bot.fetch_channel(thread_id)
             except Exception as e:
                 # If the thread has been deleted, remove the thread from the dictionary.
-                del self.questionnaire_threads[user_id]
+                self.end_questionnaire(user_id)
+                await self.database.delete_questionnaire(user_id)
                 await ctx.send("請重新開始一次分析。")
                 return
             await ctx.send(f"你已經在 <#{thread.id}> 裡面開始了分析。")
@@ -250,13 +248,18 @@ class PsyGPT(commands.Cog):
         msg = await ctx.send("已開始分析")
         thread = await ctx.channel.create_thread(
             name=f"{ctx.author.name} 的分析", message=msg, auto_archive_duration=60)
-        self.questionnaire_threads[user_id] = {
+        state = {
+            "guild_id": ctx.guild.id,
             "thread_id": thread.id,
-            "counter": 0
+            "counter": 0,
+            "answers": []
         }
+        self.questionnaire_threads[user_id] = state
+        self.register_questionnaire(user_id, state)
 
         await thread.send(self.questions[0])
-        self.questionnaire_threads[user_id]["counter"] += 1
+        state["counter"] += 1
+        await self.database.save_questionnaire(user_id, state)
 
     @commands.hybrid_command(name="self_chat", description="Chat with you. Yes, you.")
     async def _self_chat(self, ctx):
@@ -264,8 +267,8 @@ class PsyGPT(commands.Cog):
         user_id = ctx.author.id
         user_discriminator = ctx.author.name + "#" + ctx.author.discriminator
 
-        ids_in_database = [self.database[user]["id"] for user in self.database]
-        if user_id not in ids_in_database:
+        user_data = await self.database.get(user_id)
+        if user_data is None or user_data["chat_system_message"] is None:
             await ctx.send("你還沒有進行分析！")
             return
 
@@ -277,14 +280,21 @@ class PsyGPT(commands.Cog):
             auto_archive_duration=60,
         )
 
-        self.load_database()
-        conversation = Conversation()
-        conversation.init_system_message(
-            self.database[user_discriminator]["chat_system_message"])
+        # Close a chat the user still has open first, its journal close must come before the new open.
+        self.end_chat(ctx.author.id)
+        conversation = Conversation(
+            debug=self.bot.debug, log_path=history_path(ctx.author.id, "self"))
+        conversation.init_system_message(user_data["chat_system_message"])
+        key = f"psy:{ctx.author.id}"
+        session_journal.open(key, thread=thread.id, system=user_data["chat_system_message"],
+                             log_path=conversation.log_path)
+        conversation.journal_key = key
         self.chatting_threads[ctx.author.id] = {
             "thread_id": thread.id,
             "conversation": conversation
         }
+        session_router.register(thread.id, ctx.author.id, self.handle_chat, debounce=DEBOUNCE_SECONDS,
+                                on_idle=self.expire_chat, idle_timeout=CHAT_IDLE_TIMEOUT)
 
     @commands.hybrid_command(name="report", description="Get your personality report.")
     async def _report(self, ctx):
@@ -293,18 +303,41 @@ class PsyGPT(commands.Cog):
 
         user_id = ctx.author.id
 
-        ids_in_database = [self.database[user]["id"] for user in self.database]
-        if user_id not in ids_in_database:
+        user_data = await self.database.get(user_id)
+        if user_data is None or user_data["report"] is None:
             await ctx.send("你還沒有進行分析！")
             return
 
-        user_discriminator = ctx.author.name + "#" + ctx.author.discriminator
-        user_data = self.database[user_discriminator]["report"]
-
-        await ctx.author.send(user_data)
+        await ctx.author.send(user_data["report"])
 
         await ctx.send("已將分析結果私訊給你。")
 
+    def end_chat(self, user_id):
+        """Forget the self chat of a user."""
+        chat = self.chatting_threads.pop(user_id, None)
+        if chat is not None:
+            session_router.unregister(chat["thread_id"])
+            release_edit_budget(chat["thread_id"])
+            chat["conversation"].close()
+            session_journal.close(f"psy:{user_id}")
+
+    def end_questionnaire(self, user_id):
+        """Forget the in-progress questionnaire of a user."""
+        state = self.questionnaire_threads.pop(user_id, None)
+        if state is not None:
+            session_router.unregister(state["thread_id"])
+
+    async def expire_chat(self, session):
+        """Close a self chat whose user has been silent for too long."""
+        self.end_chat(session.user_id)
+        await self.close_thread(session.thread_id)
+
+    async def expire_questionnaire(self, session):
+        """Drop a questionnaire that was abandoned halfway."""
+        self.end_questionnaire(session.user_id)
+        await self.database.delete_questionnaire(session.user_id)
+        await self.close_thread(session.thread_id)
+
     async def close_thread(self, id):
         """Delete the thread"""
         try:
@@ -316,30 +349,5 @@ class PsyGPT(commands.Cog):
             return False
 
 
-async def personality_analyze(questions: list, answers: list, debug: bool = False):
-    """Analyze the user's personality by their answers.
-
-    Args:
-        questions (list): A list of questions.
-        answers (list): A list of answers.
-
-    Returns:
-        string: A string contains the user's personality report.
-    """
-
-    # Example to use Conversation and generate_conversation to call OpenAI ChatGPT API.
-    conv = Conversation()
-    conv.init_system_message("Test system message.")
-
-    prompt = conv.prepare_prompt(questions + answers)
-
-    if not debug:
-        completion = await generate_conversation(prompt)
-    else:
-        completion = "Debug message"
-
-    return completion
-
-
 async def setup(client):
     await client.add_cog(PsyGPT(client))
@@ -0,0 +1,53 @@
+import os
+import json
+from assets.utils.archive import ConversationArchive
+
+
+def write_log(directory, name, records):
+    path = os.path.join(directory, name)
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return path
+
+
+def test_compact_index_and_read(tmp_path):
+    history = tmp_path / "history"
+    history.mkdir()
+    records = [
+        {"time": "2023-04-01T10:00:00", "role": "system", "content": "persona"},
+        {"time": "2023-04-01T10:00:05", "role": "user", "content": "哈囉", "tokens": 3},
+        {"time": "2023-04-01T10:00:09", "role": "assistant", "content": "嗨", "tokens": 2},
+    ]
+    write_log(history, "1234-Kita-20230401100000.jsonl", records)
+    write_log(history, "abcdefghij.jsonl", records[:1])
+    archive = ConversationArchive(str(tmp_path / "archive"), str(history))
+    try:
+        assert archive.compact(older_than=0) == 2
+        assert os.listdir(history) == []
+        rows = list(archive.find(user_id=1234, persona="Kita"))
+        assert len(rows) == 1
+        row = rows[0]
+        assert (row["started"], row["ended"]) == ("2023-04-01T10:00:00", "2023-04-01T10:00:09")
+        assert (row["messages"], row["tokens"]) == (2, 5)
+        assert list(archive.read(row)) == records
+        # Logs with random names are archived without a user.
+        assert sorted((row["name"], row["user_id"]) for row in archive.find()) == [
+            ("1234-Kita-20230401100000.jsonl", 1234), ("abcdefghij.jsonl", None)]
+    finally:
+        archive.close()
+
+
+def test_live_and_recent_logs_are_not_archived(tmp_path):
+    history = tmp_path / "history"
+    history.mkdir()
+    live = write_log(history, "1-Kita-20230401100000.jsonl", [{"role": "user", "content": "a"}])
+    write_log(history, "2-Kita-20230401100000.jsonl", [{"role": "user", "content": "b"}])
+    archive = ConversationArchive(str(tmp_path / "archive"), str(history))
+    archive.live.add(live)
+    try:
+        assert archive.compact(older_than=3600) == 0
+        assert archive.compact(older_than=0) == 1
+        assert os.listdir(history) == ["1-Kita-20230401100000.jsonl"]
+    finally:
+        archive.close()
@@ -0,0 +1,73 @@
+import pytest
+import assets.utils.cache as cache
+from assets.utils.cache import ResponseCache, normalize
+
+
+def prompt(text):
+    return [{"role": "system", "content": "persona"}, {"role": "user", "content": text}]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_normalize():
+    assert normalize("  Hello   World！！ ") == "hello world"
+    assert normalize("ＡＢＣ?") == "abc"
+
+
+def test_hit_for_trivially_different_prompts():
+    responses = ResponseCache(enabled=True)
+    responses.put("Kita", prompt("Hello!"), "hi")
+    assert responses.get("Kita", prompt("hello")) == "hi"
+    assert responses.get("Ryou", prompt("hello")) is None
+    assert (responses.hits, responses.misses) == (1, 1)
+
+
+def test_disabled_cache_stores_nothing():
+    responses = ResponseCache(enabled=False)
+    responses.put("Kita", prompt("hello"), "hi")
+    assert responses.get("Kita", prompt("hello")) is None
+    assert len(responses.entries) == 0
+
+
+def test_evicts_the_least_recently_used_entry():
+    responses = ResponseCache(max_entries=2, enabled=True)
+    responses.put("Kita", prompt("a"), "1")
+    responses.put("Kita", prompt("b"), "2")
+    # Using "a" makes "b" the least recently used.
+    assert responses.get("Kita", prompt("a")) == "1"
+    responses.put("Kita", prompt("c"), "3")
+    assert responses.get("Kita", prompt("b")) is None
+    assert responses.get("Kita", prompt("a")) == "1"
+    assert responses.get("Kita", prompt("c")) == "3"
+
+
+def test_evicts_over_the_byte_budget():
+    responses = ResponseCache(max_bytes=200, enabled=True)
+    responses.put("Kita", prompt("a"), "x" * 100)
+    responses.put("Kita", prompt("b"), "y" * 100)
+    assert len(responses.entries) == 1
+    assert responses.get("Kita", prompt("b")) == "y" * 100
+    assert responses.size <= 200
+
+
+def test_entries_expire_after_the_ttl(clock):
+    responses = ResponseCache(ttl=60, enabled=True)
+    responses.put("Kita", prompt("a"), "1")
+    clock[0] += 59
+    assert responses.get("Kita", prompt("a")) == "1"
+    clock[0] += 2
+    assert responses.get("Kita", prompt("a")) is None
+    assert responses.size == 0
+
+
+def test_replacing_an_entry_keeps_the_size_in_sync():
+    responses = ResponseCache(enabled=True)
+    responses.put("Kita", prompt("a"), "short")
+    responses.put("Kita", prompt("a"), "a longer response")
+    key = ResponseCache.key("Kita", prompt("a"))
+    assert responses.size == len(key) + len("a longer response")
@@ -0,0 +1,36 @@
+import asyncio
+import assets.utils.chat as chat
+from assets.utils.chat import Conversation
+from assets.utils.memory import memory_budget
+
+
+def test_closing_during_compaction(tmp_path, monkeypatch):
+    summaries = []
+
+    async def summarize_conversation(summary, messages, debug=False):
+        summaries.append(messages)
+        await asyncio.sleep(10)
+        return "summary"
+
+    monkeypatch.setattr(chat, "num_tokens_from_message", lambda message: 100)
+    monkeypatch.setattr(chat, "summarize_conversation", summarize_conversation)
+
+    async def main():
+        total = memory_budget.total
+        conversation = Conversation(token_budget=500, log_path=str(tmp_path / "chat.jsonl"))
+        conversation.init_system_message("system", log=False)
+        for i in range(3):
+            conversation.prepare_prompt(f"question {i}", tokens=100)
+            conversation.append_response(f"answer {i}")
+        compaction = conversation._compaction
+        await asyncio.sleep(0)
+        assert len(summaries) == 1
+        conversation.close()
+        await asyncio.gather(compaction, return_exceptions=True)
+        assert compaction.cancelled()
+        # Nothing was summarized, and the closed conversation is no longer tracked.
+        assert conversation.summary is None
+        assert conversation not in memory_budget.conversations
+        assert memory_budget.total == total
+
+    asyncio.run(main())
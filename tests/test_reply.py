@@ -0,0 +1,81 @@
+import asyncio
+import assets.utils.chat as chat
+from assets.utils.chat import Conversation, reply_turn
+
+
+class Channel:
+    id = 1
+
+    def __init__(self) -> None:
+        self.messages = []
+
+    def typing(self):
+        return Typing()
+
+    async def send(self, content, reference=None):
+        message = Message(self, content)
+        self.messages.append(message)
+        return message
+
+
+class Typing:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class Message:
+    def __init__(self, channel, content) -> None:
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content):
+        self.content = content
+
+    async def delete(self):
+        self.channel.messages.remove(self)
+
+    async def reply(self, content):
+        return await self.channel.send(content)
+
+
+def conversation(tmp_path, monkeypatch):
+    monkeypatch.setattr(chat, "num_tokens_from_message", lambda message: 10)
+    conversation = Conversation(log_path=str(tmp_path / "chat.jsonl"))
+    conversation.init_system_message("system", log=False)
+    conversation.prepare_prompt("hi", tokens=10)
+    return conversation
+
+
+def test_reply_is_returned(tmp_path, monkeypatch):
+    conv = conversation(tmp_path, monkeypatch)
+    channel = Channel()
+    user_message = Message(channel, "hi")
+    assert asyncio.run(reply_turn(conv, user_message, chat.stream_text("hello"))) == "hello"
+    assert [message.content for message in channel.messages] == ["hello"]
+    assert len(conv.turns) == 1
+
+
+def test_failed_stream_removes_the_turn_and_the_partial_reply(tmp_path, monkeypatch):
+    conv = conversation(tmp_path, monkeypatch)
+    channel = Channel()
+    user_message = Message(channel, "hi")
+
+    async def chunks():
+        yield "partial"
+        raise RuntimeError("connection reset")
+
+    assert asyncio.run(reply_turn(conv, user_message, chunks())) is None
+    assert len(conv.turns) == 0
+    assert [message.content for message in channel.messages] == ["生成對話時發生錯誤：connection reset"]
+
+
+def test_empty_reply_removes_the_turn(tmp_path, monkeypatch):
+    conv = conversation(tmp_path, monkeypatch)
+    channel = Channel()
+    user_message = Message(channel, "hi")
+    assert asyncio.run(reply_turn(conv, user_message, chat.stream_text(""))) is None
+    assert len(conv.turns) == 0
+    assert [message.content for message in channel.messages] == ["沒有生成任何回應。"]
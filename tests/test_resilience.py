@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+import assets.utils.resilience as resilience
+from assets.utils.resilience import CircuitBreaker, CircuitOpen, DeadlineExceeded, LatencyTracker, ResilientCompletion
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout=5))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(threshold=3, cooldown=30)
+    for _ in range(2):
+        breaker.failure()
+    breaker.check()
+    breaker.failure()
+    assert breaker.is_open
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+
+def test_breaker_lets_one_probe_through_after_the_cooldown(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=30)
+    breaker.failure()
+    clock[0] += 31
+    breaker.check()
+    # Other requests wait for the probe.
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+    breaker.success()
+    assert not breaker.is_open
+    breaker.check()
+
+
+def test_latency_percentile_needs_enough_samples():
+    latency = LatencyTracker()
+    for i in range(resilience.HEDGE_MIN_SAMPLES - 1):
+        latency.observe(i)
+    assert latency.percentile(0.95) is None
+    latency.observe(100)
+    assert latency.percentile(0.95) == 100
+    assert latency.percentile(0.5) == 10
+
+
+def test_retries_a_failed_request(monkeypatch):
+    calls = []
+
+    async def create(messages):
+        calls.append(messages)
+        if len(calls) == 1:
+            raise asyncio.TimeoutError()
+        return {"ok": True}
+
+    async def acquire(requester, tokens):
+        pass
+
+    monkeypatch.setattr(resilience.completion_client, "create", create)
+    monkeypatch.setattr(resilience.request_scheduler, "acquire", acquire)
+    monkeypatch.setattr(resilience, "backoff", lambda attempt: 0)
+    completion = ResilientCompletion(deadline=5, max_retries=2, hedge_percentile=None)
+    assert run(completion.create([])) == {"ok": True}
+    assert len(calls) == 2
+    assert completion.breaker.failures == 0
+
+
+def test_deadline_is_enforced(monkeypatch):
+    async def create(messages):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(resilience.completion_client, "create", create)
+    completion = ResilientCompletion(deadline=0.1, max_retries=0, hedge_percentile=None)
+    with pytest.raises(DeadlineExceeded):
+        run(completion.create([]))
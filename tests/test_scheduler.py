@@ -0,0 +1,88 @@
+import asyncio
+import pytest
+from assets.utils.scheduler import RequestScheduler, SchedulerBusy, COMPLETION_TOKEN_ESTIMATE
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout=5))
+
+
+def test_grants_right_away_with_budget():
+    async def main():
+        scheduler = RequestScheduler(rpm=60, tpm=100000)
+        await scheduler.acquire((1, 1), 100)
+        assert scheduler.size == 0
+        assert scheduler.tokens.level == pytest.approx(
+            100000 - 100 - COMPLETION_TOKEN_ESTIMATE, abs=1)
+
+    run(main())
+
+
+def test_waiter_cancelled_before_its_grant_is_skipped():
+    async def main():
+        scheduler = RequestScheduler(rpm=6000, tpm=10 ** 6)
+        scheduler.requests.level = 0
+        first = asyncio.create_task(scheduler.acquire((1, 1), 10))
+        second = asyncio.create_task(scheduler.acquire((2, 2), 10))
+        await asyncio.sleep(0)
+        assert scheduler.size == 2
+        # The scheduler loop has not run yet. It now finds budget for the first waiter, which is already cancelled.
+        scheduler.requests.level = 1.0
+        first.cancel()
+        await second
+        assert first.cancelled()
+        assert scheduler.size == 0
+
+    run(main())
+
+
+def test_cancel_after_grant_gives_the_budget_back():
+    async def main():
+        scheduler = RequestScheduler(rpm=60, tpm=10 ** 6)
+        scheduler.requests.level = 0
+        waiter = asyncio.create_task(scheduler.acquire((1, 1), 10))
+        await asyncio.sleep(0)
+        scheduler.requests.level = 1.0
+        # The scheduler loop grants the waiter, which has not resumed yet.
+        await asyncio.sleep(0)
+        assert scheduler.size == 0 and not waiter.done()
+        requests = scheduler.requests.level
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert scheduler.requests.level == pytest.approx(requests + 1, abs=0.1)
+
+    run(main())
+
+
+def test_round_robin_over_guilds():
+    async def main():
+        scheduler = RequestScheduler(rpm=6000, tpm=10 ** 6)
+        scheduler.requests.level = 0
+        order = []
+
+        async def request(guild_id, user_id):
+            await scheduler.acquire((guild_id, user_id), 10)
+            order.append(guild_id)
+
+        tasks = [asyncio.create_task(request(1, user_id)) for user_id in range(3)]
+        tasks.append(asyncio.create_task(request(2, 0)))
+        await asyncio.gather(*tasks)
+        assert order[:2] == [1, 2]
+
+    run(main())
+
+
+def test_rejects_when_the_queue_is_full():
+    async def main():
+        scheduler = RequestScheduler(rpm=60, tpm=10 ** 6, max_queue=1)
+        scheduler.requests.level = 0
+        waiter = asyncio.create_task(scheduler.acquire((1, 1), 10))
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerBusy):
+            await scheduler.acquire((2, 2), 10)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.size == 0
+
+    run(main())
@@ -0,0 +1,99 @@
+import asyncio
+import types
+from assets.utils.session import SessionRouter
+
+THREAD_ID = 10
+USER_ID = 1
+
+
+def message(content, author=USER_ID):
+    return types.SimpleNamespace(id=0, content=content, guild=None,
+                                 channel=types.SimpleNamespace(id=THREAD_ID),
+                                 author=types.SimpleNamespace(id=author))
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout=5))
+
+
+def test_burst_is_answered_as_one_turn():
+    async def main():
+        router = SessionRouter()
+        turns = []
+
+        async def handler(last, content):
+            turns.append(content)
+
+        router.register(THREAD_ID, USER_ID, handler, debounce=0.05)
+        await router.dispatch(message("a"))
+        await router.dispatch(message("b"))
+        await asyncio.sleep(0.2)
+        assert turns == ["a\nb"]
+        assert router.get(THREAD_ID).pending == []
+
+    run(main())
+
+
+def test_cancelled_turn_is_answered_with_the_next_message():
+    async def main():
+        router = SessionRouter()
+        turns = []
+
+        async def handler(last, content):
+            turns.append(content)
+            if content == "a":
+                await asyncio.sleep(10)
+
+        router.register(THREAD_ID, USER_ID, handler, debounce=0.05)
+        await router.dispatch(message("a"))
+        await asyncio.sleep(0.1)
+        await router.dispatch(message("b"))
+        await asyncio.sleep(0.2)
+        assert turns == ["a", "a\nb"]
+
+    run(main())
+
+
+def test_committed_turn_is_not_answered_again():
+    async def main():
+        router = SessionRouter()
+        turns = []
+
+        async def handler(last, content):
+            turns.append(content)
+            router.answered(THREAD_ID)
+            if content == "a":
+                # E.g. the pause before a chat closes itself after saying goodbye.
+                await asyncio.sleep(10)
+
+        router.register(THREAD_ID, USER_ID, handler, debounce=0.05)
+        await router.dispatch(message("a"))
+        await asyncio.sleep(0.1)
+        await router.dispatch(message("b"))
+        await asyncio.sleep(0.2)
+        assert turns == ["a", "b"]
+
+    run(main())
+
+
+def test_foreign_messages_and_unregistered_threads():
+    async def main():
+        router = SessionRouter()
+        turns, foreign = [], []
+
+        async def handler(last, content):
+            turns.append(content)
+
+        async def on_foreign(msg):
+            foreign.append(msg.content)
+
+        router.register(THREAD_ID, USER_ID, handler, on_foreign=on_foreign)
+        await router.dispatch(message("mine"))
+        await router.dispatch(message("theirs", author=2))
+        router.unregister(THREAD_ID)
+        await router.dispatch(message("late"))
+        assert turns == ["mine"]
+        assert foreign == ["theirs"]
+        assert len(router) == 0
+
+    run(main())
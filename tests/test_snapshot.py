@@ -0,0 +1,95 @@
+import json
+from assets.utils.snapshot import SessionJournal
+
+
+def message(role, content):
+    return {"role": role, "content": content}
+
+
+def restart(journal):
+    """A new journal on the same file, as after a restart."""
+    return SessionJournal(journal.path).restore()
+
+
+def test_replays_messages_and_summaries(tmp_path):
+    # No event loop is running, so every record is written straight through.
+    journal = SessionJournal(str(tmp_path / "sessions.jsonl"))
+    journal.open("gpt3:1", persona="Kita")
+    for i in range(4):
+        journal.message("gpt3:1", message("user", f"m{i}"), i)
+    journal.summary("gpt3:1", 2, "summary", 7)
+    session = restart(journal)["gpt3:1"]
+    assert session["data"] == {"persona": "Kita"}
+    assert session["messages"] == [("user", "m2", 2), ("user", "m3", 3)]
+    assert (session["summary"], session["summary_tokens"]) == ("summary", 7)
+
+
+def test_popped_messages_stay_removed(tmp_path):
+    journal = SessionJournal(str(tmp_path / "sessions.jsonl"))
+    journal.open("gpt3:1", persona="Kita")
+    journal.message("gpt3:1", message("user", "first"), 1)
+    journal.message("gpt3:1", message("assistant", "reply1"), 1)
+    # A cancelled turn, answered together with the next message.
+    journal.message("gpt3:1", message("user", "cancelled msg"), 1)
+    journal.pop("gpt3:1")
+    journal.message("gpt3:1", message("user", "cancelled msg\nsecond"), 1)
+    journal.message("gpt3:1", message("assistant", "reply2"), 1)
+    journal.summary("gpt3:1", 2, "summary", 1)
+    session = restart(journal)["gpt3:1"]
+    assert [content for _, content, _ in session["messages"]] == [
+        "cancelled msg\nsecond", "reply2"]
+
+
+def test_restore_rewrites_the_live_state(tmp_path):
+    journal = SessionJournal(str(tmp_path / "sessions.jsonl"))
+    journal.open("psy:1", system="you")
+    journal.message("psy:1", message("user", "kept"), 1)
+    journal.message("psy:1", message("user", "dropped"), 1)
+    journal.pop("psy:1")
+    journal.open("psy:2", system="you")
+    journal.close("psy:2")
+    sessions = restart(journal)
+    with open(journal.path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert [record["op"] for record in records] == ["open", "m"]
+    # Replaying the rewritten file gives the same sessions.
+    assert restart(journal) == sessions
+
+
+def test_close_after_open_drops_the_session(tmp_path):
+    journal = SessionJournal(str(tmp_path / "sessions.jsonl"))
+    journal.open("psy:1", thread=10)
+    journal.close("psy:1")
+    journal.message("psy:1", message("user", "lost"), 1)
+    assert restart(journal) == {}
+
+
+def test_reopen_after_close_keeps_the_new_session(tmp_path):
+    journal = SessionJournal(str(tmp_path / "sessions.jsonl"))
+    journal.open("psy:1", thread=10)
+    journal.message("psy:1", message("user", "old"), 1)
+    journal.close("psy:1")
+    journal.open("psy:1", thread=11)
+    journal.message("psy:1", message("user", "new"), 1)
+    session = restart(journal)["psy:1"]
+    assert session["data"] == {"thread": 11}
+    assert session["messages"] == [("user", "new", 1)]
+
+
+def test_skips_a_torn_last_line(tmp_path):
+    journal = SessionJournal(str(tmp_path / "sessions.jsonl"))
+    journal.open("gpt3:1", persona="Kita")
+    journal.message("gpt3:1", message("user", "hi"), 1)
+    with open(journal.path, "a", encoding="utf-8") as f:
+        f.write('{"op": "m", "k": "gpt3:1", "r": "us')
+    assert restart(journal)["gpt3:1"]["messages"] == [("user", "hi", 1)]
+
+
+def test_take_removes_the_sessions_of_a_cog(tmp_path):
+    journal = SessionJournal(str(tmp_path / "sessions.jsonl"))
+    journal.open("gpt3:1", persona="Kita")
+    journal.open("psy:1", system="you")
+    restored = SessionJournal(journal.path)
+    restored.restore()
+    assert list(restored.take("gpt3:")) == ["gpt3:1"]
+    assert list(restored.sessions) == ["psy:1"]